@@ -0,0 +1,215 @@
+import heapq
+import logging
+
+import metrics
+
+#The analytics need numpy
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Neighborhood percentiles shown on the summary sheet
+SUMMARY_PERCENTILES = [25, 50, 75]
+
+#Rows of a neighborhood with fewer floorplans than this are compared with every row instead
+MIN_GROUP_SIZE = 5
+
+#With constantMemory only the names of this many floorplans are kept, the best values listed on the Best Value sheet
+BEST_VALUE_ROWS = 1000
+
+#The numbers kept for every row, one numpy column each
+COLUMNS = ['price', 'size', 'bed', 'bath', 'discount']
+
+class Analytics(object):
+    """Collects the numbers of every row written as numpy columns, then ranks and summarizes all of them at once:
+    price/sqft, the price after the utility adjustments, where each floorplan falls among its neighborhood,
+    z-score outliers, and a best value ranking. The results are written as values on two extra sheets, so
+    the workbook doesn't have to calculate anything when it is opened. With constantMemory the names of only the
+    BEST_VALUE_ROWS best values are kept, so memory use grows by a few dozen bytes per row."""
+
+    def __init__(self, config):
+        if numpy is None:
+            raise Exception("ERROR: analytics needs numpy, install it with \'pip install numpy\'")
+        self.outlierZScore = config['outlierZScore']
+        self.count = 0
+        self.columns = numpy.empty((len(COLUMNS), 1024))
+        self.groups = numpy.empty(1024, dtype=numpy.int32) #Index of each row's neighborhood in self.neighborhoods
+        self.neighborhoods = []
+        self.neighborhoodIndex = {}
+        self.names = {} #Row index -> name cell
+        self.bestRows = None
+        if config.get('constantMemory', False):
+            self.bestRows = BEST_VALUE_ROWS
+        self.best = [] #(-adjusted price/sqft, -row index) of the rows whose names are kept, the worst one first
+
+    def add(self, row, discount):
+        """Adds an OutputRow, the discount is the (negative) utility adjustment of its price."""
+        if self.count == self.groups.shape[0]:
+            self.columns = numpy.concatenate([self.columns, numpy.empty(self.columns.shape)], axis=1)
+            self.groups = numpy.concatenate([self.groups, numpy.empty(self.groups.shape, dtype=numpy.int32)])
+        index = self.count
+        price = numpy.nan if not row.price else row.price #No price is read as 0, e.x. "Call for Rent"
+        size = numpy.nan if not row.size else row.size
+        self.columns[:, index] = [price, size, numpy.nan if row.bed is None else row.bed,
+                                  numpy.nan if row.bath is None else row.bath, discount]
+        neighborhood = row.getValueCell('neighborhood') or "(none)"
+        if neighborhood not in self.neighborhoodIndex:
+            self.neighborhoodIndex[neighborhood] = len(self.neighborhoods)
+            self.neighborhoods.append(neighborhood)
+        self.groups[index] = self.neighborhoodIndex[neighborhood]
+        self.count += 1
+
+        if self.bestRows is None:
+            self.names[index] = row.getNameCell()
+            return
+        #Same order as the ranking: lowest adjusted price/sqft first, earlier rows first among equal ones
+        value = (float(price) + discount) / float(size)
+        if numpy.isnan(value):
+            return
+        heapq.heappush(self.best, (-value, -index))
+        self.names[index] = row.getNameCell()
+        if len(self.best) > self.bestRows:
+            value, worst = heapq.heappop(self.best)
+            del self.names[-worst]
+
+    def compute(self):
+        """Returns a dict of numpy arrays with one value per row (nan where a row has no price or size),
+        and the per-neighborhood summary as a list of dicts."""
+        columns = dict(zip(COLUMNS, self.columns[:, :self.count]))
+        prices = columns['price']
+        sizes = columns['size']
+        adjusted = prices + columns['discount']
+        result = {
+            'price': prices,
+            'size': sizes,
+            'bed': columns['bed'],
+            'bath': columns['bath'],
+            'value': prices / sizes,
+            'adjusted_price': adjusted,
+            'adjusted_value': adjusted / sizes
+        }
+
+        #Every number below compares the adjusted price/sqft, the best measure of value
+        value = result['adjusted_value']
+        valid = ~numpy.isnan(value)
+        #Neighborhoods are numbered in the order they were found, the summary lists them in alphabetical order
+        names = sorted(self.neighborhoods)
+        position = dict((name, i) for i, name in enumerate(names))
+        alphabetical = numpy.array([position[name] for name in self.neighborhoods], dtype=numpy.int64)
+        groups = alphabetical[self.groups[:self.count]]
+        counts = numpy.bincount(groups[valid], minlength=len(names))
+
+        #Mean and standard deviation per neighborhood from sums, small neighborhoods use those of all rows
+        filled = numpy.where(valid, value, 0.0)
+        sums = numpy.bincount(groups, weights=filled, minlength=len(names))
+        squares = numpy.bincount(groups, weights=filled * filled, minlength=len(names))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+            deviations = numpy.sqrt(numpy.maximum(squares / counts - means * means, 0.0))
+        small = counts < MIN_GROUP_SIZE
+        if valid.any():
+            means[small] = value[valid].mean()
+            deviations[small] = value[valid].std()
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            zscores = (value - means[groups]) / deviations[groups]
+        zscores[valid & (deviations[groups] == 0.0)] = 0.0
+        result['zscore'] = zscores
+        result['outlier'] = valid & (numpy.abs(zscores) >= self.outlierZScore)
+
+        #Where each row falls within its neighborhood, 0 is the lowest price/sqft and 100 the highest
+        order = numpy.lexsort((value, groups))
+        order = order[valid[order]]
+        starts = numpy.cumsum(counts) - counts
+        rankInGroup = numpy.empty(len(value))
+        rankInGroup[order] = numpy.arange(len(order)) - starts[groups[order]]
+        percentiles = numpy.full(len(value), numpy.nan)
+        percentiles[order] = 100.0 * rankInGroup[order] / numpy.maximum(counts[groups[order]] - 1, 1)
+        result['percentile'] = percentiles
+
+        #Best value first, rows without a price or size aren't ranked
+        ranking = numpy.argsort(value, kind='stable')
+        ranking = ranking[valid[ranking]]
+        result['ranking'] = ranking
+
+        summary = []
+        for i, name in enumerate(names):
+            rows = order[starts[i]:starts[i] + counts[i]] #Sorted by adjusted price/sqft
+            if len(rows) == 0:
+                continue
+            entry = {'neighborhood': name, 'floorplans': len(rows), 'outliers': int(result['outlier'][rows].sum())}
+            for key in ['adjusted_price', 'value', 'adjusted_value']:
+                entry[key] = numpy.percentile(result[key][rows], SUMMARY_PERCENTILES)
+            summary.append(entry)
+        return result, summary
+
+    def writeSheets(self, wb, header_format, num_format, link_format):
+        """Adds the "Summary" and "Best Value" sheets to the workbook."""
+        with metrics.timer('stage_seconds', 'analytics'):
+            result, summary = self.compute()
+            self.writeSummary(wb.add_worksheet("Summary"), result, summary, header_format, num_format)
+            self.writeRanking(wb.add_worksheet("Best Value"), result, header_format, num_format, link_format)
+        logging.info("Ranked %d floorplans, %d of them stand out from their neighborhood" % (len(result['ranking']), int(result['outlier'].sum())))
+
+    def writeSummary(self, ws, result, summary, header_format, num_format):
+        ws.set_column(0, 0, 25.0)
+        ws.set_column(1, 12, 12.0)
+        ranked = result['ranking']
+        ws.write(0, 0, "Floorplans", header_format)
+        ws.write(0, 1, self.count)
+        ws.write(1, 0, "With price and size", header_format)
+        ws.write(1, 1, len(ranked))
+        ws.write(2, 0, "Outliers (|z| >= %g)" % self.outlierZScore, header_format)
+        ws.write(2, 1, int(result['outlier'].sum()))
+        if len(ranked) > 0:
+            ws.write(3, 0, "Median Adj. Price", header_format)
+            ws.write(3, 1, numpy.median(result['adjusted_price'][ranked]), num_format)
+            ws.write(4, 0, "Median Adj. Price/sqft", header_format)
+            ws.write(4, 1, numpy.median(result['adjusted_value'][ranked]), num_format)
+
+        headers = ["Neighborhood", "Floorplans", "Outliers"]
+        for title in ["Adj. Price", "Price/sqft", "Adj. Price/sqft"]:
+            for percentile in SUMMARY_PERCENTILES:
+                headers.append("%s p%d" % (title, percentile))
+        for col, header in enumerate(headers):
+            ws.write(6, col, header, header_format)
+        for i, entry in enumerate(summary):
+            row = 7 + i
+            ws.write(row, 0, entry['neighborhood'])
+            ws.write(row, 1, entry['floorplans'])
+            ws.write(row, 2, entry['outliers'])
+            col = 3
+            for key in ['adjusted_price', 'value', 'adjusted_value']:
+                for value in entry[key]:
+                    ws.write(row, col, value, num_format)
+                    col += 1
+
+    def writeRanking(self, ws, result, header_format, num_format, link_format):
+        headers = [("Rank", 6.0), ("Name / Link", 35.0), ("Neighborhood", 15.0), ("Price", 11.0), ("Adj. Price", 11.0),
+                   ("Size (sqft)", 10.0), ("Price/sqft", 10.0), ("Adj. Price/sqft", 13.5), ("Bed", 5.0), ("Bath", 5.0),
+                   ("Neighborhood Percentile", 12.0), ("Z-Score", 8.0), ("Outlier", 8.0)]
+        for col, (header, width) in enumerate(headers):
+            ws.set_column(col, col, width)
+            ws.write(0, col, header, header_format)
+        for i, index in enumerate(result['ranking']):
+            if index not in self.names:
+                break #With constantMemory only the best values are listed
+            row = i + 1
+            ws.write(row, 0, i + 1)
+            name = self.names[index]
+            if "HYPERLINK" in name:
+                ws.write(row, 1, name, link_format)
+            else:
+                ws.write(row, 1, name)
+            ws.write(row, 2, self.neighborhoods[self.groups[index]])
+            ws.write(row, 3, result['price'][index], num_format)
+            ws.write(row, 4, result['adjusted_price'][index], num_format)
+            ws.write(row, 5, result['size'][index])
+            ws.write(row, 6, result['value'][index], num_format)
+            ws.write(row, 7, result['adjusted_value'][index], num_format)
+            for col, key in [(8, 'bed'), (9, 'bath')]:
+                if not numpy.isnan(result[key][index]):
+                    ws.write(row, col, result[key][index])
+            ws.write(row, 10, round(result['percentile'][index], 1))
+            ws.write(row, 11, round(result['zscore'][index], 2))
+            ws.write(row, 12, "Yes" if result['outlier'][index] else "No")
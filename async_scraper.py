@@ -0,0 +1,374 @@
+"""Scrapes apartments.com searches on an asyncio event loop.
+
+    async for row in scrape(urls, config):
+        print(row.getRecord())
+
+Downloads run on the event loop with aiohttp, so thousands of pages can be in flight on one thread. Pages are
+parsed in an executor (a thread, or parseWorkers processes) so parsing never blocks the loop. Rows come out in
+the same order as a run of scrape_apartments.py. Without aiohttp the pages are downloaded with PageFetcher
+on fetchWorkers threads instead. Choosing listings and finishing the apartments read from them is shared with
+scrape_apartments.py through scrape_engine.py.
+
+Checkpoints (--resume) and incremental mode are only supported by scrape_apartments.py. Both save their
+progress once every apartment of a search page is written, and here the pages of several search pages are in
+flight at once, so there is no point where a search page is finished before the next one starts.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+import parse_apartments as parsing
+from dedup import SeenSet
+from output_formatter import OutputRow, PropertyRow
+from page_cache import PageCache
+from page_fetcher import HEADERS, RETRY_STATUSES, PageFetcher, failedStatus, parseRetryAfter, retryDelay
+from parse_pipeline import parseMeasured
+from rate_limiter import RateLimiter
+from scrape_engine import ApartmentLocations, finishApartments, newListings, readListings, readPageCount, searchPageURL
+
+#aiohttp is optional, without it the downloads run on threads
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+class AsyncHostLimiter(object):
+    """Waits for a HostLimiter (see rate_limiter.py) on the event loop instead of blocking a thread."""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.changed = asyncio.Condition()
+
+    async def acquire(self):
+        waited = 0.0
+        async with self.changed:
+            while True:
+                now = time.monotonic()
+                with self.limiter.condition:
+                    delay = self.limiter.tryAcquire(now)
+                if delay == 0.0:
+                    break
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                waited += time.monotonic() - now
+        if waited > 0.0:
+            metrics.observe('limiter_wait_seconds', waited, self.limiter.host)
+        return now
+
+    async def release(self, started, status=None, error=None, retry_after=None):
+        self.limiter.release(started, status, error, retry_after)
+        with self.limiter.condition:
+            free = max(int(self.limiter.concurrency), 1) - self.limiter.inFlight
+        async with self.changed:
+            #Only wake as many waiting requests as may start, thousands can be waiting
+            self.changed.notify(max(free, 1))
+
+class AsyncPageFetcher(object):
+    """PageFetcher for the event loop: the same page cache, retries, rate limiting and metrics."""
+
+    def __init__(self, config):
+        self.config = config
+        self.timeout = config['requestTimeout']
+        self.maxRetries = config['maxRetries']
+        self.backoff = config['retryBackoff']
+        self.maxBackoff = config['retryBackoffMax']
+        self.offline = config['offline']
+        self.cache = None
+        if config['cacheDir']:
+            self.cache = PageCache(config['cacheDir'], config['cacheTTL'], config['cacheMaxSize'])
+        elif self.offline:
+            raise Exception("ERROR: Offline mode needs a cacheDir to read pages from, unable to run!")
+        self.limiter = RateLimiter(config, config['maxInFlight'])
+        self.hosts = {}
+        self.session = None
+        self.fetcher = None
+        self.threads = None
+
+    async def open(self):
+        if aiohttp is None:
+            logging.warning("aiohttp is not installed, pages are downloaded on %d threads instead (pip install aiohttp)" % self.config['fetchWorkers'])
+            self.fetcher = PageFetcher(self.config)
+            self.threads = ThreadPoolExecutor(max_workers=self.config['fetchWorkers'])
+            return
+        connector = aiohttp.TCPConnector(limit=self.config['maxInFlight'])
+        self.session = aiohttp.ClientSession(connector=connector, headers=HEADERS, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            for line in self.limiter.summary():
+                logging.info(line)
+        if self.fetcher is not None:
+            self.threads.shutdown(cancel_futures=True)
+            self.fetcher.close()
+
+    def hostLimiter(self, url):
+        limiter = self.limiter.host(url)
+        asyncLimiter = self.hosts.get(limiter.host)
+        if asyncLimiter is None:
+            asyncLimiter = AsyncHostLimiter(limiter)
+            self.hosts[limiter.host] = asyncLimiter
+        return asyncLimiter
+
+    async def fetch(self, url):
+        """Returns the raw page content of the given URL, see PageFetcher.fetch."""
+        loop = asyncio.get_running_loop()
+        if self.fetcher is not None:
+            return await loop.run_in_executor(self.threads, self.fetcher.fetch, url)
+        if self.cache is None:
+            return await self.download(url, None)
+
+        #The cache reads files, which would hold up every other request on the loop
+        entry = await loop.run_in_executor(None, self.cache.lookup, url)
+        if self.offline:
+            if entry is None:
+                metrics.increment('cache_lookups', label='miss')
+                logging.warning("Page is not in the cache, skipping it: %s" % url)
+                return None
+            metrics.increment('cache_lookups', label='hit')
+            return entry.content
+        if entry is None:
+            metrics.increment('cache_lookups', label='miss')
+        elif entry.isFresh(self.cache.ttl):
+            metrics.increment('cache_lookups', label='hit')
+            return entry.content
+        return await self.download(url, entry)
+
+    async def download(self, url, entry):
+        """Downloads the given URL, see PageFetcher.download."""
+        loop = asyncio.get_running_loop()
+        headers = None
+        if entry is not None:
+            headers = entry.validators()
+        limiter = self.hostLimiter(url)
+        attempt = 0
+        while True:
+            status = None
+            responseHeaders = None
+            content = None
+            error = None
+            started = await limiter.acquire()
+            try:
+                with metrics.timer('fetch_seconds'):
+                    async with self.session.get(url, headers=headers) as response:
+                        content = await response.read()
+                        status = response.status
+                        responseHeaders = response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                if status is not None:
+                    await limiter.release(started, status=status, retry_after=parseRetryAfter(responseHeaders.get('Retry-After')))
+                elif error is not None:
+                    await limiter.release(started, error=type(error).__name__)
+                else:
+                    await limiter.release(started)
+
+            if error is not None:
+                metrics.increment('fetch_errors', label=type(error).__name__)
+                if attempt >= self.maxRetries:
+                    logging.warning("Request failed (%s) after %d retries, skipping it: %s" % (type(error).__name__, attempt, url))
+                    return None
+                reason = type(error).__name__
+            else:
+                metrics.increment('http_responses', label=status)
+                metrics.increment('fetch_bytes', len(content))
+                if (status == 304) and (entry is not None):
+                    metrics.increment('cache_lookups', label='revalidated')
+                    await loop.run_in_executor(None, self.cache.revalidated, entry, responseHeaders)
+                    return entry.content
+                if status not in RETRY_STATUSES:
+                    if status >= 400:
+                        return failedStatus(status, attempt, url)
+                    if self.cache is not None:
+                        if entry is not None:
+                            metrics.increment('cache_lookups', label='changed')
+                        await loop.run_in_executor(None, self.cache.store, url, content, responseHeaders)
+                    return content
+                if attempt >= self.maxRetries:
+                    return failedStatus(status, attempt, url)
+                reason = "HTTP " + str(status)
+
+            delay = retryDelay(attempt, responseHeaders, self.backoff, self.maxBackoff)
+            attempt += 1
+            metrics.increment('fetch_retries')
+            logging.warning("Request failed (%s), retry %d of %d in %.1fs: %s" % (reason, attempt, self.maxRetries, delay, url))
+            await asyncio.sleep(delay)
+
+def readSearchPage(content, config=None):
+    """Returns the (name, url, address) listings of a search result page and its page count (None if unknown).
+    Only takes and returns picklable values so it can run in a worker process."""
+    soup = parsing.makeSoup(content, parsing.SEARCH_PAGE_SECTIONS)
+    container = soup.find('div', class_='placardContainer')
+    placards = []
+    if container is not None:
+        placards = container.find_all('article', class_='placard')
+    return readListings(placards), readPageCount(soup)
+
+def parseTimed(content, config, function, stage):
+    with metrics.timer('stage_seconds', stage):
+        return function(content, config)
+
+class RowList(list):
+    """Collects the rows parse_apartments.writeRows makes for one apartment."""
+
+    def getNewProperty(self):
+        return PropertyRow()
+
+    def getNewRow(self, property=None):
+        return OutputRow(property)
+
+    def writeRow(self, row):
+        self.append(row)
+
+class AsyncScraper(object):
+    """Walks the search pages and keeps up to maxInFlight apartment pages downloading or parsing at once."""
+
+    def __init__(self, config):
+        self.config = config
+        self.maxInFlight = config['maxInFlight']
+        self.fetcher = AsyncPageFetcher(config)
+        if config['parseWorkers'] > 0:
+            self.parsers = ProcessPoolExecutor(max_workers=config['parseWorkers'])
+        else:
+            self.parsers = ThreadPoolExecutor(max_workers=1)
+        self.locations = ApartmentLocations(config)
+
+    async def open(self):
+        await self.fetcher.open()
+
+    async def close(self):
+        await self.fetcher.close()
+        self.parsers.shutdown(cancel_futures=True)
+        self.locations.close()
+
+    async def parse(self, function, content, stage):
+        """Runs function(content, config) on the parsers, timed as the given stage."""
+        loop = asyncio.get_running_loop()
+        if not metrics.enabled():
+            return await loop.run_in_executor(self.parsers, function, content, self.config)
+        if isinstance(self.parsers, ProcessPoolExecutor):
+            result, snapshot = await loop.run_in_executor(self.parsers, parseMeasured, content, self.config, function, stage)
+            metrics.registry.merge(snapshot)
+            return result
+        return await loop.run_in_executor(self.parsers, parseTimed, content, self.config, function, stage)
+
+    async def readApartment(self, url):
+        content = await self.fetcher.fetch(url)
+        if content is None:
+            return None
+        return await self.parse(parsing.parseApartmentContent, content, 'parse')
+
+    async def searchPages(self, page_url, max_pages):
+        """Yields (page number, listings) for each page of search results, see walkSearchPages."""
+        page_num = 1
+        url = searchPageURL(page_url, page_num)
+        logging.info("Now getting apartments from page " + str(page_num) + ": %s" % url)
+        nextPage = asyncio.ensure_future(self.fetcher.fetch(url))
+        while nextPage is not None:
+            page = await nextPage
+            if page is None:
+                logging.warning("Search page " + str(page_num) + " couldn't be read, ending this search")
+                return
+
+            listings, pageCount = await self.parse(readSearchPage, page, 'search')
+            if not listings:
+                logging.info("No more apartments on page " + str(page_num))
+                return
+
+            isLast = ((pageCount is not None) and (page_num >= pageCount)) or ((max_pages > 0) and (page_num >= max_pages))
+            nextPage = None
+            if not isLast:
+                url = searchPageURL(page_url, page_num + 1)
+                logging.info("Now getting apartments from page " + str(page_num + 1) + ": %s" % url)
+                nextPage = asyncio.ensure_future(self.fetcher.fetch(url))
+
+            yield page_num, listings
+            page_num += 1
+
+    def takeDone(self, inFlight):
+        """Removes the finished apartments from the front of inFlight, returns their (name, url, apartment, content hash)."""
+        done = []
+        while inFlight and inFlight[0][2].done():
+            name, url, task = inFlight.popleft()
+            done.append((name, url, task.result(), None))
+        return done
+
+    def finished(self, done, seen, ignore_duplicates):
+        """The rows of the given finished apartments, see scrape_apartments.finishApartments. Returns (url, rows)."""
+        for name, url, apartment, status in finishApartments(done, seen, ignore_duplicates, None, self.locations):
+            rows = RowList()
+            parsing.writeRows(rows, url, apartment, status)
+            yield url, rows
+
+    async def rows(self, search_urls, max_pages, ignore_duplicates):
+        seen = SeenSet(self.config['seenFile'])
+        inFlight = collections.deque()
+        written = [] #URLs whose rows were handed over, only those are saved as seen
+        try:
+            for page_url in search_urls:
+                page_url = page_url.strip()
+                if not page_url.endswith('/'):
+                    page_url = page_url + '/'
+                async for page_num, listings in self.searchPages(page_url, max_pages):
+                    for name, url in newListings(listings, seen, ignore_duplicates, None):
+                        inFlight.append((name, url, asyncio.ensure_future(self.readApartment(url))))
+                        while len(inFlight) >= self.maxInFlight:
+                            await asyncio.wait([inFlight[0][2]])
+                            for url, rows in self.finished(self.takeDone(inFlight), seen, ignore_duplicates):
+                                for row in rows:
+                                    yield row
+                                written.append(url)
+
+                    #Hand over what is already done without waiting for the rest
+                    for url, rows in self.finished(self.takeDone(inFlight), seen, ignore_duplicates):
+                        for row in rows:
+                            yield row
+                        written.append(url)
+                    seen.commit(written)
+                    written = []
+
+            while inFlight:
+                await asyncio.wait([inFlight[0][2]])
+                for url, rows in self.finished(self.takeDone(inFlight), seen, ignore_duplicates):
+                    for row in rows:
+                        yield row
+                    written.append(url)
+            seen.commit(written)
+        finally:
+            for name, url, task in inFlight:
+                task.cancel()
+            seen.close()
+
+async def scrape(search_urls, config, max_pages=0, ignore_duplicates=True):
+    """Yields an OutputRow for each floorplan of every apartment found by the given apartments.com searches,
+    in search page order. config is the dict returned by scrape_apartments.readConfig. max_pages is the most
+    result pages read per search, 0 for all of them."""
+    scraper = AsyncScraper(config)
+    await scraper.open()
+    try:
+        async for row in scraper.rows(search_urls, max_pages, ignore_duplicates):
+            yield row
+    finally:
+        await scraper.close()
+
+async def scrapeInto(out, search_urls, max_pages, ignore_duplicates, config):
+    """Writes every row of scrape() to the given output. Writing a row is quick, so it happens on the loop."""
+    lastProperty = None
+    async for row in scrape(search_urls, config, max_pages, ignore_duplicates):
+        with metrics.timer('stage_seconds', 'write'):
+            out.writeRow(row)
+        metrics.increment('rows_written')
+        if row.property is not lastProperty:
+            lastProperty = row.property
+            metrics.increment('apartments_written')
+
+def scrapeApartmentsAsync(out, search_urls, max_pages, ignore_duplicates, config):
+    """Runs scrape() on a new event loop, writing its rows to the given output like scrapeApartments does."""
+    asyncio.run(scrapeInto(out, search_urls, max_pages, ignore_duplicates, config))
@@ -0,0 +1,75 @@
+"""Measures the time OutputFile.writeRow spends per row, the time of close() and the size of the finished
+file for each formulaStyle.
+
+Rows are written with the price adjustment columns turned on, since those hold the longest formulas.
+The rows are built before timing so only the formatting is measured. With the table style the formula
+columns are filled in by close() instead of writeRow.
+
+Usage: python benchmarks/bench_output_formulas.py [row count]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import parse_apartments as parsing
+from output_formatter import OutputFile, FORMULA_STYLES
+
+from bench_output_memory import makeConfig, makeApartment
+
+DEFAULT_ROW_COUNT = 20000
+
+class RowCollector(object):
+    """Stands in for an output file to keep the rows made by writeApartment."""
+
+    def __init__(self, out):
+        self.out = out
+        self.rows = []
+
+    def getNewProperty(self):
+        return self.out.getNewProperty()
+
+    def getNewRow(self, property=None):
+        return self.out.getNewRow(property)
+
+    def writeRow(self, row):
+        self.rows.append(row)
+
+def measure(rows, formulaStyle):
+    """Returns the microseconds per row of writeRow, the seconds of close() and the file size in kilobytes."""
+    config = makeConfig(False)
+    config['formulaStyle'] = formulaStyle
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench')
+    out = OutputFile(path, config)
+
+    collector = RowCollector(out)
+    for i in range(rows):
+        parsing.writeApartment(collector, "https://www.apartments.com/synthetic/" + str(i) + "/", makeApartment(i))
+
+    start = time.perf_counter()
+    for row in collector.rows:
+        out.writeRow(row)
+    written = time.perf_counter()
+    out.close()
+    closed = time.perf_counter()
+
+    size = os.path.getsize(path + '.xlsx')
+    os.remove(path + '.xlsx')
+    os.rmdir(directory)
+    return (written - start) * 1000000.0 / rows, closed - written, size / 1024.0
+
+def main(args):
+    rows = DEFAULT_ROW_COUNT
+    if args:
+        rows = int(args[0])
+    print("%10s %14s %12s %12s" % ("style", "us per row", "close (s)", "size (KB)"))
+    for formulaStyle in FORMULA_STYLES:
+        perRow, close, size = measure(rows, formulaStyle)
+        print("%10s %14.1f %12.2f %12.1f" % (formulaStyle, perRow, close, size))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
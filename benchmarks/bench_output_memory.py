@@ -0,0 +1,83 @@
+"""Measures the peak memory used by OutputFile while writing a growing number of rows.
+
+Each measurement runs in its own process so the peak resident set size (RSS) only covers that run.
+With constantMemory enabled the peak should stay flat as the row count grows.
+
+Usage: python benchmarks/bench_output_memory.py [row counts...]
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import parse_apartments as parsing
+from output_formatter import OutputFile
+
+DEFAULT_ROW_COUNTS = [1000, 10000, 50000]
+
+def makeConfig(constantMemory):
+    config = {
+        'separateUtilities': False,
+        'separatePets': False,
+        'separateParking': False,
+        'priceSelector': 'average',
+        'priceAdjustment': True,
+        'constantMemory': constantMemory,
+        'adjustPrice': {}
+    }
+    for util in OutputFile.values['utilities']:
+        config['adjustPrice'][util] = 25
+    return config
+
+def makeApartment(i):
+    """A synthetic apartment with a realistic amount of text and one floorplan."""
+    return {
+        'name': "Synthetic Apartments " + str(i),
+        'address': str(i) + " Main St, Springfield, IL, 62701",
+        'neighborhood': "Downtown",
+        'utilities': ["Water", "Trash", "Sewage"],
+        'parking': ["Lot", "Garage"],
+        'pets': ["Cats", "Dogs"],
+        'monthly': ["Storage Fee", "Dog Rent"],
+        'fees': ["Application Fee", "Admin Fee"],
+        'recreation': [],
+        'features': [],
+        'outdoors': [],
+        'floorplans': [{'name': "Plan A", 'price': str(1000 + i % 500), 'size': str(600 + i % 700), 'bed': '1', 'bath': '1'}]
+    }
+
+def peakRSS():
+    """Peak resident set size of this process in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0) #bytes on macOS
+    return peak / 1024.0 #kilobytes on Linux
+
+def child(rows, constantMemory):
+    directory = tempfile.mkdtemp()
+    out = OutputFile(os.path.join(directory, 'bench'), makeConfig(constantMemory))
+    for i in range(rows):
+        parsing.writeApartment(out, "https://www.apartments.com/synthetic/" + str(i) + "/", makeApartment(i))
+    out.close()
+    print("%.1f" % peakRSS())
+
+def measure(rows, constantMemory):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', str(rows), str(int(constantMemory))])
+    return float(output.decode().strip().splitlines()[-1])
+
+def main(args):
+    if args and args[0] == '--child':
+        child(int(args[1]), args[2] == '1')
+        return
+
+    rowCounts = [int(arg) for arg in args] or DEFAULT_ROW_COUNTS
+    print("%10s %16s %16s" % ("rows", "default (MB)", "constant (MB)"))
+    for rows in rowCounts:
+        print("%10d %16.1f %16.1f" % (rows, measure(rows, False), measure(rows, True)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,275 @@
+"""Regression checks for parse_apartments against a corpus of stored apartment pages.
+
+Every page is read two ways: the original way, calling each scrape* function of the frozen copy of the original
+parser (baseline_parser.py) on the full page, and the current one (parse_apartments.parseApartmentContent), which
+only builds the sections of the page it needs and reads every field in a single walk. The current record is
+compared field by field with the golden record saved for the page and with the original one, and both ways are
+timed on every page. A change to the parser can then be checked for correctness and speed before it is used, and
+every way the current parser reads a page differently from the original one is listed.
+
+The corpus is the apartment pages of benchmarks/fixtures plus the pages saved in benchmarks/corpus (.html or
+.html.gz), which is where pages that broke the parser go. Their golden records are in benchmarks/corpus/golden.json.
+Records are read with the options of config_example.ini.
+
+Exits with status 1 when a page doesn't match its golden record or the current parser can't read it. Differences
+from the original parser are only listed, since fixes to the parser are supposed to make some.
+
+Usage:
+  python benchmarks/parser_regression.py [--repeat 5] [--verbose]
+  python benchmarks/parser_regression.py --add saved-page.html    (copy a page into the corpus and save its record)
+  python benchmarks/parser_regression.py --update [PAGE ...]      (save the current records as the golden ones)
+"""
+
+import argparse
+import configparser
+import gzip
+import json
+import os
+import shutil
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from bs4 import BeautifulSoup
+
+import baseline_parser as baseline
+import parse_apartments as parsing
+from scrape_apartments import readConfig
+
+from replay_server import FIXTURES_DIR, Fixtures
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+GOLDEN_FILE = os.path.join(CORPUS_DIR, 'golden.json')
+
+#The function the original parser used for each field of parse_apartments.APARTMENT_FIELDS, the coordinates weren't read by it
+LEGACY_FUNCTIONS = {
+    'name': baseline.scrapeApartmentName,
+    'address': baseline.scrapeAddress,
+    'neighborhood': baseline.scrapeNeighborhood,
+    'latitude': parsing.scrapeLatitude,
+    'longitude': parsing.scrapeLongitude,
+    'utilities': baseline.scrapeUtilities,
+    'parking': baseline.scrapeParking,
+    'pets': baseline.scrapePets,
+    'monthly': baseline.scrapeMonthlyFees,
+    'fees': baseline.scrapeFees,
+    'recreation': baseline.scrapeRecreation,
+    'features': baseline.scrapeFeatures,
+    'outdoors': baseline.scrapeOutdoors
+}
+
+def regressionConfig():
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(ROOT, 'config_example.ini'))
+    return readConfig(conf)
+
+def legacyExtractApartment(content, config):
+    """Reads an apartment page the original way: the whole page is parsed and each field is searched for on its own."""
+    soup = BeautifulSoup(content, parsing.HTML_PARSER)
+    apartment = {}
+    for field, section, findAll, normalizer in parsing.APARTMENT_FIELDS:
+        if field in LEGACY_FUNCTIONS:
+            apartment[field] = LEGACY_FUNCTIONS[field](soup)
+    floorplans = []
+    names = set()
+    for floorplan in baseline.scrapeFloorplanSoups(soup):
+        name = baseline.scrapeFloorplanName(floorplan)
+        if name in names:
+            continue
+        names.add(name)
+        floorplans.append({
+            'name': name,
+            'price': baseline.scrapePrice(floorplan, config),
+            'size': baseline.scrapeSize(floorplan),
+            'bed': baseline.scrapeBed(floorplan),
+            'bath': baseline.scrapeBath(floorplan)
+        })
+    apartment['floorplans'] = floorplans
+    return apartment
+
+def currentExtractApartment(content, config):
+    return parsing.parseApartmentContent(content, config)
+
+def loadCorpus():
+    """Returns (page name, content) for every page of the corpus, sorted by name."""
+    pages = []
+    fixtures = Fixtures(FIXTURES_DIR)
+    for path in fixtures.paths('apartment'):
+        pages.append(("fixtures" + path, fixtures.content(path)))
+    if os.path.isdir(CORPUS_DIR):
+        for filename in os.listdir(CORPUS_DIR):
+            path = os.path.join(CORPUS_DIR, filename)
+            if filename.endswith('.html.gz'):
+                with gzip.open(path, 'rb') as f:
+                    pages.append(("corpus/" + filename, f.read()))
+            elif filename.endswith('.html'):
+                with open(path, 'rb') as f:
+                    pages.append(("corpus/" + filename, f.read()))
+    return sorted(pages)
+
+def loadGolden():
+    if not os.path.isfile(GOLDEN_FILE):
+        return {}
+    with open(GOLDEN_FILE, 'r') as f:
+        return json.load(f)
+
+def saveGolden(golden):
+    with open(GOLDEN_FILE, 'w') as f:
+        json.dump(golden, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+def plainRecord(apartment):
+    """The record as it would be saved in JSON, so records read now compare equal to saved ones."""
+    return json.loads(json.dumps(apartment))
+
+def readTimed(function, content, config, repeat):
+    """Returns (record, fastest time in ms), the record is an "ERROR: ..." string if reading the page failed."""
+    fastest = None
+    record = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        try:
+            record = plainRecord(function(content, config))
+        except Exception as e:
+            return "ERROR: %s: %s" % (type(e).__name__, e), None
+        elapsed = (time.perf_counter() - start) * 1000.0
+        if (fastest is None) or (elapsed < fastest):
+            fastest = elapsed
+    return record, fastest
+
+def fieldDifferences(expected, actual):
+    """Returns (field, expected value, actual value) for every field that differs, floorplans are compared one by one."""
+    if isinstance(expected, str) or isinstance(actual, str):
+        if expected == actual:
+            return []
+        return [('*', expected, actual)]
+    differences = []
+    for field in sorted(set(expected) | set(actual)):
+        if field == 'floorplans':
+            continue
+        if expected.get(field) != actual.get(field):
+            differences.append((field, expected.get(field), actual.get(field)))
+    expectedPlans = expected.get('floorplans', [])
+    actualPlans = actual.get('floorplans', [])
+    if len(expectedPlans) != len(actualPlans):
+        differences.append(('floorplans', "%d floorplans" % len(expectedPlans), "%d floorplans" % len(actualPlans)))
+    for i, (expectedPlan, actualPlan) in enumerate(zip(expectedPlans, actualPlans)):
+        for key in sorted(set(expectedPlan) | set(actualPlan)):
+            if expectedPlan.get(key) != actualPlan.get(key):
+                differences.append(("floorplans[%d].%s" % (i, key), expectedPlan.get(key), actualPlan.get(key)))
+    return differences
+
+def fieldName(field):
+    """floorplans[3].price -> floorplans.price, so differences are counted per field."""
+    if field.startswith('floorplans['):
+        return 'floorplans.' + field.split('.', 1)[1]
+    return field
+
+def check(pages, golden, config, repeat, verbose):
+    """Compares every page with its golden record and the original way of reading it. Returns the number of failed pages,
+    a page only fails on its golden record."""
+    print("%-50s %11s %11s  %s" % ("page", "legacy (ms)", "current (ms)", "result"))
+    failed = 0
+    counts = {} #(kind, field) -> pages where it differs
+    totals = [0.0, 0.0]
+    for name, content in pages:
+        legacy, legacyTime = readTimed(legacyExtractApartment, content, config, repeat)
+        current, currentTime = readTimed(currentExtractApartment, content, config, repeat)
+        problems = []
+        if name not in golden:
+            problems.append(('no golden record', [('*', None, "run with --update " + name)]))
+        else:
+            problems.append(('current != golden', fieldDifferences(golden[name], current)))
+        problems.append(('legacy != current', fieldDifferences(current, legacy)))
+        problems = [(kind, differences) for kind, differences in problems if differences]
+
+        result = "ok"
+        if problems:
+            result = ", ".join("%s (%d)" % (kind, len(differences)) for kind, differences in problems)
+            if any(kind != 'legacy != current' for kind, differences in problems):
+                failed += 1
+            else:
+                result = "ok, " + result
+        if legacyTime is not None:
+            totals[0] += legacyTime
+        if currentTime is not None:
+            totals[1] += currentTime
+        print("%-50s %11s %11s  %s" % (name[-50:], formatTime(legacyTime), formatTime(currentTime), result))
+        for kind, differences in problems:
+            for field in set(fieldName(field) for field, expected, actual in differences):
+                counts[(kind, field)] = counts.get((kind, field), 0) + 1
+            if verbose or (kind != 'legacy != current'):
+                for field, expected, actual in differences:
+                    print("    %s %s: %r -> %r" % (kind, field, expected, actual))
+
+    print("")
+    if counts:
+        print("Fields that differ (pages):")
+        for (kind, field), count in sorted(counts.items()):
+            print("  %-20s %-25s %d" % (kind, field, count))
+    speedup = ""
+    if totals[1] > 0:
+        speedup = " (%.1fx)" % (totals[0] / totals[1])
+    print("%d pages, %d failed. Total: legacy %.1f ms, current %.1f ms%s" % (len(pages), failed, totals[0], totals[1], speedup))
+    return failed
+
+def formatTime(ms):
+    if ms is None:
+        return "error"
+    return "%.2f" % ms
+
+def update(pages, golden, config, names):
+    """Saves the records the current parser reads as the golden ones, for the given pages or all of them."""
+    for name, content in pages:
+        if names and (name not in names):
+            continue
+        record, elapsed = readTimed(currentExtractApartment, content, config, 1)
+        if isinstance(record, str):
+            print("%s: %s, not saved" % (name, record))
+            continue
+        if golden.get(name) != record:
+            print("Golden record saved for " + name)
+            golden[name] = record
+    saveGolden(golden)
+
+def addPages(paths, golden, config):
+    """Copies saved pages into the corpus and saves what the current parser reads from them as their golden records."""
+    names = []
+    for path in paths:
+        filename = os.path.basename(path)
+        if not (filename.endswith('.html') or filename.endswith('.html.gz')):
+            raise Exception("ERROR: Only .html and .html.gz pages can be added to the corpus: " + path)
+        shutil.copyfile(path, os.path.join(CORPUS_DIR, filename))
+        names.append("corpus/" + filename)
+    pages = loadCorpus()
+    update(pages, golden, config, names)
+    for name, content in pages:
+        if name in names:
+            print(name)
+            print(json.dumps(golden.get(name), indent=1))
+    print("Check that the records above are right before committing them")
+
+def main():
+    parser = argparse.ArgumentParser(description="Check parse_apartments against the stored apartment pages.")
+    parser.add_argument('--repeat', type=int, default=5, help="times every page is read by each parser, the fastest is shown")
+    parser.add_argument('--verbose', action='store_true', help="also list every field where the two parsers disagree")
+    parser.add_argument('--update', nargs='*', metavar='PAGE', help="save the current records as the golden ones (only for the given pages if any)")
+    parser.add_argument('--add', nargs='+', metavar='HTML', help="copy saved apartment pages into the corpus")
+    args = parser.parse_args()
+
+    config = regressionConfig()
+    golden = loadGolden()
+    if args.add:
+        addPages(args.add, golden, config)
+        return
+    pages = loadCorpus()
+    if args.update is not None:
+        update(pages, golden, config, args.update)
+        return
+    if check(pages, golden, config, max(args.repeat, 1), args.verbose) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Records the pages of a real apartments.com search into a fixtures folder that replay_server.py can serve.
+
+The search pages and the apartment pages they list are downloaded with the scraper's own PageFetcher and saved
+gzipped with a manifest.json. The download options (workers, timeouts, retries) come from config.ini.
+
+Usage: python benchmarks/record_fixtures.py <search url> [--pages 2] [--output folder]
+"""
+
+import argparse
+import configparser
+import gzip
+import json
+import os
+import sys
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import parse_apartments as parsing
+from page_fetcher import PageFetcher
+from scrape_apartments import readConfig
+from scrape_engine import searchPageURL, readPageCount
+
+from replay_server import FIXTURES_DIR
+
+def loadConfig():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    conf = configparser.ConfigParser()
+    if not conf.read(os.path.join(root, 'config.ini')):
+        conf.read(os.path.join(root, 'config_example.ini'))
+    config = readConfig(conf)
+    config['cacheDir'] = '' #Record what the website sends now
+    config['offline'] = False
+    return config
+
+def savePage(directory, name, content):
+    with open(os.path.join(directory, name), 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as page:
+            page.write(content)
+
+def record(search_url, max_pages, directory):
+    if not search_url.endswith('/'):
+        search_url += '/'
+    parts = urlsplit(search_url)
+    site = parts.scheme + "://" + parts.netloc
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    fetcher = PageFetcher(loadConfig())
+    pages = {}
+    apartmentURLs = []
+    try:
+        for page_num in range(1, max_pages + 1):
+            url = searchPageURL(search_url, page_num)
+            content = fetcher.fetch(url)
+            if content is None:
+                break
+            soup = parsing.makeSoup(content, parsing.SEARCH_PAGE_SECTIONS)
+            container = soup.find('div', class_='placardContainer')
+            placards = []
+            if container is not None:
+                placards = container.find_all('article', class_='placard')
+            if not placards:
+                break
+            name = "search-%d.html.gz" % page_num
+            savePage(directory, name, content)
+            pages[urlsplit(url).path] = {'kind': 'search', 'file': name}
+            for placard in placards:
+                data_url = placard.get('data-url')
+                if (data_url is not None) and (data_url not in apartmentURLs):
+                    apartmentURLs.append(data_url)
+            print("Recorded search page %d with %d apartments" % (page_num, len(placards)))
+            pageCount = readPageCount(soup)
+            if (pageCount is not None) and (page_num >= pageCount):
+                break
+
+        for i, (url, content) in enumerate(zip(apartmentURLs, fetcher.fetchAll(apartmentURLs))):
+            if content is None:
+                continue
+            name = "apartment-%d.html.gz" % i
+            savePage(directory, name, content)
+            pages[urlsplit(url).path] = {'kind': 'apartment', 'file': name}
+        print("Recorded %d apartment pages" % len(apartmentURLs))
+    finally:
+        fetcher.close()
+
+    manifest = {'site': site, 'searches': [search_url], 'pages': pages}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Record an apartments.com search for the benchmarks.")
+    parser.add_argument('url', help="the apartments.com search URL")
+    parser.add_argument('--pages', type=int, default=2, help="the number of search result pages to record")
+    parser.add_argument('--output', default=FIXTURES_DIR, help="the fixtures folder to write")
+    args = parser.parse_args()
+    record(args.url, args.pages, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""A local HTTP server that replays recorded apartments.com pages, so the scraper can be measured without the real website.
+
+The pages come from a fixtures folder holding manifest.json and one gzipped HTML file per page (see record_fixtures.py
+and synthetic_fixtures.py). Links to the recorded site inside the pages are pointed at this server. Every response
+can be delayed (latency plus random jitter) and a share of them can fail with "503 Service Unavailable" to exercise retries.
+
+Usage: python benchmarks/replay_server.py [--port 8080] [--latency 0.05] [--jitter 0.02] [--error-rate 0.01]
+Then use the printed search URL as apartmentsURL in config.ini.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import threading
+import time
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+class Fixtures(object):
+    """The recorded pages, keyed by URL path."""
+
+    def __init__(self, directory=FIXTURES_DIR):
+        with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        self.site = manifest['site']
+        self.searches = manifest['searches']
+        self.pages = {}
+        self.kinds = {}
+        for path, page in manifest['pages'].items():
+            with gzip.open(os.path.join(directory, page['file']), 'rb') as f:
+                self.pages[path] = f.read()
+            self.kinds[path] = page['kind']
+
+    def paths(self, kind):
+        return [path for path in self.pages if self.kinds[path] == kind]
+
+    def content(self, path):
+        return self.pages[path]
+
+class ReplayServer(object):
+    """Serves the fixtures on 127.0.0.1 from a background thread. Keeps count of the responses sent."""
+
+    def __init__(self, fixtures, port=0, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.served = 0
+        self.errors = 0
+        self.missing = 0
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self.handlerClass())
+        self.httpd.daemon_threads = True
+        self.base = "http://%s:%d" % self.httpd.server_address
+
+        #The pages are rewritten once so serving them is only a copy
+        site = fixtures.site.encode('utf-8')
+        self.bodies = {}
+        for path, content in fixtures.pages.items():
+            self.bodies[path] = content.replace(site, self.base.encode('utf-8'))
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def searchURLs(self):
+        return [url.replace(self.fixtures.site, self.base) for url in self.fixtures.searches]
+
+    def counts(self):
+        with self.lock:
+            return {'served': self.served, 'errors': self.errors, 'missing': self.missing}
+
+    def respond(self, handler):
+        with self.lock:
+            delay = self.latency
+            if self.jitter > 0:
+                delay += self.random.uniform(0, self.jitter)
+            fail = (self.errorRate > 0) and (self.random.random() < self.errorRate)
+        if delay > 0:
+            time.sleep(delay)
+
+        path = handler.path.split('?')[0]
+        if fail:
+            self.send(handler, 503, b"")
+            with self.lock:
+                self.errors += 1
+            return
+        body = self.bodies.get(path)
+        if body is None:
+            #Past the last recorded search page, apartments.com shows a page without apartments
+            self.send(handler, 404, b"")
+            with self.lock:
+                self.missing += 1
+            return
+        self.send(handler, 200, body)
+        with self.lock:
+            self.served += 1
+
+    def send(self, handler, status, body):
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'text/html; charset=utf-8')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handlerClass(self):
+        server = self
+
+        class ReplayHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' #Keep-alive, like the real website
+
+            def do_GET(self):
+                server.respond(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        return ReplayHandler
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded apartments.com pages from a local server.")
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help="folder with manifest.json and the recorded pages")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many more seconds, picked at random")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of responses that fail with 503 (0 to 1)")
+    args = parser.parse_args()
+
+    server = ReplayServer(Fixtures(args.fixtures), args.port, args.latency, args.jitter, args.error_rate)
+    print("Serving %d pages on %s" % (len(server.bodies), server.base))
+    for url in server.searchURLs():
+        print("Search URL: " + url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""Benchmark suite for the scraper, run against the recorded pages in benchmarks/fixtures instead of apartments.com.
+
+Benchmarks:
+  scrapeSearchPage    a full scrape of every recorded search through replay_server.py (downloads, parsing, output)
+  parseApartmentPage  reading every recorded apartment page into an OutputFile, no downloads
+  writeRow            OutputFile.writeRow on rows built from the recorded apartments
+
+Each benchmark runs in its own process so its peak memory (RSS) only covers that benchmark. The results are printed
+and saved as JSON in benchmarks/results, named after the date and the current git commit, so runs of different
+commits can be compared with --compare.
+
+With --profile each benchmark is also profiled (see profiling.py), e.x. --only parseApartmentPage --profile parse
+profiles the parser on the recorded pages without any downloads. The profiles are saved in benchmarks/results,
+named after the benchmark and the stage.
+
+Usage:
+  python benchmarks/run_benchmarks.py [--latency 0.02] [--error-rate 0.02] [--only writeRow] [--output results.json]
+  python benchmarks/run_benchmarks.py --only parseApartmentPage --profile parse
+  python benchmarks/run_benchmarks.py --compare old.json [new.json]
+"""
+
+import argparse
+import configparser
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import parse_apartments as parsing
+import profiling
+from dedup import SeenSet
+from output_formatter import OutputFile
+from scrape_apartments import ScrapeRun, readConfig, scrapeSearchPage
+
+from bench_output_memory import peakRSS
+from bench_output_formulas import RowCollector
+from replay_server import FIXTURES_DIR, Fixtures, ReplayServer
+
+BENCHMARKS = ['scrapeSearchPage', 'parseApartmentPage', 'writeRow']
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+#Metrics where a lower number is better, every other metric is better when higher
+LOWER_IS_BETTER = ['parseMsPerPage', 'usPerRow', 'seconds', 'closeSeconds', 'peakMemoryMB']
+
+def benchmarkConfig(settings):
+    """The scraper options of config_example.ini, changed so runs only depend on the benchmark settings."""
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(ROOT, 'config_example.ini'))
+    config = readConfig(conf)
+    config['fetchWorkers'] = settings['fetchWorkers']
+    config['connectionPoolSize'] = max(config['connectionPoolSize'], settings['fetchWorkers'] + 1)
+    config['parseWorkers'] = 0
+    config['cacheDir'] = ''
+    config['offline'] = False
+    config['incremental'] = False
+    config['seenFile'] = ''
+    config['retryBackoff'] = 0.01 #Failed requests are part of the benchmark, long waits after them aren't
+    config['retryBackoffMax'] = 0.1
+    config['maxRetries'] = 10
+    return config
+
+class CountingOutput(object):
+    """Passes rows on to an output while counting them."""
+
+    def __init__(self, out):
+        self.out = out
+        self.rows = 0
+
+    def getNewProperty(self):
+        return self.out.getNewProperty()
+
+    def getNewRow(self, property=None):
+        return self.out.getNewRow(property)
+
+    def writeRow(self, row):
+        self.rows += 1
+        self.out.writeRow(row)
+
+    def close(self):
+        self.out.close()
+
+def benchScrapeSearchPage(settings, config, directory):
+    out = CountingOutput(OutputFile(os.path.join(directory, 'bench'), config))
+    seen = SeenSet()
+    start = time.perf_counter()
+    run = ScrapeRun(out, config, None)
+    try:
+        for url in settings['searchURLs']:
+            scrapeSearchPage(run, url, 1, 0, True, seen, config)
+    finally:
+        run.close()
+        out.close()
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'rows': out.rows,
+        'rowsPerSec': out.rows / seconds
+    }
+
+def benchParseApartmentPage(settings, config, directory):
+    fixtures = Fixtures(settings['fixtures'])
+    pages = [(fixtures.site + path, fixtures.content(path)) for path in fixtures.paths('apartment')]
+    out = CountingOutput(OutputFile(os.path.join(directory, 'bench'), config))
+    start = time.perf_counter()
+    for i in range(settings['repeat']):
+        for url, content in pages:
+            with profiling.scope('parse'):
+                soup = parsing.makeSoup(content, parsing.APARTMENT_PAGE_SECTIONS)
+            parsing.parseApartmentPage(soup, out, url, config)
+    seconds = time.perf_counter() - start
+    out.close()
+    count = len(pages) * settings['repeat']
+    return {
+        'seconds': seconds,
+        'pages': count,
+        'pagesPerSec': count / seconds,
+        'parseMsPerPage': seconds * 1000.0 / count,
+        'rows': out.rows,
+        'rowsPerSec': out.rows / seconds
+    }
+
+def benchWriteRow(settings, config, directory):
+    fixtures = Fixtures(settings['fixtures'])
+    apartments = []
+    for path in fixtures.paths('apartment'):
+        soup = parsing.makeSoup(fixtures.content(path), parsing.APARTMENT_PAGE_SECTIONS)
+        apartments.append((fixtures.site + path, parsing.extractApartment(soup, config)))
+
+    out = OutputFile(os.path.join(directory, 'bench'), config)
+    collector = RowCollector(out)
+    while len(collector.rows) < settings['rows']:
+        url, apartment = apartments[len(collector.rows) % len(apartments)]
+        parsing.writeApartment(collector, url, apartment)
+    rows = collector.rows[:settings['rows']]
+
+    start = time.perf_counter()
+    with profiling.scope('write'):
+        for row in rows:
+            out.writeRow(row)
+    written = time.perf_counter()
+    out.close()
+    closed = time.perf_counter()
+    return {
+        'rows': len(rows),
+        'rowsPerSec': len(rows) / (written - start),
+        'usPerRow': (written - start) * 1000000.0 / len(rows),
+        'closeSeconds': closed - written
+    }
+
+BENCHMARK_FUNCTIONS = {
+    'scrapeSearchPage': benchScrapeSearchPage,
+    'parseApartmentPage': benchParseApartmentPage,
+    'writeRow': benchWriteRow
+}
+
+def child(name, settings):
+    logging.basicConfig(level=logging.ERROR)
+    config = benchmarkConfig(settings)
+    directory = tempfile.mkdtemp()
+    profile = settings.get('profile')
+    if profile is not None:
+        profiling.start(profile)
+    try:
+        with profiling.scope('all'):
+            result = BENCHMARK_FUNCTIONS[name](settings, config, directory)
+    finally:
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
+    result['peakMemoryMB'] = peakRSS()
+    if profile is not None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        for path in profiling.stop().save(os.path.join(RESULTS_DIR, name)):
+            sys.stderr.write("Profile saved to %s\n" % path)
+    print(json.dumps(result))
+
+def runChild(name, settings):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', name, json.dumps(settings)])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def gitCommit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL)
+        commit = output.decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT)
+        if status.strip():
+            commit += "-dirty"
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runBenchmarks(args):
+    settings = {
+        'fixtures': os.path.abspath(args.fixtures),
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'errorRate': args.error_rate,
+        'fetchWorkers': args.fetch_workers,
+        'repeat': args.repeat,
+        'rows': args.rows
+    }
+    if args.profile is not None:
+        settings['profile'] = args.profile #Profiling slows the benchmarks down, so it is part of the settings compared
+    results = {}
+    for name in (args.only or BENCHMARKS):
+        if name == 'scrapeSearchPage':
+            server = ReplayServer(Fixtures(settings['fixtures']), 0, args.latency, args.jitter, args.error_rate)
+            try:
+                childSettings = dict(settings)
+                childSettings['searchURLs'] = server.searchURLs()
+                result = runChild(name, childSettings)
+                counts = server.counts()
+            finally:
+                server.close()
+            result['pages'] = counts['served']
+            result['pagesPerSec'] = counts['served'] / result['seconds']
+            result['failedRequests'] = counts['errors']
+        else:
+            result = runChild(name, settings)
+        results[name] = result
+        printResult(name, result)
+
+    return {
+        'commit': gitCommit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': settings,
+        'results': results
+    }
+
+def printResult(name, result):
+    print(name)
+    for metric in sorted(result):
+        print("  %-16s %12.3f" % (metric, result[metric]))
+
+def saveResults(report, path):
+    if path is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        stamp = report['date'].replace(':', '').replace('-', '')
+        path = os.path.join(RESULTS_DIR, stamp + "-" + (report['commit'] or "unknown") + ".json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print("Results saved to " + path)
+
+def compare(old, new):
+    """Prints every metric of two result files side by side with the change in percent."""
+    print("%s (%s) -> %s (%s)" % (old['commit'], old['date'], new['commit'], new['date']))
+    if old['settings'] != new['settings']:
+        print("Warning: the benchmark settings differ, the numbers may not be comparable")
+    for name in BENCHMARKS:
+        if (name not in old['results']) or (name not in new['results']):
+            continue
+        print(name)
+        for metric in sorted(new['results'][name]):
+            if metric not in old['results'][name]:
+                continue
+            before = old['results'][name][metric]
+            after = new['results'][name][metric]
+            change = ""
+            if before:
+                percent = (after - before) * 100.0 / before
+                better = (percent < 0) if metric in LOWER_IS_BETTER else (percent > 0)
+                change = "%+7.1f%%" % percent
+                if abs(percent) >= 5:
+                    change += " better" if better else " worse"
+            print("  %-16s %12.3f %12.3f  %s" % (metric, before, after, change))
+
+def loadResults(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def main():
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--child'):
+        child(sys.argv[2], json.loads(sys.argv[3]))
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the scraper against recorded pages.")
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help="folder with the recorded pages")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds the replay server waits before each response")
+    parser.add_argument('--jitter', type=float, default=0.01, help="up to this many more seconds, picked at random")
+    parser.add_argument('--error-rate', type=float, default=0.02, help="share of requests that fail with 503 (0 to 1)")
+    parser.add_argument('--fetch-workers', type=int, default=4, help="fetchWorkers used by the scrape")
+    parser.add_argument('--repeat', type=int, default=5, help="times every apartment page is parsed by parseApartmentPage")
+    parser.add_argument('--rows', type=int, default=20000, help="rows written by writeRow")
+    parser.add_argument('--only', action='append', choices=BENCHMARKS, help="only run this benchmark (can be repeated)")
+    parser.add_argument('--profile', choices=profiling.PROFILE_STAGES, help="also profile this stage of each benchmark")
+    parser.add_argument('--output', help="where to save the results, by default a new file in benchmarks/results")
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS', help="compare a results file with another one, or with a new run")
+    args = parser.parse_args()
+
+    if args.compare and (len(args.compare) > 1):
+        compare(loadResults(args.compare[0]), loadResults(args.compare[1]))
+        return
+
+    report = runBenchmarks(args)
+    saveResults(report, args.output)
+    if args.compare:
+        compare(loadResults(args.compare[0]), report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Writes a corpus of synthetic pages shaped like apartments.com search and apartment pages to benchmarks/fixtures.
+
+These are the pages shipped with the benchmarks so they can run without recording the real website first. They are
+generated from a fixed seed, so running this again gives the same files. Besides the parts the scraper reads they
+carry the navigation, scripts and long lists of unrelated content that make up most of a real page.
+Use record_fixtures.py instead to benchmark against real recorded pages.
+
+Usage: python benchmarks/synthetic_fixtures.py [output folder]
+"""
+
+import gzip
+import json
+import os
+import random
+import sys
+
+SITE = "https://www.apartments.com"
+SEARCH_PATH = "/springfield-il/"
+SEARCH_PAGES = 4
+PER_PAGE = 8
+
+WORDS = ["spacious", "modern", "kitchen", "stainless", "appliances", "hardwood", "floors", "walk-in", "closet", "views",
+         "downtown", "minutes", "community", "resident", "lounge", "package", "lockers", "quartz", "countertops", "natural",
+         "light", "bike", "storage", "controlled", "access", "washer", "dryer", "balcony", "nearby", "shopping", "dining"]
+UTILITIES = ["Water", "Trash Removal", "Sewer", "Gas", "Electricity", "Heat", "Air Conditioning", "Cable", "Internet"]
+PARKING = ["Surface Lot", "Covered", "Garage", "Street", "Assigned Parking"]
+PETS = ["Dogs Allowed", "Cats Allowed", "Dogs and Cats Allowed", "No Pets Allowed"]
+MONTHLY = ["Storage Fee", "Cat Rent", "Dog Rent", "Parking", "Trash Service"]
+ONE_TIME = ["Application Fee", "Admin Fee", "Cat Fee", "Dog Fee", "Amenity Fee"]
+BEDS = ["Studio", "1 bed", "2 beds", "3 beds"]
+
+def text(r, count):
+    return " ".join(r.choice(WORDS) for i in range(count))
+
+def filler(r):
+    """The parts of a page the scraper doesn't read: navigation, scripts, amenities, reviews and nearby listings."""
+    parts = []
+    parts.append('<nav class="globalNav"><ul>' + "".join('<li><a href="%s/%s/">%s</a></li>' % (SITE, r.choice(WORDS), text(r, 2))
+                                                          for i in range(40)) + '</ul></nav>')
+    parts.append('<script type="text/javascript">var ProfileStartupInfo = {%s};</script>' %
+                 ", ".join('"%s%d": "%s"' % (r.choice(WORDS), i, text(r, 4)) for i in range(150)))
+    parts.append('<section class="amenitiesSection">' + "".join('<div class="amenityCard"><p class="amenityLabel">%s</p><ul>%s</ul></div>' %
+                 (text(r, 2), "".join('<li class="specInfo"><span>%s</span></li>' % text(r, 3) for j in range(8))) for i in range(12)) + '</section>')
+    parts.append('<section class="reviewsSection">' + "".join('<div class="reviewContainer"><h3>%s</h3><p>%s</p></div>' %
+                 (text(r, 4), text(r, 60)) for i in range(10)) + '</section>')
+    parts.append('<section class="nearbyProperties"><ul>' + "".join('<li><article class="nearbyPlacard"><a href="%s/nearby-%d/">%s</a><p>%s</p></article></li>' %
+                 (SITE, r.randint(0, 99999), text(r, 3), text(r, 12)) for i in range(20)) + '</ul></section>')
+    return "\n".join(parts)
+
+def apartmentPath(n):
+    return "/complex-%d-springfield-il/%05x/" % (n, n * 7919)
+
+def floorplan(r, letter):
+    rent = r.randint(700, 2400)
+    if r.random() < 0.5:
+        price = "$%s" % format(rent, ",")
+    else:
+        price = "$%s – $%s" % (format(rent, ","), format(rent + r.choice([50, 100, 150, 250]), ","))
+    if r.random() < 0.05:
+        price = "Call for Rent"
+    return ('<div class="pricingGridItem multiFamily hasUnitGrid"><div class="priceGridModelWrapper"><h3 class="modelLabel">'
+            '<span class="modelName">Plan %s</span><span class="rentLabel">%s</span></h3><h4 class="detailsLabel">'
+            '<span class="detailsTextWrapper"><span>%s</span><span>%s bath</span><span>%s sq ft</span></span></h4></div>'
+            '<div class="unitGridContainer"><ul>%s</ul></div></div>'
+            % (letter, price, r.choice(BEDS), r.choice(["1", "1.5", "2", "2.5"]), format(r.randint(400, 1600), ","),
+               "".join('<li class="unitContainer"><span class="unitColumn">Unit %d</span><span class="pricingColumn">$%s</span></li>'
+                       % (r.randint(100, 999), format(rent + r.randint(0, 200), ",")) for i in range(r.randint(1, 5)))))
+
+def feesCard(header, items):
+    return ('<div class="feesPoliciesCard"><h4 class="header-column">%s</h4><div class="component-body"><ul>%s</ul></div></div>'
+            % (header, "".join('<li><div class="component-row"><div class="column">%s</div></div></li>' % item for item in items)))
+
+def fees(header, items, r):
+    return ('<div class="%s">%s</div>' % (header, "".join('<div class="descriptionWrapper"><span>%s</span><span>$%d</span></div>'
+                                                          % (item, r.randint(10, 300)) for item in items)))
+
+def apartmentPage(n):
+    r = random.Random(n)
+    floorplans = [floorplan(r, letter) for letter in "ABCDEFGHIJKL"[:r.randint(1, 12)]]
+    floorplans.append(floorplans[0]) #Real pages list some floorplans twice
+    return '''<!DOCTYPE html><html lang="en"><head><title>Complex %(n)d - Springfield, IL</title>
+<meta property="place:location:latitude" content="%(lat).6f"><meta property="place:location:longitude" content="%(lon).6f">
+<link rel="canonical" href="%(site)s%(path)s"></head><body>
+%(filler)s
+<header class="profileHeader"><a class="neighborhood" href="%(site)s/downtown-springfield-il/">Downtown</a>
+<h1 class="propertyName"> Complex %(n)d </h1>
+<div class="propertyAddressContainer"><h2><span>%(n)d Main St</span><span>Springfield</span><span class="stateZipContainer"><span>IL</span><span>6270%(zip)d</span></span>
+<span class="neighborhoodAddress"><a class="neighborhood">Downtown</a></span></h2></div></header>
+<div class="freeUtilities"><div class="descriptionWrapper"><span>Utilities Included</span><span>%(utilities)s</span></div></div>
+<div id="profileV2FeesWrapper">%(parking)s%(pets)s</div>
+<div class="petPolicyDetails"><p><span>%(petPolicy)s</span></p></div>
+%(monthly)s
+%(oneTime)s
+<div class="tab-section active">%(floorplans)s</div>
+<footer><p>%(footer)s</p></footer></body></html>''' % {
+        'n': n,
+        'lat': 39.7 + r.random() / 10,
+        'lon': -89.6 - r.random() / 10,
+        'site': SITE,
+        'path': apartmentPath(n),
+        'filler': filler(r),
+        'zip': r.randint(1, 9),
+        'utilities': ", ".join(r.sample(UTILITIES, r.randint(0, 5))),
+        'parking': feesCard("Parking", r.sample(PARKING, r.randint(0, 3))),
+        'pets': feesCard("Pet Policies", [r.choice(PETS)]),
+        'petPolicy': r.choice(PETS),
+        'monthly': fees("monthlyFees", r.sample(MONTHLY, r.randint(0, 3)), r),
+        'oneTime': fees("oneTimeFees", r.sample(ONE_TIME, r.randint(0, 3)), r),
+        'floorplans': "".join(floorplans),
+        'footer': text(r, 200)
+    }
+
+def searchPath(page):
+    return SEARCH_PATH + str(page) + "/" #Same as scrape_apartments.searchPageURL
+
+def searchPage(page, listings):
+    r = random.Random(-page)
+    placards = []
+    for n in listings:
+        placards.append('<li class="mortar-wrapper"><article class="placard" data-url="%s%s"><header class="placard-header">'
+                        '<span class="js-placardTitle title">Complex %d</span><div class="property-address">%d Main St, Springfield, IL 62701</div>'
+                        '</header><section class="placard-content"><p class="property-pricing">$%s+</p><p class="property-beds">%s</p>'
+                        '<ul class="property-amenities">%s</ul></section></article></li>'
+                        % (SITE, apartmentPath(n), n, n, format(r.randint(700, 2400), ","), r.choice(BEDS),
+                           "".join('<li>%s</li>' % text(r, 2) for i in range(6))))
+    return '''<!DOCTYPE html><html lang="en"><head><title>Springfield, IL Apartments</title></head><body>
+%s
+<div id="placardContainer" class="placardContainer"><ul>%s</ul></div>
+<nav id="paging"><span class="pageRange">Page %d of %d</span></nav>
+</body></html>''' % (filler(r), "".join(placards), page, SEARCH_PAGES)
+
+def writePage(directory, name, content):
+    with open(os.path.join(directory, name), 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as page: #No timestamp, so the files only change with their content
+            page.write(content.encode('utf-8'))
+
+def main(args):
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+    if args:
+        directory = args[0]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    pages = {}
+    apartments = set()
+    for page in range(1, SEARCH_PAGES + 1):
+        listings = list(range((page - 1) * PER_PAGE, page * PER_PAGE))
+        if page > 1:
+            listings[0] = 0 #The same apartment shows up on more than one page
+        apartments.update(listings)
+        name = "search-%d.html.gz" % page
+        writePage(directory, name, searchPage(page, listings))
+        pages[searchPath(page)] = {'kind': 'search', 'file': name}
+
+    for n in sorted(apartments):
+        name = "apartment-%d.html.gz" % n
+        writePage(directory, name, apartmentPage(n))
+        pages[apartmentPath(n)] = {'kind': 'apartment', 'file': name}
+
+    manifest = {'site': SITE, 'searches': [SITE + SEARCH_PATH], 'pages': pages}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    print("Wrote %d pages to %s" % (len(pages), directory))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import shutil
+import time
+
+class Checkpoint(object):
+    """Saves the progress of a run so it can be resumed after a crash or Ctrl-C.
+
+    The checkpoint is a folder holding progress.json (which search pages are finished and how many rows
+    had been saved at that point) and rows.jsonl, which gets one line per saved apartment. progress.json
+    is only rewritten once a search page is finished, so rows from a page that was interrupted part way
+    are ignored when resuming and that page is read again. The saved rows are also the listings visited,
+    so progress.json stays the same size however many apartments are saved."""
+
+    def __init__(self, path, resume):
+        self.path = path
+        self.progressPath = os.path.join(path, 'progress.json')
+        self.rowsPath = os.path.join(path, 'rows.jsonl')
+        self.progress = {
+            'runStart': time.time(),
+            'searches': {}, #search URL -> {'nextPage': number, 'done': bool}
+            'rows': 0
+        }
+        self.resumedRows = []
+
+        if resume:
+            self.load()
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        self.pendingRows = self.progress['rows']
+        self.rowsFile = open(self.rowsPath, 'a')
+
+    def load(self):
+        try:
+            with open(self.progressPath, 'r') as f:
+                self.progress = json.load(f)
+        except (OSError, ValueError):
+            logging.warning("No checkpoint found to resume from, starting from the beginning")
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            return
+
+        #Only keep the rows saved before the last finished page
+        try:
+            with open(self.rowsPath, 'r') as f:
+                for line in f:
+                    if len(self.resumedRows) >= self.progress['rows']:
+                        break
+                    self.resumedRows.append(json.loads(line))
+        except OSError:
+            pass
+        self.progress['rows'] = len(self.resumedRows)
+        with open(self.rowsPath, 'w') as f:
+            for row in self.resumedRows:
+                f.write(json.dumps(row) + '\n')
+        logging.info("Resuming from checkpoint with %d apartments already saved" % len(self.resumedRows))
+
+    def runStart(self):
+        return self.progress['runStart']
+
+    def visited(self):
+        """The URLs of the apartments saved before the interruption."""
+        return [row['url'] for row in self.resumedRows]
+
+    def isSearchDone(self, search_url):
+        return self.progress['searches'].get(search_url, {}).get('done', False)
+
+    def nextPage(self, search_url):
+        return self.progress['searches'].get(search_url, {}).get('nextPage', 1)
+
+    def apartmentWritten(self, url, apartment, status):
+        self.rowsFile.write(json.dumps({'url': url, 'apartment': apartment, 'status': status}) + '\n')
+        self.pendingRows += 1
+
+    def pageDone(self, search_url, page_num, done):
+        """Called once every apartment of a search page has been saved."""
+        self.rowsFile.flush()
+        os.fsync(self.rowsFile.fileno())
+        self.progress['rows'] = self.pendingRows
+        self.progress['searches'][search_url] = {'nextPage': page_num + 1, 'done': done}
+        tmp = self.progressPath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.progress, f)
+        os.replace(tmp, self.progressPath)
+
+    def finish(self):
+        """The run completed, the checkpoint isn't needed anymore."""
+        self.rowsFile.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def close(self):
+        if not self.rowsFile.closed:
+            self.rowsFile.close()
@@ -0,0 +1,327 @@
+import heapq
+import json
+import logging
+import os
+import re
+import sqlite3
+import xml.etree.ElementTree as ElementTree
+
+import metrics
+from geocoder import normalizeAddress
+
+#Commute distances need numpy
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Reading .osm.pbf road maps is optional, it needs osmium (.osm files are read without it)
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+EARTH_RADIUS_MILES = 3958.8
+
+MILES_PER_KM = 0.621371
+
+#The roads cars can drive on, with the speed (km/h) used when a road doesn't have a maxspeed tag
+ROAD_SPEEDS = {
+    'motorway': 100.0,
+    'motorway_link': 60.0,
+    'trunk': 80.0,
+    'trunk_link': 50.0,
+    'primary': 65.0,
+    'primary_link': 45.0,
+    'secondary': 55.0,
+    'secondary_link': 40.0,
+    'tertiary': 45.0,
+    'tertiary_link': 35.0,
+    'unclassified': 35.0,
+    'residential': 30.0,
+    'living_street': 10.0,
+    'service': 15.0,
+    'road': 30.0
+}
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in miles between two sets of points given in degrees. Takes numbers or numpy arrays,
+    which are broadcast against each other, e.x. a column of rows against a row of destinations."""
+    lat1, lon1, lat2, lon2 = numpy.radians(lat1), numpy.radians(lon1), numpy.radians(lat2), numpy.radians(lon2)
+    a = numpy.sin((lat2 - lat1) / 2.0) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_MILES * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+def parseDestinations(text):
+    """Reads the commuteDestinations option: destinations separated by ";", each one "latitude, longitude"
+    with an optional name in front (e.x. "Work = 47.6097, -122.3331; School = 47.6553, -122.3035").
+    Returns a list of (name, latitude, longitude)."""
+    destinations = []
+    for item in text.split(';'):
+        item = item.strip()
+        if item == '':
+            continue
+        name, sep, location = item.rpartition('=')
+        name = name.strip() or "Destination " + str(len(destinations) + 1)
+        try:
+            latitude, longitude = [float(value) for value in location.split(',')]
+        except ValueError:
+            raise Exception("ERROR: Configuration \'commuteDestinations\' has an invalid destination \'" + item + "\', use \"name = latitude, longitude\"")
+        if (abs(latitude) > 90.0) or (abs(longitude) > 180.0):
+            raise Exception("ERROR: Configuration \'commuteDestinations\' has a destination outside of the map \'" + item + "\'")
+        destinations.append((name, latitude, longitude))
+    return destinations
+
+def readSpeed(tags):
+    """The speed of a road in km/h, from its maxspeed tag when it has a usable one."""
+    speed = ROAD_SPEEDS[tags['highway']]
+    match = re.match(r'\s*([0-9.]+)\s*(mph)?', tags.get('maxspeed', ''))
+    if match is not None:
+        try:
+            speed = float(match.group(1))
+        except ValueError:
+            return speed
+        if match.group(2):
+            speed = speed / MILES_PER_KM
+    return max(speed, 1.0)
+
+def readOSMFile(path):
+    """Reads the drivable roads of an OpenStreetMap extract. Returns (node id -> (latitude, longitude), ways)
+    where ways is a list of (node ids, tags). Only the tags the router uses are kept."""
+    nodes = {}
+    ways = []
+    if path.endswith('.pbf'):
+        if osmium is None:
+            raise Exception("ERROR: Reading .osm.pbf road maps needs osmium, install it with \'pip install osmium\' or use a .osm file")
+
+        class RoadHandler(osmium.SimpleHandler):
+            def way(self, way):
+                tags = dict((tag.k, tag.v) for tag in way.tags if tag.k in ['highway', 'maxspeed', 'oneway', 'junction'])
+                if tags.get('highway') not in ROAD_SPEEDS:
+                    return
+                refs = []
+                for node in way.nodes:
+                    if node.location.valid():
+                        nodes[node.ref] = (node.location.lat, node.location.lon)
+                        refs.append(node.ref)
+                ways.append((refs, tags))
+
+        RoadHandler().apply_file(path, locations=True)
+        return nodes, ways
+
+    for event, element in ElementTree.iterparse(path):
+        if element.tag == 'node':
+            nodes[int(element.get('id'))] = (float(element.get('lat')), float(element.get('lon')))
+            element.clear()
+        elif element.tag == 'way':
+            tags = dict((tag.get('k'), tag.get('v')) for tag in element.iter('tag'))
+            if tags.get('highway') in ROAD_SPEEDS:
+                ways.append(([int(nd.get('ref')) for nd in element.iter('nd')], tags))
+            element.clear()
+    return nodes, ways
+
+class RoadRouter(object):
+    """Finds the driving distance and time from any point to each destination over the roads of a local
+    OpenStreetMap extract (.osm, or .osm.pbf with osmium). The fastest route from every intersection to each
+    destination is found once when the map is loaded, a point then only needs its nearest road node."""
+
+    def __init__(self, path, destinations, access_speed):
+        self.accessSpeed = access_speed
+        logging.info("Loading the road map " + path)
+        coordinates, ways = readOSMFile(path)
+
+        #Only nodes on a road are kept, numbered from 0 so the results fit in arrays
+        index = {}
+        latitudes = []
+        longitudes = []
+        edges = [] #(from, to, miles, minutes)
+        for refs, tags in ways:
+            speed = readSpeed(tags) * MILES_PER_KM / 60.0 #Miles per minute
+            oneway = tags.get('oneway', 'no')
+            if tags.get('junction') == 'roundabout' and oneway == 'no':
+                oneway = 'yes'
+            refs = [ref for ref in refs if ref in coordinates]
+            for ref in refs:
+                if ref not in index:
+                    index[ref] = len(latitudes)
+                    latitudes.append(coordinates[ref][0])
+                    longitudes.append(coordinates[ref][1])
+            for a, b in zip(refs, refs[1:]):
+                miles = float(haversine(coordinates[a][0], coordinates[a][1], coordinates[b][0], coordinates[b][1]))
+                if oneway == '-1':
+                    a, b = b, a
+                edges.append((index[a], index[b], miles, miles / speed))
+                if oneway not in ['yes', 'true', '1', '-1']:
+                    edges.append((index[b], index[a], miles, miles / speed))
+        if not latitudes:
+            raise Exception("ERROR: The road map \'" + path + "\' has no roads")
+        self.latitudes = numpy.array(latitudes)
+        self.longitudes = numpy.array(longitudes)
+
+        #Routes end at the destination, so the search runs backwards from it along reversed roads
+        incoming = [[] for i in range(len(latitudes))]
+        for a, b, miles, minutes in edges:
+            incoming[b].append((a, miles, minutes))
+
+        self.routes = []
+        for name, latitude, longitude in destinations:
+            node, access = self.nearestNode(latitude, longitude)
+            miles, minutes = shortestRoutes(incoming, node)
+            self.routes.append((miles + access, minutes + access / self.accessSpeed * 60.0))
+        logging.info("Found the routes to %d destinations over %d road nodes" % (len(destinations), len(latitudes)))
+
+    def nearestNode(self, latitude, longitude):
+        """The nearest road node to a point, and its straight line distance in miles."""
+        distances = haversine(latitude, longitude, self.latitudes, self.longitudes)
+        node = int(numpy.argmin(distances))
+        return node, float(distances[node])
+
+    def commute(self, latitudes, longitudes):
+        """The (miles, minutes) arrays of shape (points, destinations) from each point to each destination,
+        infinite when the road map doesn't connect them."""
+        miles = numpy.empty((len(latitudes), len(self.routes)))
+        minutes = numpy.empty((len(latitudes), len(self.routes)))
+        for i in range(len(latitudes)):
+            node, access = self.nearestNode(latitudes[i], longitudes[i])
+            for j, (routeMiles, routeMinutes) in enumerate(self.routes):
+                miles[i, j] = routeMiles[node] + access
+                minutes[i, j] = routeMinutes[node] + access / self.accessSpeed * 60.0
+        return miles, minutes
+
+def shortestRoutes(incoming, target):
+    """Dijkstra by travel time from every node to the target. Returns (miles, minutes) arrays of the fastest routes."""
+    minutes = numpy.full(len(incoming), numpy.inf)
+    miles = numpy.full(len(incoming), numpy.inf)
+    minutes[target] = 0.0
+    miles[target] = 0.0
+    queue = [(0.0, 0.0, target)]
+    while queue:
+        time, distance, node = heapq.heappop(queue)
+        if time > minutes[node]:
+            continue
+        for previous, edgeMiles, edgeMinutes in incoming[node]:
+            arrival = time + edgeMinutes
+            if arrival < minutes[previous]:
+                minutes[previous] = arrival
+                miles[previous] = distance + edgeMiles
+                heapq.heappush(queue, (arrival, distance + edgeMiles, previous))
+    return miles, minutes
+
+class CommuteCache(object):
+    """Remembers the commute of every address, in memory and in an optional SQLite file shared by later runs.
+    Results are stored along with the commute settings, so changing a destination doesn't reuse old results."""
+
+    def __init__(self, path, settings):
+        self.settings = settings
+        self.known = {}
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS commutes (
+                address TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                distance REAL,
+                duration REAL,
+                PRIMARY KEY (address, settings)
+            )""")
+            self.db.commit()
+            for address, distance, duration in self.db.execute("SELECT address, distance, duration FROM commutes WHERE settings = ?", (settings,)):
+                self.known[address] = (distance, duration)
+
+    def get(self, address):
+        return self.known.get(address)
+
+    def store(self, results):
+        """Saves a list of (address, distance, duration)."""
+        for address, distance, duration in results:
+            self.known[address] = (distance, duration)
+        if self.db is not None:
+            self.db.executemany("INSERT OR REPLACE INTO commutes (address, settings, distance, duration) VALUES (?, ?, ?, ?)",
+                                [(address, self.settings, distance, duration) for address, distance, duration in results])
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+class Commute(object):
+    """Fills in the distance (miles) and duration (minutes) of apartments from the closest of the
+    commuteDestinations. Without a road map both are straight line estimates, the duration at commuteSpeed."""
+
+    def __init__(self, config):
+        if numpy is None:
+            raise Exception("ERROR: Commute distances need numpy, install it with \'pip install numpy\'")
+        self.destinations = config['commuteDestinations']
+        self.speed = config['commuteSpeed']
+        self.latitudes = numpy.array([latitude for name, latitude, longitude in self.destinations])
+        self.longitudes = numpy.array([longitude for name, latitude, longitude in self.destinations])
+
+        settings = {'destinations': self.destinations, 'speed': self.speed}
+        self.roadMap = config['commuteRoadMap']
+        self.router = None #Only loaded once an address isn't in the cache
+        if self.roadMap:
+            if not os.path.isfile(self.roadMap):
+                raise Exception("ERROR: Configuration \'commuteRoadMap\' is not a file \'" + self.roadMap + "\'")
+            settings['roadMap'] = [os.path.abspath(self.roadMap), os.path.getmtime(self.roadMap)]
+        self.cache = CommuteCache(config['commuteCache'], json.dumps(settings, sort_keys=True))
+
+    def enrich(self, apartments):
+        """Sets 'distance' and 'duration' on each apartment dict, None when it can't be found (no coordinates or no road
+        to a destination). Apartments already in the cache cost nothing, the others are computed together."""
+        with metrics.timer('stage_seconds', 'commute'):
+            missing = {}
+            for apartment in apartments:
+                key = self.cacheKey(apartment)
+                known = None
+                if key is not None:
+                    known = self.cache.get(key)
+                if known is not None:
+                    metrics.increment('commute_lookups', label='cached')
+                    apartment['distance'], apartment['duration'] = known
+                elif key is None:
+                    metrics.increment('commute_lookups', label='unknown')
+                    apartment['distance'], apartment['duration'] = None, None
+                else:
+                    missing.setdefault(key, []).append(apartment)
+            if not missing:
+                return
+
+            keys = list(missing)
+            latitudes = numpy.array([missing[key][0]['latitude'] for key in keys])
+            longitudes = numpy.array([missing[key][0]['longitude'] for key in keys])
+            miles, minutes = self.compute(latitudes, longitudes)
+            #The closest destination by travel time is the one written
+            closest = numpy.argmin(minutes, axis=1)
+            results = []
+            for i, key in enumerate(keys):
+                distance = float(miles[i, closest[i]])
+                duration = float(minutes[i, closest[i]])
+                if numpy.isinf(duration):
+                    distance, duration = None, None
+                else:
+                    distance, duration = round(distance, 2), round(duration, 1)
+                results.append((key, distance, duration))
+                for apartment in missing[key]:
+                    apartment['distance'], apartment['duration'] = distance, duration
+            metrics.increment('commute_lookups', len(keys), label='computed')
+            self.cache.store(results)
+
+    def compute(self, latitudes, longitudes):
+        """The (miles, minutes) arrays of shape (points, destinations) from each point to each destination."""
+        if self.roadMap:
+            if self.router is None:
+                self.router = RoadRouter(self.roadMap, self.destinations, self.speed)
+            return self.router.commute(latitudes, longitudes)
+        miles = haversine(latitudes[:, None], longitudes[:, None], self.latitudes[None, :], self.longitudes[None, :])
+        return miles, miles / self.speed * 60.0
+
+    def cacheKey(self, apartment):
+        """Apartments are remembered by their address and their rounded coordinates, the commute is computed from the
+        coordinates so it is computed again when they change (e.x. a geocoded location later read from the page).
+        None when the apartment has no coordinates."""
+        if (apartment.get('latitude') is None) or (apartment.get('longitude') is None):
+            return None
+        address = normalizeAddress(apartment.get('address') or '')
+        return "%s|%.5f,%.5f" % (address, apartment['latitude'], apartment['longitude'])
+
+    def close(self):
+        self.cache.close()
@@ -0,0 +1,146 @@
+import re
+import sqlite3
+import time
+
+from geocoder import splitAddress
+
+try:
+    from urllib.parse import urlsplit, urlunsplit
+except ImportError:
+    from urlparse import urlsplit, urlunsplit
+
+def canonicalizeURL(url):
+    """Returns the form of a listing URL used to spot duplicates. Case of the host, a leading "www.",
+    trailing slashes, query strings (tracking parameters) and fragments don't make a different listing."""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    path = parts.path.rstrip('/')
+    return urlunsplit((parts.scheme.lower(), host, path, '', ''))
+
+def normalizeName(name):
+    return " ".join(re.sub(r'[^a-z0-9]+', ' ', (name or '').lower()).split())
+
+def listingFingerprint(name, address):
+    """The fingerprint of a search result placard, None when it doesn't say enough to tell complexes apart
+    (a name, a street and a ZIP code are needed)."""
+    name = normalizeName(name)
+    number, street, zipCode = splitAddress(address or '')
+    if (name == '') or (street == '') or (zipCode == ''):
+        return None
+    return "listing:%s|%s|%s|%s" % (name, number, street, zipCode)
+
+def apartmentFingerprints(apartment):
+    """The fingerprints of an apartment read from its page: one of its name and address, and one of its name and
+    every floorplan (price, size, bed, bath) sorted, so the same complex is found even without a usable address."""
+    fingerprints = []
+    name = normalizeName(apartment.get('name'))
+    if name == '':
+        return fingerprints
+    number, street, zipCode = splitAddress(apartment.get('address') or '')
+    if (street != '') and (zipCode != ''):
+        fingerprints.append("property:%s|%s|%s|%s" % (name, number, street, zipCode))
+    floorplans = sorted("%s/%s/%s/%s" % (floorplan['price'], floorplan['size'], floorplan['bed'], floorplan['bath'])
+                        for floorplan in apartment.get('floorplans', []))
+    if floorplans:
+        fingerprints.append("content:%s|%s" % (name, ";".join(floorplans)))
+    return fingerprints
+
+class SeenSet(object):
+    """The set of listing URLs already visited, stored in canonical form, along with the fingerprints of the
+    complexes found at them. The same complex reached through a URL that looks different is spotted by its
+    fingerprint: from the search result placard before its page is downloaded when the placard gives a name and
+    an address, otherwise from the apartment read from its page.
+
+    When a file is given, the URLs and fingerprints are also saved to SQLite tables so they are shared with later
+    runs and other search URLs. Everything saved is loaded into memory at startup, so checking a URL costs the
+    same no matter how many have been seen. Nothing is saved until commit(), which is called once the rows of a
+    search page are written, so listings of a page that was interrupted aren't skipped by the next run."""
+
+    def __init__(self, path=None):
+        self.seen = set()
+        self.fingerprints = {} #Fingerprint -> canonical URL it was first seen at
+        self.pendingURLs = [] #(canonical URL, time first seen) added since the last commit
+        self.pendingFingerprints = [] #(fingerprint, canonical URL) added since the last commit
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen (url TEXT PRIMARY KEY, first_seen REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS fingerprints (fingerprint TEXT PRIMARY KEY, url TEXT NOT NULL)")
+            self.db.commit()
+            for (url,) in self.db.execute("SELECT url FROM seen"):
+                self.seen.add(url)
+            for fingerprint, url in self.db.execute("SELECT fingerprint, url FROM fingerprints"):
+                self.fingerprints[fingerprint] = url
+
+    def __contains__(self, url):
+        return canonicalizeURL(url) in self.seen
+
+    def __iter__(self):
+        return iter(self.seen)
+
+    def __len__(self):
+        return len(self.seen)
+
+    def add(self, url):
+        """Marks the URL as seen, returns False if it had already been seen."""
+        url = canonicalizeURL(url)
+        if url in self.seen:
+            return False
+        self.seen.add(url)
+        self.pendingURLs.append((url, time.time()))
+        return True
+
+    def update(self, urls):
+        for url in urls:
+            self.add(url)
+
+    def addListing(self, url, name, address):
+        """Records the placard of a listing, returns False if the same complex was already listed at another URL."""
+        fingerprint = listingFingerprint(name, address)
+        if fingerprint is None:
+            return True
+        return self.addFingerprints(url, [fingerprint])
+
+    def addApartment(self, url, apartment):
+        """Records an apartment read from the listing's page (see parse_apartments.extractApartment),
+        returns False if the same complex was already read from another URL."""
+        return self.addFingerprints(url, apartmentFingerprints(apartment))
+
+    def addFingerprints(self, url, fingerprints):
+        url = canonicalizeURL(url)
+        for fingerprint in fingerprints:
+            first = self.fingerprints.get(fingerprint)
+            if (first is not None) and (first != url):
+                return False
+        for fingerprint in fingerprints:
+            if fingerprint not in self.fingerprints:
+                self.fingerprints[fingerprint] = url
+                self.pendingFingerprints.append((fingerprint, url))
+        return True
+
+    def commit(self, urls=None):
+        """Saves the URLs and fingerprints added since the last commit. When urls are given only those URLs and
+        their fingerprints are saved, the others stay in memory until a later commit."""
+        urlRows = self.pendingURLs
+        fingerprintRows = self.pendingFingerprints
+        if urls is None:
+            self.pendingURLs = []
+            self.pendingFingerprints = []
+        else:
+            done = set(canonicalizeURL(url) for url in urls)
+            urlRows = [row for row in self.pendingURLs if row[0] in done]
+            fingerprintRows = [row for row in self.pendingFingerprints if row[1] in done]
+            self.pendingURLs = [row for row in self.pendingURLs if row[0] not in done]
+            self.pendingFingerprints = [row for row in self.pendingFingerprints if row[1] not in done]
+        if self.db is not None:
+            self.db.executemany("INSERT OR IGNORE INTO seen (url, first_seen) VALUES (?, ?)", urlRows)
+            self.db.executemany("INSERT OR IGNORE INTO fingerprints (fingerprint, url) VALUES (?, ?)", fingerprintRows)
+            self.db.commit()
+
+    def close(self):
+        """Anything added since the last commit is dropped, it belongs to a page that wasn't finished."""
+        if self.db is not None:
+            self.db.rollback()
+            self.db.close()
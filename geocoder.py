@@ -0,0 +1,233 @@
+import csv
+import difflib
+import logging
+import os
+import re
+import sqlite3
+
+import metrics
+
+#The street index needs numpy
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Words written the same way in every address, so "123 North Main Street" finds "123 N Main St"
+ADDRESS_ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'av': 'ave', 'road': 'rd', 'boulevard': 'blvd', 'drive': 'dr', 'lane': 'ln',
+    'court': 'ct', 'place': 'pl', 'parkway': 'pkwy', 'highway': 'hwy', 'terrace': 'ter', 'circle': 'cir',
+    'square': 'sq', 'trail': 'trl', 'expressway': 'expy', 'freeway': 'fwy', 'center': 'ctr', 'crossing': 'xing',
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw'
+}
+
+#Everything after one of these words is the apartment number, which the index doesn't have
+UNIT_WORDS = ['apt', 'apartment', 'unit', 'suite', 'ste', 'bldg', 'building']
+
+#How close a street name has to be to one in the index to count as the same street (0 to 1)
+FUZZY_CUTOFF = 0.85
+
+#The column names each value can have in the index file, compared in lowercase
+INDEX_COLUMNS = {
+    'latitude': ['latitude', 'lat', 'y'],
+    'longitude': ['longitude', 'lon', 'lng', 'long', 'x'],
+    'address': ['address', 'full_address', 'street_address'],
+    'number': ['number', 'house_number', 'housenumber', 'addr:housenumber'],
+    'street': ['street', 'street_name', 'addr:street'],
+    'zip': ['zip', 'zipcode', 'zip_code', 'postcode', 'postal_code', 'zcta', 'zcta5']
+}
+
+def normalizeAddress(address):
+    return re.sub(r'\s+', ' ', address).strip().lower()
+
+def normalizeStreet(text):
+    """Lowercase street text without punctuation, unit numbers, or spelled out street types and directions."""
+    words = []
+    for word in re.sub(r'[^a-z0-9# ]', ' ', text.lower()).split():
+        if (word in UNIT_WORDS) or word.startswith('#'):
+            break
+        words.append(ADDRESS_ABBREVIATIONS.get(word, word))
+    return " ".join(words)
+
+def splitAddress(address):
+    """Splits an address like "123 Main St, Springfield, IL 62701" into (house number, normalized street, ZIP code).
+    Parts that aren't there are ''. A range of house numbers like "100-120" uses the first one."""
+    zipCodes = re.findall(r'(?<![0-9])([0-9]{5})(?:-[0-9]{4})?(?![0-9])', address)
+    zipCode = zipCodes[-1] if zipCodes else ''
+    street = address.split(',')[0].strip()
+    match = re.match(r'([0-9]+)[a-zA-Z]?(?:\s*-\s*[0-9]+[a-zA-Z]?)?\s+(.*)$', street)
+    if match is None:
+        return '', normalizeStreet(street), zipCode
+    return match.group(1), normalizeStreet(match.group(2)), zipCode
+
+def findColumn(fieldnames, name):
+    for field in fieldnames:
+        if field.strip().lower() in INDEX_COLUMNS[name]:
+            return field
+    return None
+
+class AddressIndex(object):
+    """Coordinates of addresses and ZIP codes, read from a CSV file such as an OpenAddresses extract (LAT, LON,
+    NUMBER, STREET, POSTCODE) or a list of ZIP code centroids (ZIP, LAT, LNG). Addresses are looked up by exact
+    house number and street, then by the closest house number on the closest matching street name in the same
+    ZIP code, then by the center of the ZIP code."""
+
+    def __init__(self, path):
+        logging.info("Loading the geocoding index " + path)
+        self.exact = {} #(number, street, zip) -> (latitude, longitude)
+        streets = {} #zip -> street -> [(number, latitude, longitude)]
+        zipCenters = {}
+        zipPoints = {}
+        with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            fieldnames = reader.fieldnames or []
+            columns = dict((name, findColumn(fieldnames, name)) for name in INDEX_COLUMNS)
+            if (columns['latitude'] is None) or (columns['longitude'] is None):
+                raise Exception("ERROR: The geocoding index \'" + path + "\' needs latitude and longitude columns")
+            for record in reader:
+                try:
+                    location = (float(record[columns['latitude']]), float(record[columns['longitude']]))
+                except (TypeError, ValueError):
+                    continue
+                zipCode = ''
+                if columns['zip'] is not None:
+                    zipCode = (record[columns['zip']] or '').strip()[:5]
+                if columns['address'] is not None:
+                    number, street, addressZip = splitAddress(record[columns['address']] or '')
+                    zipCode = zipCode or addressZip
+                elif columns['street'] is not None:
+                    number = ''
+                    if columns['number'] is not None:
+                        number = re.sub(r'[^0-9].*$', '', (record[columns['number']] or '').strip())
+                    street = normalizeStreet(record[columns['street']] or '')
+                else:
+                    #A ZIP code centroid
+                    if zipCode != '':
+                        zipCenters[zipCode] = location
+                    continue
+                if street == '':
+                    continue
+                self.exact[(number, street, zipCode)] = location
+                if number != '':
+                    streets.setdefault(zipCode, {}).setdefault(street, []).append((int(number), location[0], location[1]))
+                zipPoints.setdefault(zipCode, []).append(location)
+
+        #Each street is kept as arrays so the closest house number is found in one step
+        self.streets = {}
+        for zipCode, names in streets.items():
+            self.streets[zipCode] = {}
+            for street, points in names.items():
+                self.streets[zipCode][street] = numpy.array(points)
+
+        #ZIP codes without a centroid in the file use the middle of their addresses
+        self.zips = zipCenters
+        for zipCode, points in zipPoints.items():
+            if (zipCode != '') and (zipCode not in self.zips):
+                latitude, longitude = numpy.mean(numpy.array(points), axis=0)
+                self.zips[zipCode] = (float(latitude), float(longitude))
+        logging.info("The geocoding index has %d addresses and %d ZIP codes" % (len(self.exact), len(self.zips)))
+
+    def lookup(self, address):
+        """Returns (latitude, longitude, how it was found), the location is None if the address isn't in the index.
+        How it was found is 'exact', 'street' (closest house number on the closest street name), 'zip' or 'missing'."""
+        number, street, zipCode = splitAddress(address)
+        location = self.exact.get((number, street, zipCode))
+        if location is not None:
+            return location[0], location[1], 'exact'
+
+        names = self.streets.get(zipCode)
+        if names and (street != ''):
+            match = street
+            if match not in names:
+                matches = difflib.get_close_matches(street, list(names), n=1, cutoff=FUZZY_CUTOFF)
+                match = matches[0] if matches else None
+            if match is not None:
+                points = names[match]
+                closest = 0
+                if number != '':
+                    closest = int(numpy.argmin(numpy.abs(points[:, 0] - int(number))))
+                return float(points[closest, 1]), float(points[closest, 2]), 'street'
+
+        location = self.zips.get(zipCode)
+        if location is not None:
+            return location[0], location[1], 'zip'
+        return None, None, 'missing'
+
+class GeocodeCache(object):
+    """Remembers the location found for every address, also the addresses that weren't found, in memory and in an
+    optional SQLite file shared by later runs. Results are stored along with the index they came from."""
+
+    def __init__(self, path, index):
+        self.index = index
+        self.known = {}
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS geocodes (
+                address TEXT NOT NULL,
+                geocode_index TEXT NOT NULL,
+                latitude REAL,
+                longitude REAL,
+                PRIMARY KEY (address, geocode_index)
+            )""")
+            self.db.commit()
+            for address, latitude, longitude in self.db.execute("SELECT address, latitude, longitude FROM geocodes WHERE geocode_index = ?", (index,)):
+                self.known[address] = (latitude, longitude)
+
+    def get(self, address):
+        return self.known.get(address)
+
+    def store(self, results):
+        """Saves a list of (address, latitude, longitude)."""
+        for address, latitude, longitude in results:
+            self.known[address] = (latitude, longitude)
+        if self.db is not None:
+            self.db.executemany("INSERT OR REPLACE INTO geocodes (address, geocode_index, latitude, longitude) VALUES (?, ?, ?, ?)",
+                                [(address, self.index, latitude, longitude) for address, latitude, longitude in results])
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+class Geocoder(object):
+    """Gives apartments without a location on their page the latitude and longitude of their address,
+    from the local geocodeIndex file. Nothing is sent over the network."""
+
+    def __init__(self, config):
+        if numpy is None:
+            raise Exception("ERROR: Geocoding needs numpy, install it with \'pip install numpy\'")
+        self.path = config['geocodeIndex']
+        if not os.path.isfile(self.path):
+            raise Exception("ERROR: Configuration \'geocodeIndex\' is not a file \'" + self.path + "\'")
+        self.index = None #Only loaded once an address isn't in the cache
+        self.cache = GeocodeCache(config['geocodeCache'], "%s:%f" % (os.path.abspath(self.path), os.path.getmtime(self.path)))
+
+    def locate(self, apartments):
+        """Sets 'latitude' and 'longitude' on each apartment dict that doesn't have them yet, None when the
+        address can't be found. The addresses that aren't in the cache are looked up together."""
+        with metrics.timer('stage_seconds', 'geocode'):
+            looked = {} #Address -> location of the addresses looked up in the index
+            for apartment in apartments:
+                if (apartment.get('latitude') is not None) and (apartment.get('longitude') is not None):
+                    continue
+                address = normalizeAddress(apartment.get('address') or '')
+                known = self.cache.get(address) or looked.get(address)
+                if known is not None:
+                    metrics.increment('geocode_lookups', label='cached')
+                else:
+                    if self.index is None:
+                        self.index = AddressIndex(self.path)
+                    latitude, longitude, found = self.index.lookup(address)
+                    metrics.increment('geocode_lookups', label=found)
+                    if found == 'missing':
+                        logging.debug("Address not found in the geocoding index: %s" % address)
+                    known = (latitude, longitude)
+                    looked[address] = known
+                apartment['latitude'], apartment['longitude'] = known
+            if looked:
+                self.cache.store([(address, latitude, longitude) for address, (latitude, longitude) in looked.items()])
+
+    def close(self):
+        self.cache.close()
@@ -0,0 +1,292 @@
+import json
+import os
+import threading
+import time
+
+#Upper bounds (in seconds) of the histogram buckets used for timings
+TIME_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+#The label name of each metric that has one, used in the Prometheus export
+LABEL_NAMES = {
+    'http_responses': 'status',
+    'fetch_errors': 'error',
+    'cache_lookups': 'result',
+    'stage_seconds': 'stage',
+    'parse_seconds': 'function',
+    'limiter_wait_seconds': 'host',
+    'limiter_decreases': 'host',
+    'limiter_concurrency': 'host',
+    'limiter_rate': 'host',
+    'commute_lookups': 'result',
+    'geocode_lookups': 'result'
+}
+
+#What each metric measures, shown in the summary and the Prometheus export
+DESCRIPTIONS = {
+    'fetch_seconds': "Time to download a page, per request",
+    'fetch_bytes': "Bytes of page content downloaded",
+    'fetch_retries': "Requests that were retried",
+    'fetch_errors': "Failed requests: errors without a response, and pages skipped because of their HTTP status",
+    'http_responses': "HTTP responses by status code",
+    'cache_lookups': "Page cache lookups by result",
+    'stage_seconds': "Time spent in each stage of the scrape",
+    'parse_seconds': "Time spent in each parse function",
+    'limiter_wait_seconds': "Time a request waited for the rate limiter",
+    'limiter_decreases': "Times the rate limiter slowed down requests",
+    'limiter_concurrency': "Requests allowed at once by the rate limiter",
+    'limiter_rate': "Requests per second allowed by the rate limiter",
+    'commute_lookups': "Commutes filled in, by where they came from",
+    'geocode_lookups': "Addresses geocoded, by how they were found",
+    'rows_written': "Rows written to the output",
+    'apartments_written': "Apartments written to the output"
+}
+
+class Histogram(object):
+    """Counts observations per bucket, plus their sum and the largest one."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while (i < len(self.buckets)) and (value > self.buckets[i]):
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket holding the given fraction of the observations."""
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if (seen >= target) and (count > 0):
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                return self.max
+        return 0.0
+
+    def toDict(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': self.buckets, 'counts': self.counts}
+
+class Metrics(object):
+    """Counters, gauges and histograms of one run, safe to update from several threads. A metric can have one
+    label (e.x. the HTTP status), each label value is counted separately."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1, label=None):
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def setGauge(self, name, value, label=None):
+        with self.lock:
+            self.gauges[(name, label)] = value
+
+    def observe(self, name, value, label=None):
+        key = (name, label)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(TIME_BUCKETS)
+                self.histograms[key] = histogram
+            histogram.observe(value)
+
+    def merge(self, snapshot):
+        """Adds the counts of a snapshot taken in another process (see snapshot())."""
+        with self.lock:
+            for name, label, value in snapshot['counters']:
+                key = (name, label)
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, label, value in snapshot.get('gauges', []):
+                self.gauges[(name, label)] = value
+            for name, label, values in snapshot['histograms']:
+                key = (name, label)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram(TIME_BUCKETS)
+                    self.histograms[key] = histogram
+                for i, count in enumerate(values['counts']):
+                    histogram.counts[i] += count
+                histogram.count += values['count']
+                histogram.sum += values['sum']
+                histogram.max = max(histogram.max, values['max'])
+
+    def snapshot(self):
+        """The metrics as plain lists, picklable and JSON serializable."""
+        with self.lock:
+            return {
+                'counters': [[name, label, value] for (name, label), value in sorted(self.counters.items(), key=sortKey)],
+                'gauges': [[name, label, value] for (name, label), value in sorted(self.gauges.items(), key=sortKey)],
+                'histograms': [[name, label, histogram.toDict()] for (name, label), histogram in sorted(self.histograms.items(), key=sortKey)]
+            }
+
+    def summary(self):
+        """A table of every metric for the end of the run."""
+        elapsed = time.time() - self.started
+        lines = ["Run metrics (%.1fs)" % elapsed]
+        lines.append("%-40s %10s %12s %10s %10s %10s" % ("timing", "count", "total (s)", "mean (ms)", "p95 (ms)", "max (ms)"))
+        with self.lock:
+            for (name, label), histogram in sorted(self.histograms.items(), key=sortKey):
+                mean = 0.0
+                if histogram.count > 0:
+                    mean = histogram.sum / histogram.count
+                lines.append("%-40s %10d %12.3f %10.1f %10.1f %10.1f" % (metricName(name, label), histogram.count, histogram.sum,
+                             mean * 1000.0, histogram.percentile(0.95) * 1000.0, histogram.max * 1000.0))
+            lines.append("%-40s %10s" % ("counter", "value"))
+            for (name, label), value in sorted(self.counters.items(), key=sortKey):
+                lines.append("%-40s %10d" % (metricName(name, label), value))
+            if self.gauges:
+                lines.append("%-40s %10s" % ("gauge", "value"))
+            for (name, label), value in sorted(self.gauges.items(), key=sortKey):
+                lines.append("%-40s %10.1f" % (metricName(name, label), value))
+            hits = self.counters.get(('cache_lookups', 'hit'), 0) + self.counters.get(('cache_lookups', 'revalidated'), 0)
+            lookups = sum(value for (name, label), value in self.counters.items() if name == 'cache_lookups')
+        if lookups > 0:
+            lines.append("%-40s %9.1f%%" % ("cache hit rate", hits * 100.0 / lookups))
+        return "\n".join(lines)
+
+    def toJSON(self):
+        report = self.snapshot()
+        report['started'] = self.started
+        report['elapsed'] = time.time() - self.started
+        return json.dumps(report, indent=1)
+
+    def toPrometheus(self, prefix='apartments_scraper_'):
+        """The metrics in the Prometheus text format, for the node exporter textfile collector."""
+        lines = []
+        described = set()
+        with self.lock:
+            for (name, label), value in sorted(self.counters.items(), key=sortKey):
+                metric = prefix + name + "_total"
+                if metric not in described:
+                    described.add(metric)
+                    lines.append("# HELP %s %s" % (metric, DESCRIPTIONS.get(name, name)))
+                    lines.append("# TYPE %s counter" % metric)
+                lines.append("%s%s %s" % (metric, labelText(name, label), value))
+            for (name, label), value in sorted(self.gauges.items(), key=sortKey):
+                metric = prefix + name
+                if metric not in described:
+                    described.add(metric)
+                    lines.append("# HELP %s %s" % (metric, DESCRIPTIONS.get(name, name)))
+                    lines.append("# TYPE %s gauge" % metric)
+                lines.append("%s%s %s" % (metric, labelText(name, label), value))
+            for (name, label), histogram in sorted(self.histograms.items(), key=sortKey):
+                metric = prefix + name
+                if metric not in described:
+                    described.add(metric)
+                    lines.append("# HELP %s %s" % (metric, DESCRIPTIONS.get(name, name)))
+                    lines.append("# TYPE %s histogram" % metric)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (metric, labelText(name, label, le=str(bound)), cumulative))
+                lines.append("%s_sum%s %f" % (metric, labelText(name, label), histogram.sum))
+                lines.append("%s_count%s %d" % (metric, labelText(name, label), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Saves the metrics to the given file, in the Prometheus text format if it ends in .prom, otherwise as JSON."""
+        if path.endswith('.prom'):
+            text = self.toPrometheus()
+        else:
+            text = self.toJSON()
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+def sortKey(item):
+    (name, label), value = item
+    if label is None:
+        return (name, '')
+    return (name, str(label))
+
+def metricName(name, label):
+    if label is None:
+        return name
+    return name + "[" + str(label) + "]"
+
+def labelText(name, label, le=None):
+    labels = []
+    if label is not None:
+        value = str(label).replace('\\', '\\\\').replace('"', '\\"')
+        labels.append('%s="%s"' % (LABEL_NAMES.get(name, 'label'), value))
+    if le is not None:
+        labels.append('le="%s"' % le)
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+class Timer(object):
+    """Times a block of code: with metrics.timer('stage_seconds', 'parse'): ..."""
+
+    def __init__(self, registry, name, label):
+        self.registry = registry
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, self.label)
+        return False
+
+class NullTimer(object):
+    """Used in place of a Timer when metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = NullTimer()
+
+#The metrics of this process, None while disabled so every call below returns right away
+registry = None
+
+def enable():
+    global registry
+    if registry is None:
+        registry = Metrics()
+    return registry
+
+def disable():
+    global registry
+    registry = None
+
+def enabled():
+    return registry is not None
+
+def increment(name, amount=1, label=None):
+    if registry is not None:
+        registry.increment(name, amount, label)
+
+def gauge(name, value, label=None):
+    if registry is not None:
+        registry.setGauge(name, value, label)
+
+def observe(name, value, label=None):
+    if registry is not None:
+        registry.observe(name, value, label)
+
+def timer(name, label=None):
+    if registry is None:
+        return NULL_TIMER
+    return Timer(registry, name, label)
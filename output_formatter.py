@@ -1,5 +1,9 @@
+import re
+
 import xlsxwriter
 
+from analytics import Analytics
+
 LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
 def excel_style(row, col):
@@ -10,22 +14,152 @@ def excel_style(row, col):
         result[:0] = LETTERS[rem]
     return ''.join(result) + str(row + 1)
 
-class OutputRow(object):
-    def __init__(self, listValues, config):
-        self.Values = {}
-        self.listValues = listValues
+#The allowed items of each list column, in the order they are shown. Anything else shows up as "Other".
+LIST_VALUES = {
+    'utilities': ["Air Conditioning", "Electric", "Gas", "Heat", "Sewage", "Trash", "Water"],
+    'parking': ["Covered", "Garage", "Lot"],
+    'pets': ["Cats", "Dogs"],
+    'monthly': ["Storage Fee", "Cat Rent", "Dog Rent", "Parking"],
+    'fees': ["Application Fee", "Admin Fee", "Cat Fee", "Dog Fee"],
+    'recreation': ["Fitness Center", "Pool", "Tennis Court", "Trails", "Sauna", "Spa", "Racquetball Court", "Volleyball Court", "Playground"],
+    'features': ["Smoke Free", "Storage Unit", "Fireplace"],
+    'outdoors': ["Gated", "Grill", "Balcony", "Patio", "Sundeck", "Courtyard", "Picnic Area"]
+}
+
+class CategoryVocabulary(object):
+    """ Gives every allowed item of a list column its own bit, so the items of a row are stored as a single int.
+    The extra "other" bit is set for items outside the vocabulary. The text of a cell only depends on the
+    bits set, so it is built once per combination and reused. """
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.bits = {}
+        for i, item in enumerate(self.items):
+            self.bits[item] = 1 << i
+        self.otherBit = 1 << len(self.items)
+        self.cells = {}
+
+    def bit(self, item):
+        return self.bits.get(item, self.otherBit)
+
+    def itemsOf(self, mask):
+        """ The allowed items set in the mask, in vocabulary order. """
+        return [item for item in self.items if mask & self.bits[item]]
+
+    def cellText(self, mask):
+        text = self.cells.get(mask)
+        if text is None:
+            items = self.itemsOf(mask)
+            if mask & self.otherBit:
+                items.append("Other")
+            text = " / ".join(items)
+            self.cells[mask] = text
+        return text
+
+VOCABULARIES = dict((key, CategoryVocabulary(items)) for key, items in LIST_VALUES.items())
+
+#How the values of a property (shared by all its floorplans) are stored
+PROPERTY_VALUE_TYPES = {
+    'status': 'text',
+    'neighborhood': 'text',
+    'address': 'text',
+    'distance': 'real',
+    'duration': 'real'
+}
+
+#How the values of a single floorplan are stored
+FLOORPLAN_VALUE_TYPES = {
+    'price': 'integer',
+    'size': 'integer',
+    'bed': 'real',
+    'bath': 'real'
+}
+
+class PropertyRow(object):
+    """ The values shared by every floorplan of an apartment complex, stored once and referenced by its OutputRows.
+    Numbers are stored as numbers and the list columns with a vocabulary as bitmasks (see CategoryVocabulary).
+    Items outside a vocabulary, and list columns without one, are kept in "extras" which is only created when needed. """
+
+    __slots__ = ('ApartmentName', 'URL', 'status', 'neighborhood', 'address', 'distance', 'duration', 'utilities',
+                 'parking', 'pets', 'monthly', 'fees', 'recreation', 'features', 'outdoors', 'extras')
+
+    def __init__(self):
         self.ApartmentName = None
         self.URL = None
+        for key in PROPERTY_VALUE_TYPES:
+            setattr(self, key, None)
+        for key in VOCABULARIES:
+            setattr(self, key, 0)
+        self.extras = None
+
+    def setValue(self, key, value):
+        setattr(self, key, toRecordValue(value, PROPERTY_VALUE_TYPES[key]))
+
+    def addListValue(self, key, value):
+        vocabulary = VOCABULARIES.get(key)
+        if vocabulary is not None:
+            bit = vocabulary.bit(value)
+            setattr(self, key, getattr(self, key) | bit)
+            if bit != vocabulary.otherBit:
+                return
+        if self.extras is None:
+            self.extras = {}
+        val = self.extras.setdefault(key, [])
+        if value not in val:
+            val.append(value)
+
+    def hasListValue(self, key, value):
+        vocabulary = VOCABULARIES[key]
+        return (getattr(self, key) & vocabulary.bits[value]) != 0
+
+    def getListCell(self, key):
+        if key not in VOCABULARIES:
+            return ""
+        return VOCABULARIES[key].cellText(getattr(self, key))
+
+    def getListItems(self, key):
+        """ Every item added to the list column, the allowed ones first in vocabulary order. """
+        items = []
+        if key in VOCABULARIES:
+            items = VOCABULARIES[key].itemsOf(getattr(self, key))
+        if (self.extras is not None) and (key in self.extras):
+            items.extend(self.extras[key])
+        return items
+
+    def getRecord(self):
+        """ Returns the property as a dict of plain typed values, see PROPERTY_FIELDS. """
+        record = {
+            'name': self.ApartmentName,
+            'url': self.URL
+        }
+        for key, kind in PROPERTY_FIELDS:
+            if kind == 'list':
+                record[key] = self.getListItems(key)
+            else:
+                record[key] = getattr(self, key)
+        return record
+
+class OutputRow(object):
+    """ One row of the output, a single floorplan. The values shared by the whole apartment complex live in
+    the PropertyRow it references, so a complex with many floorplans only stores and reads them once. """
+
+    __slots__ = ('property', 'Floorplan', 'price', 'size', 'bed', 'bath')
+
+    def __init__(self, property=None):
+        if property is None:
+            property = PropertyRow()
+        self.property = property
         self.Floorplan = None
-        self.config = config
-        
+        for key in FLOORPLAN_VALUE_TYPES:
+            setattr(self, key, None)
+
     def setApartmentName(self, name):
         """ The name of the apartment complex. """
-        self.ApartmentName = name
+        self.property.ApartmentName = name
 
     def setApartmentURL(self, url):
         """ The URL to the Apartments.com page. """
-        self.URL = url
+        self.property.URL = url
 
     def setFloorplanName(self, name):
         """ The name of the floorplan. """
@@ -33,58 +167,131 @@ class OutputRow(object):
 
     def getNameCell(self):
         """ Returns the data for the "name" cell  in the correct format. """
-        apartment = self.ApartmentName
+        apartment = self.property.ApartmentName
         floorplan = self.Floorplan
         if apartment is None:
             apartment = ""
         if floorplan is None:
             floorplan = ""
         text = apartment + " \'" + floorplan + "\'"
-        if self.URL is None:
+        if self.property.URL is None:
             return text
         else:
-            return "=HYPERLINK(\"" + self.URL + "\", \"" + text + "\")"
+            return "=HYPERLINK(\"" + self.property.URL + "\", \"" + text + "\")"
 
     def setValue(self, key, value):
-        self.Values[key] = value
+        if key in FLOORPLAN_VALUE_TYPES:
+            setattr(self, key, toRecordValue(value, FLOORPLAN_VALUE_TYPES[key]))
+        else:
+            self.property.setValue(key, value)
 
     def getValueCell(self, key):
-        if key not in self.Values:
+        if key in FLOORPLAN_VALUE_TYPES:
+            value = getattr(self, key)
+        else:
+            value = getattr(self.property, key)
+        if value is None:
             return ""
-        return self.Values[key]
-    
+        return value
+
     def addListValue(self, key, value):
-        if key not in self.Values:
-            self.Values[key] = []
-        val = self.Values[key]
-        if value not in val:
-            val.append(value)
+        self.property.addListValue(key, value)
+
+    def hasListValue(self, key, value):
+        return self.property.hasListValue(key, value)
 
     def getListCell(self, key):
-        if key not in self.listValues:
-            return ""
-        listItems = self.listValues[key]
-        if key not in self.Values:
-            self.Values[key] = []
-        val = self.Values[key]
-        items = []
-        #Add items from our list in the order they appear iun the restricted items
-        for item in listItems:
-            if item in val:
-                items.append(item)
-        #Check to make sure all items are valid items
-        for item in val:
-            if item not in items:
-                items.append("Other")
-                break
-        return " / ".join(items)
+        return self.property.getListCell(key)
+
+    def getListItems(self, key):
+        return self.property.getListItems(key)
+
+    def getFloorplanRecord(self):
+        """ Returns the floorplan values as a dict of plain typed values, see FLOORPLAN_FIELDS. """
+        record = {'floorplan': self.Floorplan}
+        for key, kind in FLOORPLAN_FIELDS:
+            record[key] = getattr(self, key)
+        return record
+
+    def getRecord(self):
+        """ Returns the row as a dict of plain typed values (numbers as numbers, lists as lists) for outputs other than Excel. """
+        record = self.property.getRecord()
+        record.update(self.getFloorplanRecord())
+        return dict((key, record[key]) for key in RECORD_KEYS)
+
+#The typed fields of PropertyRow.getRecord() besides name and url
+PROPERTY_FIELDS = [
+    ('status', 'text'),
+    ('neighborhood', 'text'),
+    ('address', 'text'),
+    ('utilities', 'list'),
+    ('parking', 'list'),
+    ('pets', 'list'),
+    ('monthly', 'list'),
+    ('fees', 'list'),
+    ('recreation', 'list'),
+    ('features', 'list'),
+    ('outdoors', 'list'),
+    ('lease', 'list'),
+    ('distance', 'real'),
+    ('duration', 'real')
+]
+
+#The typed fields of OutputRow.getFloorplanRecord() besides floorplan
+FLOORPLAN_FIELDS = [
+    ('price', 'integer'),
+    ('size', 'integer'),
+    ('bed', 'real'),
+    ('bath', 'real')
+]
+
+#The typed fields of OutputRow.getRecord() besides name, floorplan and url
+RECORD_FIELDS = PROPERTY_FIELDS + FLOORPLAN_FIELDS
+
+RECORD_KEYS = ['name', 'floorplan', 'url'] + [key for key, kind in RECORD_FIELDS]
+
+def toRecordValue(value, kind):
+    """ Converts a value into the given record type, None when it is blank. """
+    if (value is None) or (value == ""):
+        return None
+    if kind == 'integer':
+        return int(float(value))
+    if kind == 'real':
+        return float(value)
+    return value
+
+
+class FormulaTemplate(object):
+    """ A formula whose cell references only change with the row. The text is given once with "{row}" wherever
+    the row number goes, filling it in for a row is then a single join. """
+
+    def __init__(self, text):
+        self.parts = text.split('{row}')
 
-    
+    def fill(self, row):
+        return str(row + 1).join(self.parts)
+
+#The ways formulas can refer to other cells (see the formulaStyle option), 'values' writes the results instead
+FORMULA_STYLES = ['cells', 'names', 'table', 'values']
+
+#The name of the Excel table holding the rows when formulaStyle is 'table'
+TABLE_NAME = 'ApartmentTable'
+
+def tableRef(header):
+    """ A structured reference to a column of the current row in the Excel table. """
+    for char in "'[]#":
+        header = header.replace(char, "'" + char)
+    return TABLE_NAME + "[@[" + header + "]]"
+
+def definedName(text):
+    """ Turns text into a valid Excel defined name. """
+    return re.sub(r'[^A-Za-z0-9_]', '_', text)
 
 class OutputFile(object):
 
     headers = {
         'name': ["Name / Link", 35.0],
+        'status': ["Status", 10.0, {'incremental': True}],
         'neighborhood': ["Neighborhood", 15.0],
         'price': ["Price", 11.0],
         'size': ["Size (sqft)", 10.0],
@@ -123,20 +330,16 @@ class OutputFile(object):
         'duration': ["Duration (min)", None]
     }
 
-    values = {
-        'utilities': ["Air Conditioning", "Electric", "Gas", "Heat", "Sewage", "Trash", "Water"],
-        'parking': ["Covered", "Garage", "Lot"],
-        'pets': ["Cats", "Dogs"],
-        'monthly': ["Storage Fee", "Cat Rent", "Dog Rent", "Parking"],
-        'fees': ["Application Fee", "Admin Fee", "Cat Fee", "Dog Fee"],
-        'recreation': ["Fitness Center", "Pool", "Tennis Court", "Trails", "Sauna", "Spa", "Racquetball Court", "Volleyball Court", "Playground"],
-        'features': ["Smoke Free", "Storage Unit", "Fireplace"],
-        'outdoors': ["Gated", "Grill", "Balcony", "Patio", "Sundeck", "Courtyard", "Picnic Area"]
-    }
+    values = LIST_VALUES
 
     def __init__(self, output_name, config):
         self.config = config
-        self.wb = xlsxwriter.Workbook(output_name + '.xlsx')
+        #In constant memory mode each row is flushed to disk as soon as the next one is started, instead of
+        #keeping every cell until close(). Rows must then be written strictly in order, which writeRow does.
+        options = {}
+        if config.get('constantMemory', False):
+            options['constant_memory'] = True
+        self.wb = xlsxwriter.Workbook(output_name + '.xlsx', options)
         self.ws = self.wb.add_worksheet("Apartments")
         self.columns = {}
 
@@ -171,11 +374,67 @@ class OutputFile(object):
             self.ws.write(0, col, header[0], cell_format)
             col += 1
 
+        self.headerFormat = cell_format
+        self.formulaStyle = config.get('formulaStyle', 'cells')
+        if (self.formulaStyle == 'table') and config.get('constantMemory', False):
+            raise Exception("ERROR: formulaStyle \'table\' can't be used with constantMemory, Excel tables need every row in memory.")
+
         if config['priceAdjustment']:
             self.createAdjustmentSheet(config, cell_format)
-        
+
+        #The formulas only depend on the column layout, which is fixed now, so they are built once here.
+        #In table mode the formula columns are left empty and filled in by Excel table at close().
+        self.formulas = []
+        self.tableFormulas = {}
+        formulaKeys = ['value']
+        if config['priceAdjustment']:
+            formulaKeys += ['discount', 'adjusted_price', 'adjusted_value']
+        if self.formulaStyle != 'values':
+            for key in formulaKeys:
+                text = self.formulaText(key)
+                if self.formulaStyle == 'table':
+                    self.tableFormulas[key] = text
+                else:
+                    self.formulas.append((self.columns[key], FormulaTemplate(text)))
+
+        self.analytics = None
+        if config.get('analytics', False):
+            self.analytics = Analytics(config)
+
         self.currentRow = 1
 
+    def cellRef(self, key):
+        """ The reference to the column's cell of the current row in a formula. """
+        if self.formulaStyle == 'table':
+            return tableRef(self.headers[key][0])
+        return excel_style(0, self.columns[key])[:-1] + "{row}"
+
+    def utilitiesRef(self, util=None):
+        """ The reference to the included utilities cell of the current row, or the cell of one utility when they are separated. """
+        key = 'utilities'
+        if util is not None:
+            key = 'utilities[' + util + ']'
+        if self.formulaStyle == 'table':
+            return self.cellRef(key)
+        return "$" + self.cellRef(key)
+
+    def adjustmentRef(self, i, util):
+        """ The reference to the price adjustment of a utility. """
+        if self.formulaStyle == 'cells':
+            return "\'Price Adjustments\'!$B$" + str(i + 2)
+        return definedName("Adjust" + util)
+
+    def formulaText(self, key):
+        if key == 'value':
+            return "=" + self.cellRef('price') + "/" + self.cellRef('size')
+        elif key == 'discount':
+            return self.discountFormula()
+        elif key == 'adjusted_price':
+            return "=" + self.cellRef('price') + "+" + self.cellRef('discount')
+        elif key == 'adjusted_value':
+            return "=" + self.cellRef('adjusted_price') + "/" + self.cellRef('size')
+        raise Exception("ERROR: No formula for column \'" + key + "\'")
+
     def createAdjustmentSheet(self, config, header_format):
         ws = self.wb.add_worksheet("Price Adjustments")
         self.adjWS = ws
@@ -185,13 +444,18 @@ class OutputFile(object):
         for util in self.values['utilities']:
             ws.write(row, 0, util)
             ws.write(row, 1, config['adjustPrice'][util], self.num_format)
+            if self.formulaStyle != 'cells':
+                self.wb.define_name(definedName("Adjust" + util), "=\'Price Adjustments\'!$B$" + str(row + 1))
             row += 1
+        if self.formulaStyle != 'cells':
+            self.wb.define_name('AdjustUtilities', "=\'Price Adjustments\'!$A$2:$A$" + str(row))
+            self.wb.define_name('AdjustPrices', "=\'Price Adjustments\'!$B$2:$B$" + str(row))
 
-    def getNewRow(self):
-        return OutputRow(self.values, self.config)
+    def getNewProperty(self):
+        return PropertyRow()
 
-    def excel_style(self, colKey):
-        return excel_style(self.currentRow, self.columns[colKey])
+    def getNewRow(self, property=None):
+        return OutputRow(property)
 
     def writeCell(self, key, value, format):
         if format is None:
@@ -205,16 +469,22 @@ class OutputFile(object):
         if "HYPERLINK" in nameCell:
             nameFormat = self.link_format
         self.writeCell('name', nameCell, nameFormat)
+        if 'status' in self.columns:
+            self.writeCell('status', row.getValueCell('status'), None)
         self.writeCell('neighborhood', row.getValueCell('neighborhood'), None)
-        self.writeCell('price', float(row.getValueCell('price')), self.num_format)
-        self.writeCell('size', int(row.getValueCell('size')), None)
-        self.writeCell('value', "=" + self.excel_style('price') + "/" + self.excel_style('size'), self.num_format)
-        if self.config['priceAdjustment']:
-            self.writeCell('discount', self.calculateDiscount(row), self.num_format)
-            self.writeCell('adjusted_price', "=" + self.excel_style('price') + "+" + self.excel_style('discount'), self.num_format)
-            self.writeCell('adjusted_value', "=" + self.excel_style('adjusted_price') + "/" + self.excel_style('size'), self.num_format)
-        self.writeCell('bed', float(row.getValueCell('bed')), None)
-        self.writeCell('bath', float(row.getValueCell('bath')), None)
+        self.writeCell('price', row.price, self.num_format)
+        self.writeCell('size', row.size, None)
+        for col, formula in self.formulas:
+            self.ws.write_formula(self.currentRow, col, formula.fill(self.currentRow), self.num_format)
+        discount = 0
+        if self.config['priceAdjustment'] and ((self.formulaStyle == 'values') or (self.analytics is not None)):
+            discount = self.rowDiscount(row)
+        if self.formulaStyle == 'values':
+            self.writeFormulaValues(row, discount)
+        if self.analytics is not None:
+            self.analytics.add(row, discount)
+        self.writeCell('bed', row.bed, None)
+        self.writeCell('bath', row.bath, None)
         self.writeSeparatedCells(row, 'utilities', 'separateUtilities', None)
         self.writeSeparatedCells(row, 'parking', 'separateParking', None)
         self.writeSeparatedCells(row, 'pets', 'separatePets', None)
@@ -232,21 +502,40 @@ class OutputFile(object):
 
     def writeSeparatedCells(self, row, key, configKey, format):
         if self.config[configKey]:
-            if key in self.values:
-                listValues = self.values[key]
-                values = []
-                if key in row.Values:
-                    values = row.Values[key]
-                for listValue in listValues:
-                    value = "No"
-                    if listValue in values:
-                        value = "Yes"
-                    self.writeCell(key + '[' + listValue + ']', value, format)
+            for listValue in self.values[key]:
+                value = "No"
+                if row.hasListValue(key, listValue):
+                    value = "Yes"
+                self.writeCell(key + '[' + listValue + ']', value, format)
         else:
             self.writeCell(key, row.getListCell(key), format)
 
-    def calculateDiscount(self, row):
+    def rowDiscount(self, row):
+        """ The price adjustment of the row's included utilities, the same as the discount formula. """
+        discount = 0
+        for util in self.values['utilities']:
+            if row.hasListValue('utilities', util):
+                discount -= self.config['adjustPrice'][util]
+        return discount
+
+    def writeFormulaValues(self, row, discount):
+        """ Writes what the formula columns would calculate, blank where a formula would give an error. """
+        price = row.price
+        if price is None:
+            price = 0 #Same as the empty cell in a formula
+        values = {'value': None, 'discount': discount, 'adjusted_price': price + discount, 'adjusted_value': None}
+        if row.size:
+            values['value'] = price / row.size
+            values['adjusted_value'] = (price + discount) / row.size
+        for key, value in values.items():
+            if key in self.columns:
+                self.writeCell(key, "" if value is None else value, self.num_format)
+
+    def discountFormula(self):
         """This is a doozy of an excel formula"""
+        if (self.formulaStyle != 'cells') and not self.config['separateUtilities']:
+            #With the adjustments named, every utility found in the cell is summed up in one go
+            return "=-SUMPRODUCT(ISNUMBER(FIND(AdjustUtilities, " + self.utilitiesRef() + "))*AdjustPrices)"
         discounts = []
         for i, util in enumerate(self.values['utilities']):
             discount = "IF(ISNUMBER(FIND(\""
@@ -254,17 +543,33 @@ class OutputFile(object):
                 discount += "Yes"
             else:
                 discount += util
-            discount += "\", $"
+            discount += "\", "
             if self.config['separateUtilities']:
-                discount += self.excel_style('utilities[' + util + ']')
+                discount += self.utilitiesRef(util)
             else:
-                discount += self.excel_style('utilities')
-            discount += ")), \'Price Adjustments\'!$B$" + str(i + 2) + ", 0)"
+                discount += self.utilitiesRef()
+            discount += ")), " + self.adjustmentRef(i, util) + ", 0)"
             discounts.append(discount)
         if len(discounts) == 0:
-            return int(0)
+            return "=0"
         return "=-(" + (" + ".join(discounts)) + ")"
 
+    def addTable(self):
+        """ Turns the written rows into an Excel table, the formula columns are defined once for the whole table. """
+        if self.currentRow == 1:
+            return #Excel tables need at least one row
+        columns = [None] * len(self.columns)
+        for key, col in self.columns.items():
+            column = {'header': self.headers[key][0], 'header_format': self.headerFormat}
+            if key in self.tableFormulas:
+                column['formula'] = self.tableFormulas[key]
+                column['format'] = self.num_format
+            columns[col] = column
+        self.ws.add_table(0, 0, self.currentRow - 1, len(columns) - 1, {'name': TABLE_NAME, 'columns': columns})
+
     def close(self):
+        if self.formulaStyle == 'table':
+            self.addTable()
+        if self.analytics is not None:
+            self.analytics.writeSheets(self.wb, self.headerFormat, self.num_format, self.link_format)
         self.wb.close()
-    
\ No newline at end of file
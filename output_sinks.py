@@ -0,0 +1,283 @@
+import csv
+import json
+import logging
+import sqlite3
+
+from output_formatter import OutputFile, OutputRow, PropertyRow, RECORD_FIELDS, PROPERTY_FIELDS, FLOORPLAN_FIELDS
+
+#Parquet output is optional, it needs pyarrow
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+#Every record column in order, with its type
+RECORD_COLUMNS = [('name', 'text'), ('floorplan', 'text'), ('url', 'text')] + RECORD_FIELDS
+
+#The columns of the two related tables written with normalizedOutput, floorplans.property_id refers to properties.id
+PROPERTY_COLUMNS = [('id', 'integer'), ('name', 'text'), ('url', 'text')] + PROPERTY_FIELDS
+FLOORPLAN_COLUMNS = [('property_id', 'integer'), ('floorplan', 'text')] + FLOORPLAN_FIELDS
+
+#Output format name -> file extension
+OUTPUT_FORMATS = {
+    'xlsx': '.xlsx',
+    'csv': '.csv',
+    'jsonl': '.jsonl',
+    'parquet': '.parquet',
+    'sqlite': '.sqlite'
+}
+
+def outputPaths(output_name, output_format, config):
+    """The files written for an output format."""
+    extension = OUTPUT_FORMATS[output_format]
+    if config.get('normalizedOutput', False) and (output_format not in ['xlsx', 'sqlite']):
+        return [output_name + '_properties' + extension, output_name + '_floorplans' + extension]
+    return [output_name + extension]
+
+class OutputSink(object):
+    """Base class of the outputs other than Excel. Rows are converted to typed records
+    (see OutputRow.getRecord) so numbers stay numbers, without any of the Excel formulas.
+
+    With normalizedOutput, each property is written once to a "properties" table and its floorplans
+    to a "floorplans" table that refers to it by id, instead of one wide row per floorplan.
+
+    By default every table is its own file, written by a tableClass(path, columns) and named after the
+    output with the extension of the format (output_name_floorplans.csv with normalizedOutput)."""
+
+    tableClass = None
+    extension = None
+
+    def __init__(self, output_name, config):
+        self.config = config
+        self.normalized = config.get('normalizedOutput', False)
+        self.lastProperty = None
+        self.propertyId = 0
+        if self.normalized:
+            self.properties = self.openTable(output_name, 'properties', PROPERTY_COLUMNS)
+            self.floorplans = self.openTable(output_name, 'floorplans', FLOORPLAN_COLUMNS)
+            self.tables = [self.properties, self.floorplans]
+        else:
+            self.rows = self.openTable(output_name, None, RECORD_COLUMNS)
+            self.tables = [self.rows]
+
+    def openTable(self, output_name, table, columns):
+        if table is None:
+            return self.tableClass(output_name + self.extension, columns)
+        return self.tableClass(output_name + '_' + table + self.extension, columns)
+
+    def getNewProperty(self):
+        return PropertyRow()
+
+    def getNewRow(self, property=None):
+        return OutputRow(property)
+
+    def writeRow(self, row):
+        if not self.normalized:
+            self.rows.writeRecord(row.getRecord())
+            return
+        #Rows of the same property are written one after another, so a new property object means a new property
+        if row.property is not self.lastProperty:
+            self.lastProperty = row.property
+            self.propertyId += 1
+            record = row.property.getRecord()
+            record['id'] = self.propertyId
+            self.properties.writeRecord(record)
+        record = row.getFloorplanRecord()
+        record['property_id'] = self.propertyId
+        self.floorplans.writeRecord(record)
+
+    def close(self):
+        for table in self.tables:
+            table.close()
+
+class CsvTable(object):
+    """One line per record, list values are joined with " / "."""
+
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([column for column, kind in columns])
+
+    def writeRecord(self, record):
+        values = []
+        for column, kind in self.columns:
+            value = record[column]
+            if kind == 'list':
+                value = " / ".join(value)
+            values.append(value)
+        self.writer.writerow(values)
+
+    def close(self):
+        self.file.close()
+
+class CsvSink(OutputSink):
+    tableClass = CsvTable
+    extension = OUTPUT_FORMATS['csv']
+
+class JsonLinesTable(object):
+    """One JSON object per line."""
+
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def writeRecord(self, record):
+        self.file.write(json.dumps(dict((column, record[column]) for column, kind in self.columns)) + '\n')
+
+    def close(self):
+        self.file.close()
+
+class JsonLinesSink(OutputSink):
+    tableClass = JsonLinesTable
+    extension = OUTPUT_FORMATS['jsonl']
+
+class ParquetTable(object):
+    """Columnar output, records are collected and written in batches."""
+
+    def __init__(self, path, columns, batch_size=1000):
+        types = {
+            'text': pyarrow.string(),
+            'integer': pyarrow.int64(),
+            'real': pyarrow.float64(),
+            'list': pyarrow.list_(pyarrow.string())
+        }
+        self.schema = pyarrow.schema([(column, types[kind]) for column, kind in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.batchSize = batch_size
+        self.batch = []
+
+    def writeRecord(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_table(pyarrow.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+class ParquetSink(OutputSink):
+    tableClass = ParquetTable
+    extension = OUTPUT_FORMATS['parquet']
+
+    def __init__(self, output_name, config):
+        if pyarrow is None:
+            raise Exception("ERROR: Parquet output needs pyarrow, install it with \'pip install pyarrow\'")
+        OutputSink.__init__(self, output_name, config)
+
+class SqliteTable(object):
+    """A table of the SQLite output. Records are inserted in batches, one transaction per batch."""
+
+    def __init__(self, db, name, columns, batch_size=1000):
+        types = {'text': 'TEXT', 'integer': 'INTEGER', 'real': 'REAL', 'list': 'TEXT'}
+        self.db = db
+        self.columns = columns
+        self.db.execute("DROP TABLE IF EXISTS " + name)
+        self.db.execute("CREATE TABLE " + name + " (" + ", ".join(column + " " + types[kind] for column, kind in columns) + ")")
+        self.insert = "INSERT INTO " + name + " VALUES (" + ", ".join("?" for column in columns) + ")"
+        self.batchSize = batch_size
+        self.batch = []
+
+    def writeRecord(self, record):
+        values = []
+        for column, kind in self.columns:
+            value = record[column]
+            if kind == 'list':
+                value = " / ".join(value)
+            values.append(value)
+        self.batch.append(values)
+        if len(self.batch) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            with self.db:
+                self.db.executemany(self.insert, self.batch)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+
+class SqliteSink(OutputSink):
+    """An "apartments" table with one row per floorplan, or "properties" and "floorplans" tables with normalizedOutput."""
+
+    def __init__(self, output_name, config):
+        self.db = sqlite3.connect(output_name + '.sqlite')
+        OutputSink.__init__(self, output_name, config)
+
+    def openTable(self, output_name, table, columns):
+        if table is None:
+            return SqliteTable(self.db, 'apartments', columns)
+        return SqliteTable(self.db, table, columns)
+
+    def close(self):
+        OutputSink.close(self)
+        self.db.close()
+
+class MultiOutput(object):
+    """Sends every row to several outputs in the same pass."""
+
+    def __init__(self, outputs, config):
+        self.outputs = outputs
+        self.config = config
+
+    def getNewProperty(self):
+        return PropertyRow()
+
+    def getNewRow(self, property=None):
+        return OutputRow(property)
+
+    def writeRow(self, row):
+        for output in self.outputs:
+            output.writeRow(row)
+
+    def close(self):
+        closeAll(self.outputs)
+
+def closeAll(outputs):
+    """Closes every output, even when closing one of them fails. The first error is raised once all of them are closed."""
+    error = None
+    for output in outputs:
+        try:
+            output.close()
+        except Exception as e:
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
+
+def openOutput(output_name, output_format, config):
+    if output_format == 'xlsx':
+        return OutputFile(output_name, config)
+    elif output_format == 'csv':
+        return CsvSink(output_name, config)
+    elif output_format == 'jsonl':
+        return JsonLinesSink(output_name, config)
+    elif output_format == 'parquet':
+        return ParquetSink(output_name, config)
+    elif output_format == 'sqlite':
+        return SqliteSink(output_name, config)
+    raise Exception("ERROR: Unknown output format \'" + output_format + "\'")
+
+def openOutputs(output_name, output_formats, config):
+    """Opens one output per format, all written to at the same time."""
+    outputs = []
+    try:
+        for output_format in output_formats:
+            outputs.append(openOutput(output_name, output_format, config))
+    except Exception:
+        #The outputs already opened are closed, but it's the error opening the next one that gets raised
+        try:
+            closeAll(outputs)
+        except Exception:
+            logging.exception("Unable to close the outputs already opened")
+        raise
+    if len(outputs) == 1:
+        return outputs[0]
+    return MultiOutput(outputs, config)
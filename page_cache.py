@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+def hashBytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+class CacheEntry(object):
+    """What the cache knows about one URL."""
+    def __init__(self, meta, content):
+        self.meta = meta
+        self.content = content
+
+    def isFresh(self, ttl):
+        return (time.time() - self.meta['storedAt']) < ttl
+
+    def validators(self):
+        """Returns the request headers needed to ask the server if the cached copy is still good."""
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('lastModified'):
+            headers['If-Modified-Since'] = self.meta['lastModified']
+        return headers
+
+class PageCache(object):
+    """On-disk cache of downloaded pages.
+
+    Page bodies are stored once per unique content under objects/, named by their hash. Each URL
+    gets a small JSON file under entries/ pointing at its body along with the ETag / Last-Modified
+    validators. When the bodies grow past the size limit, the least recently used URLs are dropped."""
+
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxSize = max_size
+        self.entriesDir = os.path.join(directory, 'entries')
+        self.objectsDir = os.path.join(directory, 'objects')
+        os.makedirs(self.entriesDir, exist_ok=True)
+        os.makedirs(self.objectsDir, exist_ok=True)
+        self.lock = threading.Lock()
+
+        #Load the index into memory, the last access time of an entry is the modified time of its file
+        self.entries = {}
+        for fname in os.listdir(self.entriesDir):
+            if not fname.endswith('.json'):
+                continue
+            path = os.path.join(self.entriesDir, fname)
+            try:
+                with open(path, 'r') as f:
+                    meta = json.load(f)
+                meta['accessedAt'] = os.path.getmtime(path)
+            except (OSError, ValueError):
+                continue
+            self.entries[fname[:-len('.json')]] = meta
+
+        self.objectSizes = {}
+        for fname in os.listdir(self.objectsDir):
+            try:
+                self.objectSizes[fname] = os.path.getsize(os.path.join(self.objectsDir, fname))
+            except OSError:
+                continue
+        self.totalSize = sum(self.objectSizes.values())
+
+        #Count how many URLs point at each body so shared bodies are only deleted once unused
+        self.objectRefs = {}
+        for meta in self.entries.values():
+            self.objectRefs[meta['body']] = self.objectRefs.get(meta['body'], 0) + 1
+        for digest in list(self.objectSizes):
+            if digest not in self.objectRefs:
+                self.objectRefs[digest] = 1
+                self.releaseObject(digest)
+        self.evict() #The size limit may have been lowered since the last run
+
+    def keyFor(self, url):
+        return hashBytes(url.encode('utf-8'))
+
+    def entryPath(self, key):
+        return os.path.join(self.entriesDir, key + '.json')
+
+    def objectPath(self, digest):
+        return os.path.join(self.objectsDir, digest)
+
+    def lookup(self, url):
+        """Returns the CacheEntry for the URL, or None if it has not been cached."""
+        key = self.keyFor(url)
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta is None:
+                return None
+            try:
+                with open(self.objectPath(meta['body']), 'rb') as f:
+                    content = f.read()
+            except OSError:
+                #The body went missing, forget about the entry
+                self.removeEntry(key)
+                return None
+            meta['accessedAt'] = time.time()
+            try:
+                os.utime(self.entryPath(key))
+            except OSError:
+                pass
+            return CacheEntry(meta, content)
+
+    def store(self, url, content, headers):
+        """Saves a freshly downloaded page along with its validators."""
+        digest = hashBytes(content)
+        meta = {
+            'url': url,
+            'body': digest,
+            'etag': headers.get('ETag'),
+            'lastModified': headers.get('Last-Modified'),
+            'storedAt': time.time()
+        }
+        with self.lock:
+            if digest not in self.objectSizes:
+                self.writeFile(self.objectPath(digest), content)
+                self.objectSizes[digest] = len(content)
+                self.totalSize += len(content)
+            self.saveEntry(self.keyFor(url), meta)
+            self.evict()
+
+    def revalidated(self, entry, headers):
+        """The server confirmed the cached copy is still current (HTTP 304), restart its TTL."""
+        meta = dict(entry.meta)
+        meta['storedAt'] = time.time()
+        if headers.get('ETag'):
+            meta['etag'] = headers.get('ETag')
+        if headers.get('Last-Modified'):
+            meta['lastModified'] = headers.get('Last-Modified')
+        with self.lock:
+            self.saveEntry(self.keyFor(meta['url']), meta)
+
+    def saveEntry(self, key, meta):
+        meta['accessedAt'] = time.time()
+        saved = dict(meta)
+        del saved['accessedAt']
+        self.writeFile(self.entryPath(key), json.dumps(saved).encode('utf-8'))
+        old = self.entries.get(key)
+        self.entries[key] = meta
+        self.objectRefs[meta['body']] = self.objectRefs.get(meta['body'], 0) + 1
+        if old is not None:
+            self.releaseObject(old['body'])
+
+    def writeFile(self, path, data):
+        """Writes through a temporary file so a crash never leaves half a page in the cache."""
+        tmp = path + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def removeEntry(self, key):
+        meta = self.entries.pop(key, None)
+        try:
+            os.remove(self.entryPath(key))
+        except OSError:
+            pass
+        if meta is not None:
+            self.releaseObject(meta['body'])
+
+    def releaseObject(self, digest):
+        """Deletes a body once no URL points at it anymore."""
+        refs = self.objectRefs.get(digest, 0) - 1
+        if refs > 0:
+            self.objectRefs[digest] = refs
+            return
+        self.objectRefs.pop(digest, None)
+        try:
+            os.remove(self.objectPath(digest))
+        except OSError:
+            pass
+        self.totalSize -= self.objectSizes.pop(digest, 0)
+
+    def evict(self):
+        """Drops least recently used entries until the stored bodies fit in the size limit."""
+        if self.maxSize <= 0 or self.totalSize <= self.maxSize:
+            return
+        removed = 0
+        for key, meta in sorted(self.entries.items(), key=lambda item: item[1]['accessedAt']):
+            if self.totalSize <= self.maxSize:
+                break
+            self.removeEntry(key)
+            removed += 1
+        logging.info("Evicted %d pages from the cache" % removed)
@@ -0,0 +1,197 @@
+import email.utils
+import logging
+import random
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import profiling
+from page_cache import PageCache
+from rate_limiter import RateLimiter
+
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/61.0.3163.100 Safari/537.36'}
+
+#Responses with these status codes are worth asking for again
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+def parseRetryAfter(value):
+    """Converts a Retry-After header (either seconds or an HTTP date) into a number of seconds to wait."""
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+def retryDelay(attempt, headers, backoff, max_backoff):
+    """Exponential backoff with full jitter, unless the server told us how long to wait in the response headers."""
+    if headers is not None:
+        delay = parseRetryAfter(headers.get('Retry-After'))
+        if delay is not None:
+            return min(delay, max_backoff)
+    return random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+
+def failedStatus(status, attempt, url):
+    """Counts and logs a page that wasn't downloaded because of its HTTP status, returns None in place of its content."""
+    metrics.increment('fetch_errors', label="HTTP " + str(status))
+    if attempt > 0:
+        logging.warning("Request returned HTTP %d after %d retries, skipping it: %s" % (status, attempt, url))
+    else:
+        logging.warning("Request returned HTTP %d, skipping it: %s" % (status, url))
+    return None
+
+class PageFetcher(object):
+    """Downloads pages over one shared keep-alive session, retrying transient failures."""
+
+    def __init__(self, config):
+        self.timeout = config['requestTimeout']
+        self.maxRetries = config['maxRetries']
+        self.backoff = config['retryBackoff']
+        self.maxBackoff = config['retryBackoffMax']
+
+        #One connection per worker thread is enough, extra connections would sit idle
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=config['connectionPoolSize'], pool_maxsize=config['connectionPoolSize'], pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.offline = config['offline']
+        self.cache = None
+        if config['cacheDir']:
+            self.cache = PageCache(config['cacheDir'], config['cacheTTL'], config['cacheMaxSize'])
+        elif self.offline:
+            raise Exception("ERROR: Offline mode needs a cacheDir to read pages from, unable to run!")
+
+        #Paces the downloads so the website doesn't start refusing them
+        self.limiter = RateLimiter(config)
+
+        #Only create a thread pool when more than one page should be downloaded at a time
+        self.pool = None
+        if config['fetchWorkers'] > 1:
+            self.pool = ThreadPoolExecutor(max_workers=config['fetchWorkers'])
+
+    def retryDelay(self, attempt, response):
+        headers = None
+        if response is not None:
+            headers = response.headers
+        return retryDelay(attempt, headers, self.backoff, self.maxBackoff)
+
+    def fetch(self, url):
+        """Returns the raw page content of the given URL, from the cache when possible.
+        In offline mode None is returned for pages that were never cached."""
+        with profiling.scope('fetch'):
+            return self.fetchCached(url)
+
+    def fetchCached(self, url):
+        if self.cache is None:
+            return self.download(url, None)
+
+        entry = self.cache.lookup(url)
+        if self.offline:
+            if entry is None:
+                metrics.increment('cache_lookups', label='miss')
+                logging.warning("Page is not in the cache, skipping it: %s" % url)
+                return None
+            metrics.increment('cache_lookups', label='hit')
+            return entry.content
+        if entry is None:
+            metrics.increment('cache_lookups', label='miss')
+        elif entry.isFresh(self.cache.ttl):
+            metrics.increment('cache_lookups', label='hit')
+            return entry.content
+        return self.download(url, entry)
+
+    def download(self, url, entry):
+        """Downloads the given URL and returns the raw page content. When a stale cache entry is
+        given, the server is asked to only send the page if it changed. Returns None when the page
+        can't be downloaded (an error status, or retries ran out), so one bad page doesn't end the run."""
+        headers = None
+        if entry is not None:
+            headers = entry.validators()
+        limiter = self.limiter.host(url)
+        attempt = 0
+        while True:
+            response = None
+            error = None
+            started = limiter.acquire()
+            try:
+                with metrics.timer('fetch_seconds'):
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                if response is not None:
+                    limiter.release(started, status=response.status_code, retry_after=parseRetryAfter(response.headers.get('Retry-After')))
+                elif error is not None:
+                    limiter.release(started, error=type(error).__name__)
+                else:
+                    limiter.release(started)
+
+            if error is not None:
+                metrics.increment('fetch_errors', label=type(error).__name__)
+                if attempt >= self.maxRetries:
+                    logging.warning("Request failed (%s) after %d retries, skipping it: %s" % (type(error).__name__, attempt, url))
+                    return None
+                reason = type(error).__name__
+            else:
+                metrics.increment('http_responses', label=response.status_code)
+                metrics.increment('fetch_bytes', len(response.content))
+                if (response.status_code == 304) and (entry is not None):
+                    metrics.increment('cache_lookups', label='revalidated')
+                    self.cache.revalidated(entry, response.headers)
+                    return entry.content
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code >= 400:
+                        return failedStatus(response.status_code, attempt, url)
+                    if self.cache is not None:
+                        if entry is not None:
+                            metrics.increment('cache_lookups', label='changed')
+                        self.cache.store(url, response.content, response.headers)
+                    return response.content
+                if attempt >= self.maxRetries:
+                    return failedStatus(response.status_code, attempt, url)
+                reason = "HTTP " + str(response.status_code)
+
+            delay = self.retryDelay(attempt, response)
+            attempt += 1
+            metrics.increment('fetch_retries')
+            logging.warning("Request failed (%s), retry %d of %d in %.1fs: %s" % (reason, attempt, self.maxRetries, delay, url))
+            time.sleep(delay)
+
+    def fetchAll(self, urls):
+        """Downloads each URL, yielding the page contents in the same order as the given URLs.
+        When more than one fetch worker is configured the downloads run concurrently."""
+        if self.pool is None:
+            return map(self.fetch, urls)
+        return self.pool.map(self.fetch, urls)
+
+    def submit(self, url):
+        """Starts downloading the URL on the fetch threads and returns a Future of the page content.
+        Without fetch threads the page is downloaded before returning."""
+        if self.pool is not None:
+            return self.pool.submit(self.fetch, url)
+        future = Future()
+        try:
+            future.set_result(self.fetch(url))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        for line in self.limiter.summary():
+            logging.info(line)
+        self.session.close()
@@ -1,4 +1,58 @@
 import re
+from bs4 import BeautifulSoup, SoupStrainer
+
+import metrics
+import profiling
+
+#lxml is a much faster parser than the one built into Python, but it is optional
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+class SectionStrainer(SoupStrainer):
+    """Only keeps the parts of a page matching one of the given (tag, attribute, value) sections,
+    everything else is thrown away while parsing. Elements nested inside a kept section are kept too."""
+
+    def __init__(self, sections):
+        SoupStrainer.__init__(self)
+        self.sections = sections
+
+    def matchesSection(self, name, attrs):
+        for tag, attr, value in self.sections:
+            if name != tag:
+                continue
+            #While parsing, the class attribute is still the raw space separated string
+            attrValue = attrs.get(attr)
+            if isinstance(attrValue, list):
+                attrValue = " ".join(attrValue)
+            #Every class in the value has to be there, "tab-section active" needs both classes
+            if (attrValue is not None) and set(value.split()).issubset(attrValue.split()):
+                return True
+        return False
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return self.matchesSection(name, attrs or {})
+
+    def allow_string_creation(self, string):
+        return False
+
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        #Used instead of allow_tag_creation by Beautiful Soup versions before 4.13
+        if self.matchesSection(markup_name, markup_attrs):
+            return markup_name
+        return None
+
+#The search result list and the page count of the pagination control
+SEARCH_PAGE_SECTIONS = SectionStrainer([
+    ('div', 'class', 'placardContainer'),
+    ('span', 'class', 'pageRange')
+])
+
+def makeSoup(content, sections):
+    """Parses the raw page content, only building the tree for the given sections."""
+    return BeautifulSoup(content, HTML_PARSER, parse_only=sections)
 
 def addListToRow(key, arr, row):
     for item in arr:
@@ -6,50 +60,111 @@ def addListToRow(key, arr, row):
 
 def parseApartmentPage(soup, out, url, config):
     """Parses the apartment page for information and stores it in the given OutputFile for formatting."""
-    name = scrapeApartmentName(soup)
-    address = scrapeAddress(soup)
-    neighborhood = scrapeNeighborhood(soup)
-    utilities = scrapeUtilities(soup)
-    parking = scrapeParking(soup)
-    pets = scrapePets(soup)
-    monthlyFees = scrapeMonthlyFees(soup)
-    fees = scrapeFees(soup)
-    recreation = scrapeRecreation(soup)
-    features = scrapeFeatures(soup)
-    outdoors = scrapeOutdoors(soup)
-
-    discoveredFloorplans = []
-    floorplans = scrapeFloorplanSoups(soup)
-    for floorplan in floorplans:
-        floorplanName = scrapeFloorplanName(floorplan) #Separate for easier debugging
-        if floorplanName in discoveredFloorplans:
-            continue
-        else:
-            discoveredFloorplans.append(floorplanName)
-
-        row = out.getNewRow()
-
-        row.setApartmentName(name)
-        row.setApartmentURL(url)
-        row.setValue('neighborhood', neighborhood)
-        row.setValue('address', address)
-        addListToRow('utilities', utilities, row)
-        addListToRow('parking', parking, row)
-        addListToRow('pets', pets, row)
-        addListToRow('monthly', monthlyFees, row)
-        addListToRow('fees', fees, row)
-        addListToRow('recreation', recreation, row)
-        addListToRow('features', features, row)
-        addListToRow('outdoors', outdoors, row)
-
-        row.setFloorplanName(floorplanName)
-        row.setValue('price', scrapePrice(floorplan, config))
-        row.setValue('size', scrapeSize(floorplan))
-        row.setValue('bed', scrapeBed(floorplan))
-        row.setValue('bath', scrapeBath(floorplan))
+    with profiling.scope('parse'):
+        apartment = extractApartment(soup, config)
+    writeApartment(out, url, apartment)
+
+def parseApartmentContent(content, config):
+    """Parses the raw apartment page into the plain dict returned by extractApartment.
+    Only takes and returns picklable values so it can run in a worker process."""
+    with profiling.scope('parse'):
+        with metrics.timer('parse_seconds', 'makeSoup'):
+            soup = makeSoup(content, APARTMENT_PAGE_SECTIONS)
+        return extractApartment(soup, config)
+
+def writeApartment(out, url, apartment, status=None):
+    """Stores one row per floorplan of an apartment returned by extractApartment in the given OutputFile.
+    The values shared by every floorplan are stored once in a property row that each floorplan row refers to.
+    The status is only used in incremental mode (e.x. "New" or "Removed")."""
+    with metrics.timer('stage_seconds', 'write'), profiling.scope('write'):
+        writeRows(out, url, apartment, status)
+    metrics.increment('apartments_written')
+    metrics.increment('rows_written', len(apartment['floorplans']))
+
+def writeRows(out, url, apartment, status):
+    property = out.getNewProperty()
+    property.ApartmentName = apartment['name']
+    property.URL = url
+    property.setValue('neighborhood', apartment['neighborhood'])
+    property.setValue('address', apartment['address'])
+    property.setValue('distance', apartment.get('distance'))
+    property.setValue('duration', apartment.get('duration'))
+    addListToRow('utilities', apartment['utilities'], property)
+    addListToRow('parking', apartment['parking'], property)
+    addListToRow('pets', apartment['pets'], property)
+    addListToRow('monthly', apartment['monthly'], property)
+    addListToRow('fees', apartment['fees'], property)
+    addListToRow('recreation', apartment['recreation'], property)
+    addListToRow('features', apartment['features'], property)
+    addListToRow('outdoors', apartment['outdoors'], property)
+    if status is not None:
+        property.setValue('status', status)
+
+    for floorplan in apartment['floorplans']:
+        row = out.getNewRow(property)
+        row.setFloorplanName(floorplan['name'])
+        row.setValue('price', floorplan['price'])
+        row.setValue('size', floorplan['size'])
+        row.setValue('bed', floorplan['bed'])
+        row.setValue('bath', floorplan['bath'])
 
         out.writeRow(row) #Actually save the data to the file
 
+def extractApartment(soup, config):
+    """Reads every field in APARTMENT_FIELDS from the apartment page in a single walk over the tree.
+    Returns a dict of field name to value, 'floorplans' holds one dict per unique floorplan."""
+    with metrics.timer('parse_seconds', 'findSections'):
+        sections = findSections(soup, APARTMENT_FIELDS)
+    apartment = {}
+    for field, section, findAll, normalizer in APARTMENT_FIELDS:
+        with metrics.timer('parse_seconds', normalizer.__name__):
+            apartment[field] = normalizer(sections[field])
+
+    with metrics.timer('parse_seconds', 'readFloorplan'):
+        discoveredFloorplans = set()
+        floorplans = []
+        for floorplan in apartment['floorplans']:
+            floorplanName = readFloorplanName(floorplan) #Separate for easier debugging
+            if floorplanName in discoveredFloorplans:
+                continue
+            else:
+                discoveredFloorplans.add(floorplanName)
+            floorplans.append(readFloorplan(floorplan, floorplanName, config))
+    apartment['floorplans'] = floorplans
+    return apartment
+
+def sectionMatches(tag, attr, value):
+    """Same matching rules as soup.find(name, class_=value) or soup.find(name, id=value)."""
+    attrValue = tag.get(attr)
+    if attrValue is None:
+        return False
+    if isinstance(attrValue, list):
+        #A value with a space in it has to match the whole class string, like "tab-section active"
+        if ' ' in value:
+            return " ".join(attrValue) == value
+        return value in attrValue
+    return attrValue == value
+
+def findSections(soup, fields):
+    """Walks the tree once, collecting the element(s) each field is read from. Fields that only
+    need one element get the first match in document order (or None), the same as soup.find."""
+    found = {}
+    byName = {}
+    for field, section, findAll, normalizer in fields:
+        if section is None:
+            found[field] = None
+            continue
+        found[field] = [] if findAll else None
+        byName.setdefault(section[0], []).append((field, section[1], section[2], findAll))
+
+    for tag in soup.find_all(list(byName)):
+        for field, attr, value, findAll in byName[tag.name]:
+            if findAll:
+                if sectionMatches(tag, attr, value):
+                    found[field].append(tag)
+            elif (found[field] is None) and sectionMatches(tag, attr, value):
+                found[field] = tag
+    return found
 
 def simplify(text):
     """Given text scraped from a website, simplify the text by removing unnecessary whitespace and bullets."""
@@ -71,9 +186,15 @@ def simplify(text):
 
     return data #str(data).encode('utf-8')
 
+# Each scrape function below searches the whole soup for its section and hands it to the matching
+# read function. parseApartmentPage doesn't use the scrape functions, it finds every section in
+# one pass (see APARTMENT_FIELDS) and calls the read functions directly.
+
 def scrapeApartmentName(soup):
     """Scrapes the apartment name from the soup."""
-    obj = soup.find('h1', class_='propertyName')
+    return readApartmentName(soup.find('h1', class_='propertyName'))
+
+def readApartmentName(obj):
     if obj is not None:
         text = obj.getText()
         if text is not None:
@@ -82,9 +203,11 @@ def scrapeApartmentName(soup):
 
 def scrapeAddress(soup):
     """Scrapes the full address from the soup."""
+    return readAddress(soup.find('div', class_='propertyAddressContainer'))
+
+def readAddress(obj):
     address = []
 
-    obj = soup.find('div', class_='propertyAddressContainer')
     if obj is not None:
         obj = obj.find('h2')
         if obj is not None:
@@ -99,13 +222,32 @@ def scrapeAddress(soup):
 
 def scrapeNeighborhood(soup):
     """Scrapes the neighborhood data from the soup."""
-    obj = soup.find('a', class_='neighborhood')
+    return readNeighborhood(soup.find('a', class_='neighborhood'))
+
+def readNeighborhood(obj):
     if obj is not None:
         return simplify(obj.getText())    
 
+def scrapeLatitude(soup):
+    """Scrapes the latitude of the apartment from the page's location meta tag."""
+    return readCoordinate(soup.find('meta', property='place:location:latitude'))
+
+def scrapeLongitude(soup):
+    return readCoordinate(soup.find('meta', property='place:location:longitude'))
+
+def readCoordinate(obj):
+    if obj is not None:
+        try:
+            return float(obj.get('content', ''))
+        except ValueError:
+            pass
+    return None
+
 def scrapeUtilities(soup):
+    return readUtilities(soup.find('div', class_='freeUtilities'))
+
+def readUtilities(obj):
     utilities = []
-    obj = soup.find('div', class_='freeUtilities')
     if obj is not None:
         obj = obj.find('div', class_='descriptionWrapper')
         if obj is not None:
@@ -129,7 +271,9 @@ def scrapeUtilities(soup):
     return []
 
 def filterV2FeesWrapper(soup, desiredHeader):
-    feedObj = soup.find('div', id='profileV2FeesWrapper')
+    return findFeesCard(soup.find('div', id='profileV2FeesWrapper'), desiredHeader)
+
+def findFeesCard(feedObj, desiredHeader):
     if feedObj is not None:
         for card in feedObj.find_all('div', class_='feesPoliciesCard'):
             obj = card.find('h4', class_='header-column')
@@ -140,8 +284,11 @@ def filterV2FeesWrapper(soup, desiredHeader):
 
 
 def scrapeParking(soup):
+    return readParking(soup.find('div', id='profileV2FeesWrapper'))
+
+def readParking(feesWrapper):
     parking = []
-    obj = filterV2FeesWrapper(soup, 'Parking')
+    obj = findFeesCard(feesWrapper, 'Parking')
     if obj is not None:
         obj = obj.find_all('li')
         for parkingType in obj:
@@ -162,8 +309,10 @@ def scrapeParking(soup):
     return []
 
 def scrapePets(soup):
+    return readPets(soup.find_all('div', class_='petPolicyDetails'))
+
+def readPets(obj):
     pets = []
-    obj = soup.find_all('div', class_='petPolicyDetails')
     if obj is not None:
         for details in obj:
             detailObj = details.find('p')
@@ -179,8 +328,10 @@ def scrapePets(soup):
     return []
 
 def scrapeMonthlyFees(soup):
+    return readMonthlyFees(soup.find('div', class_='monthlyFees'))
+
+def readMonthlyFees(obj):
     fees = []
-    obj = soup.find('div', class_='monthlyFees')
     if obj is not None:
             for expense in obj.find_all('div', class_='descriptionWrapper'):
                 spans = expense.find_all('span')
@@ -201,8 +352,10 @@ def scrapeMonthlyFees(soup):
     return []
 
 def scrapeFees(soup):
+    return readFees(soup.find('div', class_='oneTimeFees'))
+
+def readFees(obj):
     fees = []
-    obj = soup.find('div', class_='oneTimeFees')
     if obj is not None:
             for expense in obj.find_all('div', class_='descriptionWrapper'):
                 spans = expense.find_all('span')
@@ -248,14 +401,30 @@ def scrapeOutdoors(soup):
 
 def scrapeFloorplanSoups(soup):
     """Returns a list of soups, one per floorplan"""
-    obj = soup.find('div', class_='tab-section active')
+    return readFloorplanSoups(soup.find('div', class_='tab-section active'))
+
+def readFloorplanSoups(obj):
     if obj is not None:
         floorplans = obj.find_all('div', class_='pricingGridItem')
         if floorplans is not None:
             return floorplans
     return []
 
+def readFloorplan(floorplan, floorplanName, config):
+    """Reads all of the floorplan values. The details text is only read once and shared by size, bed and bath."""
+    details = readDetailsText(floorplan)
+    return {
+        'name': floorplanName,
+        'price': scrapePrice(floorplan, config),
+        'size': readSize(details),
+        'bed': readBed(details),
+        'bath': readBath(details)
+    }
+
 def scrapeFloorplanName(floorplan):
+    return readFloorplanName(floorplan)
+
+def readFloorplanName(floorplan):
     if floorplan is not None:
         obj = floorplan.find('span', class_='modelName')
         if obj is not None:
@@ -266,100 +435,145 @@ def scrapePrice(floorplan, config):
     if floorplan is not None:
         obj = floorplan.find('span', class_='rentLabel')
         if obj is not None:
-            text = simplify(obj.getText().replace("\u2013", "-"))
-            text = text.replace('$', "")
-            text = text.replace(",", "")
-            rent = 0
-            split = text.find('-')
-            if split > -1:
-                rent1 = int(text[:split].strip())
-                rent2 = int(text[split + 1:].strip())
-                if config['priceSelector'] == 'lowest':
-                    rent = min(rent1, rent2)
-                elif config['priceSelector'] == 'highest':
-                    rent = max(rent1, rent2)
-                elif config['priceSelector'] == 'average':
-                    rent = (rent1 + rent2) // 2
-                else:
-                    raise Exception("ERROR: Invalid priceSelector value.")
-            else:
-                try:
-                    rent = int(text.strip())
-                except ValueError:
-                    rent = 0
-            return str(rent)
+            return readPrice(obj.getText(), config)
     return '0'
 
-def findSizeInList(soup, names):
-    for obj in soup.find_all('span'):
-        text = obj.getText()
-        if text is None:
-            continue
-        text = simplify(text.replace("\u0189", ".5").replace("\u2013", "-")) #Replace the 1/2 fraction character and fancy hyphen with a normal one
+def readPrice(text, config):
+    """Reads the rent from text like "$1,200", "$856 – $985", "1,200 - 1,500" or "Starting at $1,200 / Person".
+    Dollar amounts are rents, and so are numbers without a $ that look like one (a thousands separator or at
+    least three digits), so small numbers like "for 12 mo" don't matter. No rent (e.x. "Call for Rent") is '0'."""
+    amounts = re.findall(r'\$\s*([0-9][0-9,]*)|(?<![0-9.,])([0-9]{1,3}(?:,[0-9]{3})+|[0-9]{3,})(?![0-9])', simplify(text))
+    rents = [int((dollars or number).replace(",", "")) for dollars, number in amounts]
+    rent = 0
+    if len(rents) >= 2:
+        rent1, rent2 = rents[0], rents[1]
+        if config['priceSelector'] == 'lowest':
+            rent = min(rent1, rent2)
+        elif config['priceSelector'] == 'highest':
+            rent = max(rent1, rent2)
+        elif config['priceSelector'] == 'average':
+            rent = (rent1 + rent2) // 2
+        else:
+            raise Exception("ERROR: Invalid priceSelector value.")
+    elif len(rents) == 1:
+        rent = rents[0]
+    return str(rent)
+
+def readDetailsText(floorplan):
+    """Returns the simplified text of every span in the floorplan details, or None if there are no details."""
+    if floorplan is not None:
+        obj = floorplan.find('span', class_='detailsTextWrapper')
+        if obj is not None:
+            texts = []
+            for span in obj.find_all('span'):
+                text = span.getText()
+                if text is None:
+                    continue
+                texts.append(simplify(text.replace("\u0189", ".5").replace("\u2013", "-"))) #Replace the 1/2 fraction character and fancy hyphen with a normal one
+            return texts
+    return None
+
+def findTextEndingWith(texts, names):
+    for text in texts:
         for name in names:
             if name and text.endswith(name):
                 return text
 
 def scrapeSize(floorplan):
-    if floorplan is not None:
-        obj = floorplan.find('span', class_='detailsTextWrapper')
-        if obj is not None:
-            text = findSizeInList(obj, ["sq ft"])
-            if not text:
-                return '0'
-            text = text.strip("sq ft").strip().replace(",", "")
-            split = text.find('-')
+    return readSize(readDetailsText(floorplan))
+
+def readSize(details):
+    if details is not None:
+        text = findTextEndingWith(details, ["sq ft"])
+        if not text:
+            return '0'
+        text = text.strip("sq ft").strip().replace(",", "")
+        split = text.find('-')
+        size = 0
+        try:
+            if split > -1:
+                size1 = int(text[:split].strip())
+                size2 = int(text[split + 1:].strip())
+                size = (size1 + size2) // 2
+            else:
+                size = int(text.strip())
+        except ValueError:
             size = 0
-            try:
-                if split > -1:
-                    size1 = int(text[:split].strip())
-                    size2 = int(text[split + 1:].strip())
-                    size = (size1 + size2) // 2
-                else:
-                    size = int(text.strip())
-            except ValueError:
-                size = 0
-            return str(size)
+        return str(size)
     return '0'
 
 def scrapeBed(floorplan):
-    if floorplan is not None:
-        obj = floorplan.find('span', class_='detailsTextWrapper')
-        if obj is not None:
-            text = findSizeInList(obj, ["bed", "beds", "studio"])
-            if not text:
-                return '0'
-            text = text.lower()
-            data = text.split()
-            beds = text
-            if len(data) >= 1:
-                beds = data[0]
-            if 'studio' in beds.lower():
-                beds = '1'
-            try:
-                float(beds)
-                return beds
-            except ValueError:
-                return '0'
+    return readBed(readDetailsText(floorplan))
+
+def readBed(details):
+    if details is not None:
+        text = findTextEndingWith(details, ["bed", "beds", "studio"])
+        if not text:
+            return '0'
+        text = text.lower()
+        data = text.split()
+        beds = text
+        if len(data) >= 1:
+            beds = data[0]
+        if 'studio' in beds.lower():
+            beds = '1'
+        try:
+            float(beds)
+            return beds
+        except ValueError:
+            return '0'
     return '0'
 
 def scrapeBath(floorplan):
-    if floorplan is not None:
-        obj = floorplan.find('span', class_='detailsTextWrapper')
-        if obj is not None:
-            text = findSizeInList(obj, ["bath", "baths", "studio"])
-            if not text:
-                return '0'
-            text = text.lower()
-            data = text.split()
-            baths = text
-            if len(data) >= 1:
-                baths = data[0]
-            if 'studio' in baths.lower():
-                baths = '1'
-            try:
-                float(baths)
-                return baths
-            except ValueError:
-                return '0'
-    return '0'
\ No newline at end of file
+    return readBath(readDetailsText(floorplan))
+
+def readBath(details):
+    if details is not None:
+        text = findTextEndingWith(details, ["bath", "baths", "studio"])
+        if not text:
+            return '0'
+        text = text.lower()
+        data = text.split()
+        baths = text
+        if len(data) >= 1:
+            baths = data[0]
+        if 'studio' in baths.lower():
+            baths = '1'
+        try:
+            float(baths)
+            return baths
+        except ValueError:
+            return '0'
+    return '0'
+
+def noValues(obj):
+    return []
+
+#Every value read from an apartment page: field name, the (tag, attribute, value) section it is read from,
+#whether every matching section is needed (instead of just the first), and the function that reads it.
+#A section of None means the field isn't scraped yet.
+APARTMENT_FIELDS = [
+    ('name', ('h1', 'class', 'propertyName'), False, readApartmentName),
+    ('address', ('div', 'class', 'propertyAddressContainer'), False, readAddress),
+    ('neighborhood', ('a', 'class', 'neighborhood'), False, readNeighborhood),
+    ('latitude', ('meta', 'property', 'place:location:latitude'), False, readCoordinate),
+    ('longitude', ('meta', 'property', 'place:location:longitude'), False, readCoordinate),
+    ('utilities', ('div', 'class', 'freeUtilities'), False, readUtilities),
+    ('parking', ('div', 'id', 'profileV2FeesWrapper'), False, readParking),
+    ('pets', ('div', 'class', 'petPolicyDetails'), True, readPets),
+    ('monthly', ('div', 'class', 'monthlyFees'), False, readMonthlyFees),
+    ('fees', ('div', 'class', 'oneTimeFees'), False, readFees),
+    ('recreation', None, False, noValues),
+    ('features', None, False, noValues),
+    ('outdoors', None, False, noValues),
+    ('floorplans', ('div', 'class', 'tab-section active'), False, readFloorplanSoups)
+]
+
+#Only the sections listed in APARTMENT_FIELDS are kept when parsing an apartment page
+APARTMENT_PAGE_SECTIONS = SectionStrainer([section for field, section, findAll, normalizer in APARTMENT_FIELDS if section is not None])
+
+#Increase when a parser change reads different values from the same page, so incremental runs read stored pages again
+PARSER_VERSION = 4
+
+#The options that change the apartment stored for a page
+EXTRACTION_OPTIONS = ['priceSelector', 'separateUtilities', 'separatePets', 'separateParking']
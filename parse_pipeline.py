@@ -0,0 +1,91 @@
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import metrics
+import parse_apartments as parsing
+
+def parseMeasured(content, config, function=parsing.parseApartmentContent, stage='parse'):
+    """Runs parseApartmentContent (or another function(content, config)) in a worker process while recording
+    metrics there. Returns its result and a snapshot of the metrics, which the main process adds to its own."""
+    metrics.registry = metrics.Metrics()
+    try:
+        with metrics.timer('stage_seconds', stage):
+            result = function(content, config)
+        return result, metrics.registry.snapshot()
+    finally:
+        metrics.disable()
+
+class ParsePipeline(object):
+    """Downloads and parses apartment pages in three stages:
+    the fetch threads download the raw pages, a pool of parser processes turns each page into a
+    plain apartment dict, and the caller writes the results in the original listing order.
+    At most queueSize listings are in flight at once so memory use stays flat on long runs."""
+
+    def __init__(self, fetcher, state, config):
+        self.fetcher = fetcher
+        self.state = state
+        self.config = config
+        self.queueSize = config['pipelineQueueSize']
+        self.parsers = ProcessPoolExecutor(max_workers=config['parseWorkers'])
+
+    def submit(self, url):
+        """Returns a Future of (apartment, content hash). The apartment is None if the page couldn't be read,
+        the content hash is only known in incremental mode."""
+        result = Future()
+        contentHash = None
+
+        def parsed(parseFuture):
+            try:
+                result.set_result((parseFuture.result(), contentHash))
+            except Exception as e:
+                result.set_exception(e)
+
+        def parsedMeasured(parseFuture):
+            try:
+                apartment, snapshot = parseFuture.result()
+                metrics.registry.merge(snapshot)
+                result.set_result((apartment, contentHash))
+            except Exception as e:
+                result.set_exception(e)
+
+        def fetched(fetchFuture):
+            nonlocal contentHash
+            try:
+                content = fetchFuture.result()
+                if content is None:
+                    result.set_result((None, None))
+                    return
+                if self.state is not None:
+                    #Pages that didn't change since the last run don't need to be read again
+                    contentHash, apartment = self.state.unchangedApartment(url, content)
+                    if apartment is not None:
+                        result.set_result((apartment, contentHash))
+                        return
+                if metrics.enabled():
+                    self.parsers.submit(parseMeasured, content, self.config).add_done_callback(parsedMeasured)
+                else:
+                    self.parsers.submit(parsing.parseApartmentContent, content, self.config).add_done_callback(parsed)
+            except Exception as e:
+                result.set_exception(e)
+
+        self.fetcher.submit(url).add_done_callback(fetched)
+        return result
+
+    def run(self, listings):
+        """Given a list of (name, url) listings, yields (name, url, apartment, content hash) in the same order."""
+        inFlight = collections.deque()
+        listings = iter(listings)
+        while True:
+            #Keep the pipeline full, but never more than queueSize listings ahead of the writer
+            for name, url in listings:
+                inFlight.append((name, url, self.submit(url)))
+                if len(inFlight) >= self.queueSize:
+                    break
+            if not inFlight:
+                return
+            name, url, future = inFlight.popleft()
+            apartment, contentHash = future.result()
+            yield name, url, apartment, contentHash
+
+    def close(self):
+        self.parsers.shutdown(cancel_futures=True)
@@ -0,0 +1,201 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+
+#The parts of a run that can be profiled on their own, 'all' profiles the whole run
+PROFILE_STAGES = ['all', 'fetch', 'parse', 'write']
+
+#Seconds between two samples of the running threads' stacks
+SAMPLE_INTERVAL = 0.005
+
+#Since Python 3.12 only one cProfile profiler can be enabled in a process at a time
+PROFILE_EVERY_THREAD = sys.version_info < (3, 12)
+
+class StageProfile(object):
+    """Profiles the code running inside scope() blocks of one stage, in every thread that enters one.
+    Each thread gets its own cProfile profiler, and a background thread samples the stacks of the
+    threads inside a scope for a flame graph. Where only one profiler can run at a time (Python 3.12+),
+    only the first thread to enter a scope is profiled with cProfile, the others are only sampled."""
+
+    def __init__(self, stage, interval=SAMPLE_INTERVAL):
+        self.stage = stage
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []
+        self.inside = {} #Thread id -> how many scopes it is nested in
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name='profile-sampler')
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def covers(self, stage):
+        return (self.stage == 'all') or (self.stage == stage)
+
+    def enter(self):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            with self.lock:
+                if PROFILE_EVERY_THREAD or not self.profiles:
+                    profile = cProfile.Profile()
+                    self.profiles.append(profile)
+                else:
+                    profile = False
+            if profile is False:
+                self.skip("only one thread can be profiled at a time on Python %d.%d" % sys.version_info[:2])
+            self.local.profile = profile
+        ident = threading.get_ident()
+        with self.lock:
+            depth = self.inside.get(ident, 0)
+            self.inside[ident] = depth + 1
+        if (depth == 0) and profile:
+            try:
+                profile.enable()
+            except ValueError as e:
+                #Another profiler is already running, e.x. the script was started under python -m cProfile
+                self.local.profile = False
+                with self.lock:
+                    self.profiles.remove(profile)
+                self.skip(str(e))
+
+    def skip(self, reason):
+        logging.info("Thread %s is left out of the cProfile results of the %s profile (%s), the stack samples still cover it"
+                     % (threading.current_thread().name, self.stage, reason))
+
+    def exit(self):
+        ident = threading.get_ident()
+        with self.lock:
+            depth = self.inside[ident] - 1
+            if depth == 0:
+                del self.inside[ident]
+            else:
+                self.inside[ident] = depth
+        if (depth == 0) and self.local.profile:
+            self.local.profile.disable()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                threads = list(self.inside)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            stacks = []
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks.append(collapsedStack(frame))
+            with self.lock:
+                for stack in stacks:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def stats(self):
+        """The cProfile results of every thread combined, None if no scope of the stage was entered."""
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return None
+        return pstats.Stats(*profiles)
+
+    def save(self, output_name):
+        """Writes <output_name>.profile-<stage>.pstats for pstats/snakeviz and <output_name>.profile-<stage>.collapsed
+        with one "frame;frame;frame count" line per sampled stack, for flamegraph.pl or speedscope.
+        Returns the paths of the files written."""
+        base = output_name + ".profile-" + self.stage
+        paths = []
+        stats = self.stats()
+        if stats is None:
+            logging.warning("Nothing was profiled, the '%s' stage never ran" % self.stage)
+            return paths
+        stats.dump_stats(base + ".pstats")
+        paths.append(base + ".pstats")
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        with open(base + ".collapsed", 'w') as f:
+            for stack, count in stacks:
+                f.write("%s %d\n" % (stack, count))
+        paths.append(base + ".collapsed")
+        return paths
+
+    def summary(self, limit=25):
+        """The functions that took the most time, including the functions they called."""
+        stats = self.stats()
+        if stats is None:
+            return ""
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(limit)
+        return text.getvalue()
+
+def frameName(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+def collapsedStack(frame):
+    names = []
+    while frame is not None:
+        names.append(frameName(frame).replace(';', ':'))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+class NullScope(object):
+    """Used in place of a Scope when the stage isn't profiled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SCOPE = NullScope()
+
+class Scope(object):
+    """Profiles a block of code: with profiling.scope('parse'): ..."""
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __enter__(self):
+        self.profile.enter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.exit()
+        return False
+
+#The profile of this process, None while not profiling so scope() returns right away
+active = None
+
+def start(stage, interval=SAMPLE_INTERVAL):
+    global active
+    if stage not in PROFILE_STAGES:
+        raise Exception("ERROR: Unknown profile stage \'" + stage + "\', use one of " + ", ".join(PROFILE_STAGES))
+    if active is None:
+        active = StageProfile(stage, interval)
+    return active
+
+def stop():
+    """Stops sampling and returns the profile, which can still be saved."""
+    global active
+    profile = active
+    active = None
+    if profile is not None:
+        profile.stop()
+    return profile
+
+def scope(stage):
+    if (active is None) or not active.covers(stage):
+        return NULL_SCOPE
+    return Scope(active)
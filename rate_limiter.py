@@ -0,0 +1,229 @@
+import collections
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import metrics
+
+#Responses that mean the server is overloaded or throttling us
+OVERLOAD_STATUSES = [429, 502, 503, 504]
+
+#How much the limits shrink after an overload response or error, and after the server slowed down
+OVERLOAD_DECREASE = 0.5
+LATENCY_DECREASE = 0.8
+
+#The server counts as slowed down when the average of the last few response times grows past this many times
+#the long running average. Both are moving averages, LATENCY_SMOOTHING is the weight of each new response.
+LATENCY_FACTOR = 2.0
+LATENCY_SMOOTHING = 0.2
+BASELINE_SMOOTHING = 0.02
+LATENCY_SAMPLES = 5
+
+#The request rate never goes below this many requests per second
+MIN_RATE = 0.2
+
+#How far back requests are counted to know the current request rate, in seconds
+RATE_WINDOW = 5.0
+
+class HostLimiter(object):
+    """Paces the requests to one host with a token bucket and a limit on the requests running at once.
+
+    With adaptive limits both grow additively while responses are healthy (about one more request at once per
+    round of requests, about one more request per second every second, but doubling every round before the first
+    decrease) and shrink multiplicatively when the server
+    answers 429/5xx, a request fails, or responses get much slower. Without requestsPerSecond the rate is only
+    limited once the server answers 429 or sends Retry-After. Only responses to requests started after the last
+    decrease can shrink the limits again, so one burst of errors counts once."""
+
+    def __init__(self, host, max_concurrency, max_rate, adaptive, initial_concurrency=None, max_pause=None):
+        self.host = host
+        self.maxConcurrency = max_concurrency
+        self.maxRate = max_rate #None when only the server's responses limit the rate
+        self.adaptive = adaptive
+        self.maxPause = max_pause #The longest Retry-After followed, None for no limit
+        self.condition = threading.Condition()
+
+        self.concurrency = float(initial_concurrency or max_concurrency)
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.inFlight = 0
+        self.pausedUntil = 0.0
+        self.lastDecrease = 0.0
+        self.started = collections.deque() #Start times of the requests in the last RATE_WINDOW seconds
+        self.firstStarted = None
+
+        self.latency = None
+        self.baseline = None
+        self.samples = 0
+        self.decreases = 0
+        self.lastLogged = 0.0
+        self.publish()
+
+    def acquire(self):
+        """Waits until a request to the host is allowed. Returns the start time to pass to release()."""
+        waited = 0.0
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                delay = self.tryAcquire(now)
+                if delay == 0.0:
+                    break
+                if delay is None:
+                    self.condition.wait()
+                else:
+                    self.condition.wait(delay)
+                waited += time.monotonic() - now
+        if waited > 0.0:
+            metrics.observe('limiter_wait_seconds', waited, self.host)
+        return now
+
+    def tryAcquire(self, now):
+        """Starts a request at the given time and returns 0 if it is allowed, otherwise returns what delay() does
+        without starting it. Must be called holding the condition, for callers that wait their own way."""
+        delay = self.delay(now)
+        if delay != 0.0:
+            return delay
+        if self.rate is not None:
+            self.tokens -= 1.0
+        self.inFlight += 1
+        self.started.append(now)
+        while self.started[0] < (now - RATE_WINDOW):
+            self.started.popleft()
+        if self.firstStarted is None:
+            self.firstStarted = now
+        return 0.0
+
+    def delay(self, now):
+        """Seconds until the next request may start, 0 if it may start now, None to wait for a request to finish."""
+        if now < self.pausedUntil:
+            return self.pausedUntil - now
+        if self.inFlight >= max(int(self.concurrency), 1):
+            return None
+        if self.rate is None:
+            return 0.0
+        burst = max(self.rate, 1.0)
+        self.tokens = min(self.tokens + (now - self.refilled) * self.rate, burst)
+        self.refilled = now
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def release(self, started, status=None, error=None, retry_after=None):
+        """Records how a request started at the given time ended: the HTTP status of the response, or the name
+        of the error when there was no response. The Retry-After seconds are only used with an overload status."""
+        now = time.monotonic()
+        with self.condition:
+            self.inFlight -= 1
+            if (retry_after is not None) and (status in OVERLOAD_STATUSES):
+                #The server said when it takes requests again, none are sent to it before then
+                if self.maxPause is not None:
+                    retry_after = min(retry_after, self.maxPause)
+                self.pausedUntil = max(self.pausedUntil, now + retry_after)
+            if self.adaptive and ((status is not None) or (error is not None)):
+                if (error is not None) or (status in OVERLOAD_STATUSES):
+                    #A fixed rate is only started when the server asks for fewer requests, otherwise less at once is enough
+                    throttled = (status == 429) or (retry_after is not None)
+                    self.decrease(started, now, OVERLOAD_DECREASE, throttled or (self.rate is not None), error or ("HTTP " + str(status)))
+                elif status < 500:
+                    self.observeLatency(started, now)
+            self.condition.notify_all()
+
+    def observeLatency(self, started, now):
+        latency = now - started
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        if self.baseline is None:
+            self.baseline = latency
+        else:
+            self.baseline += BASELINE_SMOOTHING * (latency - self.baseline)
+        self.samples += 1
+        #Only compared once the recent average covers a few responses
+        if (self.samples >= LATENCY_SAMPLES) and (self.latency > LATENCY_FACTOR * self.baseline) and (int(self.concurrency) > 1):
+            self.decrease(started, now, LATENCY_DECREASE, False, "responses slowed from %.2fs to %.2fs" % (self.baseline, self.latency))
+        else:
+            self.increase(now)
+
+    def increase(self, now):
+        before = int(self.concurrency)
+        if self.decreases == 0:
+            #Until the host first pushes back, one more request at once per response doubles the limit every round
+            self.concurrency = min(self.concurrency + 1.0, float(self.maxConcurrency))
+        else:
+            self.concurrency = min(self.concurrency + 1.0 / self.concurrency, float(self.maxConcurrency))
+        if self.rate is not None:
+            self.rate = self.rate + 1.0 / self.rate
+            if self.maxRate is not None:
+                self.rate = min(self.rate, self.maxRate)
+        if (int(self.concurrency) > before) and ((now >= self.lastLogged + 1.0) or (int(self.concurrency) == self.maxConcurrency)):
+            self.lastLogged = now
+            logging.info("Speeding up requests to %s: %s" % (self.host, self.describe()))
+        self.publish()
+
+    def decrease(self, started, now, factor, slowRate, reason):
+        if started < self.lastDecrease:
+            return #Sent before the last decrease, the limits already account for it
+        self.lastDecrease = now
+        self.decreases += 1
+        self.concurrency = max(self.concurrency * factor, 1.0)
+        if slowRate:
+            if self.rate is None:
+                #Start limiting the rate from half of what the server just refused
+                window = max(min(now - self.firstStarted, RATE_WINDOW), 0.1)
+                self.rate = len(self.started) / window
+                self.tokens = min(self.tokens, 1.0)
+            self.rate = max(self.rate * factor, MIN_RATE)
+        #Responses from before the decrease don't say how fast the server is now
+        self.latency = None
+        self.samples = 0
+        metrics.increment('limiter_decreases', label=self.host)
+        logging.info("Slowing down requests to %s (%s): %s" % (self.host, reason, self.describe()))
+        self.publish()
+
+    def describe(self):
+        text = "%d at once" % max(int(self.concurrency), 1)
+        if self.rate is not None:
+            text += ", %.1f requests/s" % self.rate
+        return text
+
+    def publish(self):
+        metrics.gauge('limiter_concurrency', max(int(self.concurrency), 1), self.host)
+        if self.rate is not None:
+            metrics.gauge('limiter_rate', self.rate, self.host)
+
+class RateLimiter(object):
+    """Keeps one HostLimiter per host, so a slow or throttling host doesn't hold back the others."""
+
+    def __init__(self, config, max_concurrency=None):
+        """By default up to fetchWorkers requests run at once. With a higher max_concurrency adaptive limits
+        start at fetchWorkers and only grow past it while the host keeps up."""
+        self.maxConcurrency = max_concurrency or config['fetchWorkers']
+        self.maxRate = config['requestsPerSecond'] or None
+        self.adaptive = config['adaptiveRate']
+        self.maxPause = config['retryBackoffMax'] #Same limit as the wait before a retry
+        self.initialConcurrency = self.maxConcurrency
+        if self.adaptive:
+            self.initialConcurrency = min(config['fetchWorkers'], self.maxConcurrency)
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def host(self, url):
+        name = urlsplit(url).netloc
+        with self.lock:
+            limiter = self.hosts.get(name)
+            if limiter is None:
+                limiter = HostLimiter(name, self.maxConcurrency, self.maxRate, self.adaptive, self.initialConcurrency, self.maxPause)
+                self.hosts[name] = limiter
+            return limiter
+
+    def summary(self):
+        with self.lock:
+            limiters = list(self.hosts.values())
+        lines = []
+        for limiter in limiters:
+            if limiter.decreases > 0:
+                lines.append("Requests to %s were slowed down %d times, ended at %s" % (limiter.host, limiter.decreases, limiter.describe()))
+        return lines
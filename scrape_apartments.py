@@ -1,15 +1,25 @@
 """Parse an apartments.com search result page and export to CSV."""
 
+import argparse
 import csv
 import json
 import sys
 import datetime
-import requests
 import os
 import traceback
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 import parse_apartments as parsing
-from output_formatter import OutputFile
+import metrics
+import profiling
+from output_formatter import OutputFile, FORMULA_STYLES
+from page_fetcher import PageFetcher
+from commute import parseDestinations
+from parse_pipeline import ParsePipeline
+from scrape_engine import ApartmentLocations, finishApartments, newListings, readListings, readPageCount, searchPageURL
+from state_store import StateStore
+from checkpoint import Checkpoint
+from dedup import SeenSet
+from output_sinks import OUTPUT_FORMATS, openOutputs, outputPaths
 import logging
 
 # Config parser was renamed in Python 3
@@ -18,110 +28,233 @@ try:
 except ImportError:
     import ConfigParser as configparser
 
-def scrapeApartments(out, search_urls, max_pages, ignore_duplicates, config):
+class ScrapeRun(object):
+    """The output file and helpers shared by every search page of a run."""
+
+    def __init__(self, out, config, checkpoint):
+        self.out = out
+        self.checkpoint = checkpoint
+        self.fetcher = PageFetcher(config) #Shared by every request so connections are reused
+        self.searchPool = ThreadPoolExecutor(max_workers=1) #Downloads the next search page ahead of time
+        self.state = None
+        if config['incremental']:
+            self.state = StateStore(config['stateFile'], config)
+            if checkpoint is not None:
+                #Listings seen before the run was interrupted still count as seen by this run
+                self.state.runStart = checkpoint.runStart()
+        self.pipeline = None
+        if config['parseWorkers'] > 0:
+            self.pipeline = ParsePipeline(self.fetcher, self.state, config)
+        self.locations = ApartmentLocations(config)
+
+    def close(self):
+        if self.pipeline is not None:
+            self.pipeline.close()
+        self.locations.close()
+        self.searchPool.shutdown(cancel_futures=True)
+        if self.state is not None:
+            self.state.close()
+        self.fetcher.close()
+
+def scrapeApartments(out, search_urls, max_pages, ignore_duplicates, config, checkpoint=None):
     """goes through each apartment search page URL and scrapes the data"""
     # parse current entire apartment list including pagination for all search urls
-    apartments = [] #List of visited apartment URLs to avoid duplicate entries
-    for url in search_urls:
-        url = url.strip()
-        if not url.endswith('/'):
-            url = url + '/'
-        scrapeSearchPage(out, url, 1, max_pages, ignore_duplicates, apartments, config)
-
-
-def scrapeSearchPage(out, page_url, page_num, max_pages, ignore_duplicates, apartmentList, config):
-    """Given the current page URL, extract the information from each apartment in the list"""
-    url = page_url
-    metadata = url.find('?')
-    if metadata > -1:
-        url = url[:metadata] + str(page_num) + "/" + url[metadata:]
-    else:
-        if not url.endswith("/"):
-            url += "/"
-        url += str(page_num) + "/"
+    apartments = SeenSet(config['seenFile']) #Set of visited apartment URLs to avoid duplicate entries
+    run = ScrapeRun(out, config, checkpoint)
+    try:
+        if checkpoint is not None:
+            apartments.update(checkpoint.visited())
+            #The output file is new, so everything saved before the interruption is written again
+            run.locations.add([row['apartment'] for row in checkpoint.resumedRows])
+            for row in checkpoint.resumedRows:
+                apartments.addApartment(row['url'], row['apartment'])
+                parsing.writeApartment(out, row['url'], row['apartment'], row['status'])
+            apartments.commit(checkpoint.visited())
 
-    logging.info("Now getting apartments from page " + str(page_num) + ": %s" % url)
+        for url in search_urls:
+            url = url.strip()
+            if not url.endswith('/'):
+                url = url + '/'
+            page_num = 1
+            if checkpoint is not None:
+                if checkpoint.isSearchDone(url):
+                    continue
+                page_num = checkpoint.nextPage(url)
+            if (max_pages == 0) or (page_num <= max_pages):
+                scrapeSearchPage(run, url, page_num, max_pages, ignore_duplicates, apartments, config)
 
-    # read the current page
-    headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/61.0.3163.100 Safari/537.36'}
-    page = requests.get(url, headers=headers)
- 
-    # soupify the current page
-    soup = BeautifulSoup(page.content, 'html.parser')
-    soup.prettify()
-
-    # get the element that contains the apartment list
-    soup = soup.find('div', class_='placardContainer')
-
-    # append the current apartments to the list
-    for item in soup.find_all('article', class_='placard'):
-        data_url = item.get('data-url')
-        if data_url is None: 
-            continue
+        #Only reached when every search finished, otherwise listings that weren't reached would look removed
+        if run.state is not None:
+            removed = run.state.markRemoved()
+            run.locations.add([apartment for data_url, apartment in removed])
+            for data_url, apartment in removed:
+                logging.info("No longer listed: %s" % apartment['name'])
+                parsing.writeApartment(out, data_url, apartment, "Removed")
+    finally:
+        run.close()
+        apartments.close()
 
-        # get the name for user/debug info
-        name = "N/A"
-        obj = item.find('span', class_='js-placardTitle')
-        if obj is not None:
-            name = obj.getText().strip()
+def parseListings(listings, run, config):
+    """Downloads and parses the apartment page of each (name, url) listing. Yields (name, url, apartment, content hash)
+    in the same order as the listings, apartment is None if the page couldn't be read. The content hash is only
+    known in incremental mode, where pages that didn't change since the last run aren't parsed again."""
+    if run.pipeline is not None:
+        for result in run.pipeline.run(listings):
+            yield result
+        return
 
-        if ignore_duplicates and (data_url in apartmentList):
-            logging.info('Skipping duplicate: %s' % name)
+    pages = run.fetcher.fetchAll([data_url for name, data_url in listings])
+    for (name, data_url), apartmentPage in zip(listings, pages):
+        if apartmentPage is None:
+            yield name, data_url, None, None
             continue
+        contentHash = None
+        if run.state is not None:
+            contentHash, apartment = run.state.unchangedApartment(data_url, apartmentPage)
+            if apartment is not None:
+                yield name, data_url, apartment, contentHash
+                continue
+        with metrics.timer('stage_seconds', 'parse'):
+            apartment = parsing.parseApartmentContent(apartmentPage, config)
+        yield name, data_url, apartment, contentHash
 
-        #Take note of the url so we don't accidently create a duplicate entry later
-        apartmentList.append(data_url)
+def walkSearchPages(run, page_url, page_num, max_pages):
+    """Yields (page number, placards, is last page) for each page of search results, starting at page_num.
+    The next page is downloaded in the background while the caller works on the current one. Stops on the
+    last page according to the pagination control, on a page without apartments, or after max_pages (0 for no limit).
+    A page that ends the search without apartments is yielded with no placards, so it is still checkpointed as the last one.
+    A search page that can't be downloaded ends the search without being yielded."""
+    url = searchPageURL(page_url, page_num)
+    logging.info("Now getting apartments from page " + str(page_num) + ": %s" % url)
+    nextPage = run.searchPool.submit(run.fetcher.fetch, url)
+    while nextPage is not None:
+        page = nextPage.result()
+        if page is None:
+            #The page couldn't be downloaded (or isn't cached in offline mode), only this search ends. It isn't
+            #checkpointed as done, so --resume tries the page again.
+            logging.warning("Search page " + str(page_num) + " couldn't be read, ending this search")
+            return
+
+        with metrics.timer('stage_seconds', 'search'):
+            # soupify the current page
+            soup = parsing.makeSoup(page, parsing.SEARCH_PAGE_SECTIONS)
+
+            # get the element that contains the apartment list
+            container = soup.find('div', class_='placardContainer')
+            placards = []
+            if container is not None:
+                placards = container.find_all('article', class_='placard')
+        if not placards:
+            logging.info("No more apartments on page " + str(page_num))
+            yield page_num, [], True
+            return
+
+        pageCount = readPageCount(soup)
+        isLast = ((pageCount is not None) and (page_num >= pageCount)) or ((max_pages > 0) and (page_num >= max_pages))
+
+        #Start downloading the next page before handing this one over
+        nextPage = None
+        if not isLast:
+            url = searchPageURL(page_url, page_num + 1)
+            logging.info("Now getting apartments from page " + str(page_num + 1) + ": %s" % url)
+            nextPage = run.searchPool.submit(run.fetcher.fetch, url)
 
-        #print some user/debug info
-        logging.info("Collecting data for: %s" % name)
+        yield page_num, placards, isLast
+        page_num += 1
 
-        #request the page and parse the data
-        apartmentPage = requests.get(data_url, headers=headers)
-        apartmentSoup = BeautifulSoup(apartmentPage.content, 'html.parser')
-        apartmentSoup.prettify()
-        parsing.parseApartmentPage(apartmentSoup, out, data_url, config)
+def scrapeSearchPage(run, page_url, page_num, max_pages, ignore_duplicates, seen, config):
+    """Goes through the search result pages starting at page_num, extracting the information from each apartment in the list"""
+    for page_num, placards, isLast in walkSearchPages(run, page_url, page_num, max_pages):
+        scrapePlacards(run, page_url, page_num, placards, isLast, ignore_duplicates, seen, config)
 
-    # recurse until the last page
-    if page_num < max_pages:
-        scrapeSearchPage(out, page_url, page_num + 1, max_pages, ignore_duplicates, apartmentList, config)
+def scrapePlacards(run, page_url, page_num, placards, isLast, ignore_duplicates, seen, config):
+    """Given the apartments listed on one search result page, extract the information from each of them"""
+    listings = newListings(readListings(placards), seen, ignore_duplicates, run.state)
 
-def loadConfigFromValuesNoCase(conf, key, values):
+    #request and parse the pages, then write the data in page order so the output matches a serial run
+    results = parseListings(listings, run, config)
+    written = []
+    for name, data_url, apartment, status in finishApartments(results, seen, ignore_duplicates, run.state, run.locations):
+        parsing.writeApartment(run.out, data_url, apartment, status)
+        if run.checkpoint is not None:
+            run.checkpoint.apartmentWritten(data_url, apartment, status)
+        written.append(data_url)
+
+    #The seen set is saved last, a listing only counts as seen once its row is written and checkpointed.
+    #Listings whose page couldn't be read aren't saved, so later runs try them again.
+    if run.state is not None:
+        run.state.commit()
+    if run.checkpoint is not None:
+        run.checkpoint.pageDone(page_url, page_num, isLast)
+    seen.commit(written)
+
+def loadConfigFromValuesNoCase(conf, key, values, fallback=None):
     """NOTE: The values must all be lowercase (e.x. \"highest\")"""
-    value = conf.get('all', key).lower()
+    if fallback is None:
+        value = conf.get('all', key).lower()
+    else:
+        value = conf.get('all', key, fallback=fallback).lower()
     if value in values:
         return value
     else:
         raise Exception("ERROR: Configuration \'" + key + "\' was an invalid value, unable to run!")
 
-def main():
-    """Read from the config file"""
-    trueValues = ['T', 't', '1', 'True', 'true']
-    priceSelectorValues = ['lowest', 'highest', 'average']
-
-    conf = configparser.ConfigParser()
-    config_file = os.path.join(os.path.dirname(__file__), "config.ini")
-    conf.read(config_file)
-
-    # get the apartments.com search URL(s)
-    apartments_url_config = conf.get('all', 'apartmentsURL')
-    urls = apartments_url_config.replace(" ", "").split(",")
+def loadConfigInt(conf, key, default):
+    """Reads an integer option, using the default when it is missing or invalid."""
+    try:
+        return int(conf.get('all', key, fallback=str(default)))
+    except ValueError:
+        logging.warning("Configuration \'" + key + "\' is not a number, using " + str(default))
+        return default
 
-    #get max page numbers
-    max_pages_config = conf.get('all', 'maxPageScrape')
-    max_pages = 1
+def loadConfigFloat(conf, key, default):
+    """Reads a decimal option, using the default when it is missing or invalid."""
     try:
-        max_pages = int(max_pages_config)
+        return float(conf.get('all', key, fallback=str(default)))
     except ValueError:
-        max_pages = 1
+        logging.warning("Configuration \'" + key + "\' is not a number, using " + str(default))
+        return default
 
-    #get ignore duplicates config
-    ignore_duplicates = conf.get('all', 'ignoreDuplicates') in trueValues
+def readConfig(conf):
+    """Reads the options shared by the whole scrape from the config file into a dict"""
+    trueValues = ['T', 't', '1', 'True', 'true']
+    priceSelectorValues = ['lowest', 'highest', 'average']
 
-    #get other configs
     config = {}
     config['separateUtilities'] = (conf.get('all', 'separateUtilities') in trueValues)
     config['separatePets'] = (conf.get('all', 'separatePets') in trueValues)
     config['separateParking'] = (conf.get('all', 'separateParking') in trueValues)
+    config['fetchWorkers'] = max(loadConfigInt(conf, 'fetchWorkers', 1), 1)
+    config['parseWorkers'] = max(loadConfigInt(conf, 'parseWorkers', 0), 0)
+    config['pipelineQueueSize'] = max(loadConfigInt(conf, 'pipelineQueueSize', 64), 1)
+    config['maxInFlight'] = max(loadConfigInt(conf, 'maxInFlight', 200), 1)
+    config['seenFile'] = conf.get('all', 'seenFile', fallback='').strip()
+    config['incremental'] = (conf.get('all', 'incremental', fallback='false') in trueValues)
+    config['stateFile'] = conf.get('all', 'stateFile', fallback='scrape_state.db').strip()
+    config['connectionPoolSize'] = max(loadConfigInt(conf, 'connectionPoolSize', 10), config['fetchWorkers'] + 1)
+    config['requestTimeout'] = loadConfigFloat(conf, 'requestTimeout', 30.0)
+    config['maxRetries'] = max(loadConfigInt(conf, 'maxRetries', 3), 0)
+    config['retryBackoff'] = loadConfigFloat(conf, 'retryBackoff', 1.0)
+    config['retryBackoffMax'] = loadConfigFloat(conf, 'retryBackoffMax', 60.0)
+    config['requestsPerSecond'] = max(loadConfigFloat(conf, 'requestsPerSecond', 0.0), 0.0)
+    config['adaptiveRate'] = (conf.get('all', 'adaptiveRate', fallback='false') in trueValues)
+    config['cacheDir'] = conf.get('all', 'cacheDir', fallback='').strip()
+    config['cacheTTL'] = loadConfigFloat(conf, 'cacheTTL', 6.0) * 60 * 60
+    config['cacheMaxSize'] = int(loadConfigFloat(conf, 'cacheMaxSize', 500.0) * 1024 * 1024)
+    config['offline'] = (conf.get('all', 'offline', fallback='false') in trueValues)
+    config['constantMemory'] = (conf.get('all', 'constantMemory', fallback='false') in trueValues)
+    config['normalizedOutput'] = (conf.get('all', 'normalizedOutput', fallback='false') in trueValues)
+    config['formulaStyle'] = loadConfigFromValuesNoCase(conf, 'formulaStyle', FORMULA_STYLES, 'cells')
+    config['analytics'] = (conf.get('all', 'analytics', fallback='false') in trueValues)
+    config['outlierZScore'] = max(loadConfigFloat(conf, 'outlierZScore', 3.0), 0.0)
+    config['metricsFile'] = conf.get('all', 'metricsFile', fallback='').strip()
+    config['metrics'] = (conf.get('all', 'metrics', fallback='false') in trueValues) or (config['metricsFile'] != '')
+    config['geocodeIndex'] = conf.get('all', 'geocodeIndex', fallback='').strip()
+    config['geocodeCache'] = conf.get('all', 'geocodeCache', fallback='geocode_cache.db').strip()
+    config['commuteDestinations'] = parseDestinations(conf.get('all', 'commuteDestinations', fallback=''))
+    config['commuteSpeed'] = max(loadConfigFloat(conf, 'commuteSpeed', 25.0), 1.0)
+    config['commuteRoadMap'] = conf.get('all', 'commuteRoadMap', fallback='').strip()
+    config['commuteCache'] = conf.get('all', 'commuteCache', fallback='commute_cache.db').strip()
     config['priceSelector'] = loadConfigFromValuesNoCase(conf, 'priceSelector', priceSelectorValues)
     config['priceAdjustment'] = (conf.get('all', 'priceAdjustment') in trueValues)
     config['adjustPrice'] = {
@@ -139,33 +272,125 @@ def main():
         if util not in config['adjustPrice']:
             config['adjustPrice'][util] = 0
 
+    return config
+
+def main(resume=False, profile=None, use_async=False):
+    """Read from the config file. The profile is the stage to profile (see profiling.PROFILE_STAGES), None to not profile.
+    With use_async the scrape runs on the asyncio engine in async_scraper.py."""
+    trueValues = ['T', 't', '1', 'True', 'true']
+
+    conf = configparser.ConfigParser()
+    config_file = os.path.join(os.path.dirname(__file__), "config.ini")
+    conf.read(config_file)
+
+    # get the apartments.com search URL(s)
+    apartments_url_config = conf.get('all', 'apartmentsURL')
+    urls = apartments_url_config.replace(" ", "").split(",")
+
+    #get max page numbers
+    max_pages_config = conf.get('all', 'maxPageScrape')
+    max_pages = 1
+    try:
+        max_pages = int(max_pages_config)
+    except ValueError:
+        max_pages = 1
+    if max_pages < 0:
+        logging.warning("Configuration \'maxPageScrape\' is negative, only the first page is read")
+        max_pages = 1
+
+    #get ignore duplicates config
+    ignore_duplicates = conf.get('all', 'ignoreDuplicates') in trueValues
+
+    #get other configs
+    config = readConfig(conf)
+    if use_async and (resume or config['incremental']):
+        raise Exception("ERROR: --async can't be combined with --resume or incremental mode, unable to run!")
+
     # get the name of the output file
     fname = conf.get('all', 'fname')
 
-    #Attempt to remove old output file to make sure we have write permissions
-    try:
-        os.remove(fname + ".xlsx")
-    except PermissionError:
-        logging.error("The output file is being used by another process. Try closing the file then run the program again: \'" + fname + ".xlsx\'")
-        return
-    except FileNotFoundError:
-        #We don't actually care about this error, we can ignore it.
-        pass
+    #get the output file formats
+    output_formats = []
+    for output_format in conf.get('all', 'outputFormats', fallback='xlsx').split(','):
+        output_format = output_format.strip().lower()
+        if output_format == '':
+            continue
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception("ERROR: Configuration \'outputFormats\' has an unknown format \'" + output_format + "\', unable to run!")
+        output_formats.append(output_format)
+
+    #Attempt to remove old output files to make sure we have write permissions
+    for output_format in output_formats:
+        for output_file in outputPaths(fname, output_format, config):
+            try:
+                os.remove(output_file)
+            except PermissionError:
+                logging.error("The output file is being used by another process. Try closing the file then run the program again: \'" + output_file + "\'")
+                return
+            except FileNotFoundError:
+                #We don't actually care about this error, we can ignore it.
+                pass
 
-    #Create the output file and start the scraping
-    out = OutputFile(fname, config)
+    if config['metrics']:
+        metrics.enable()
+
+    if profile is not None:
+        if (config['parseWorkers'] > 0) and (profile in ['all', 'parse']):
+            #The profilers only see this process, so pages are parsed here instead of in worker processes
+            logging.warning("Profiling reads every page in the main process, parseWorkers is ignored")
+            config['parseWorkers'] = 0
+        profiling.start(profile)
+
+    #Create the output files and start the scraping
+    checkpoint = Checkpoint(fname + ".checkpoint", resume)
     try:
-        scrapeApartments(out, urls, max_pages, ignore_duplicates, config)
+        out = openOutputs(fname, output_formats, config)
     except Exception:
-        logging.exception("An error has occured!")
-    finally:
-        out.close()
+        checkpoint.close()
+        raise
+    with profiling.scope('all'):
+        try:
+            if use_async:
+                from async_scraper import scrapeApartmentsAsync
+                scrapeApartmentsAsync(out, urls, max_pages, ignore_duplicates, config)
+            else:
+                scrapeApartments(out, urls, max_pages, ignore_duplicates, config, checkpoint)
+            checkpoint.finish()
+        except Exception:
+            logging.exception("An error has occured!")
+            logging.info("Progress was saved, run again with --resume to continue where it stopped")
+        except KeyboardInterrupt:
+            logging.info("Stopped, run again with --resume to continue where it stopped")
+        finally:
+            try:
+                checkpoint.close()
+            finally:
+                with metrics.timer('stage_seconds', 'close'), profiling.scope('write'):
+                    out.close()
+    if profile is not None:
+        profiled = profiling.stop()
+        logging.info(profiled.summary())
+        for path in profiled.save(fname):
+            logging.info("Profile saved to " + path)
+    if metrics.enabled():
+        logging.info(metrics.registry.summary())
+        if config['metricsFile']:
+            metrics.registry.export(config['metricsFile'])
+            logging.info("Metrics saved to " + config['metricsFile'])
     logging.info("Finished")
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scrape apartments.com search results into a spreadsheet.")
+    parser.add_argument('--resume', action='store_true', help="continue an interrupted run from its last checkpoint")
+    parser.add_argument('--profile', nargs='?', const='all', choices=profiling.PROFILE_STAGES,
+                        help="profile the run, or only one stage of it, and save the profile next to the output file")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="run on the asyncio engine, with up to maxInFlight pages downloading at once (needs aiohttp)")
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO, handlers=[
         logging.FileHandler(filename='logging.log'),
         logging.StreamHandler(sys.stdout)
     ])
-    main()
+    main(resume=args.resume, profile=args.profile, use_async=args.use_async)
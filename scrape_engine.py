@@ -0,0 +1,127 @@
+"""The parts of a scrape shared by the engine in scrape_apartments.py and the asyncio engine in async_scraper.py:
+reading the search result pages, choosing which listings to read, and finishing the apartments read from them."""
+
+import logging
+import re
+
+import parse_apartments as parsing
+from commute import Commute
+from geocoder import Geocoder
+
+class ApartmentLocations(object):
+    """Fills in the locations and commutes of apartments, with the geocoder and commute engine the config turns on."""
+
+    def __init__(self, config):
+        self.geocoder = None
+        if config['geocodeIndex']:
+            self.geocoder = Geocoder(config)
+        self.commute = None
+        if config['commuteDestinations']:
+            self.commute = Commute(config)
+
+    def add(self, apartments):
+        """Fills in the coordinates missing from the given apartment dicts, then their distance and duration, all at once."""
+        if self.geocoder is not None:
+            self.geocoder.locate(apartments)
+        if self.commute is not None:
+            self.commute.enrich(apartments)
+
+    def close(self):
+        if self.geocoder is not None:
+            self.geocoder.close()
+        if self.commute is not None:
+            self.commute.close()
+
+def searchPageURL(page_url, page_num):
+    """Returns the URL of the given page of search results."""
+    url = page_url
+    metadata = url.find('?')
+    if metadata > -1:
+        url = url[:metadata] + str(page_num) + "/" + url[metadata:]
+    else:
+        if not url.endswith("/"):
+            url += "/"
+        url += str(page_num) + "/"
+    return url
+
+def readPageCount(soup):
+    """Reads the number of result pages from the pagination control (e.x. "Page 1 of 28"), or None if it isn't there."""
+    obj = soup.find('span', class_='pageRange')
+    if obj is not None:
+        match = re.search(r'of\s*(\d+)', obj.getText())
+        if match:
+            return int(match.group(1))
+    return None
+
+def readListings(placards):
+    """Returns the (name, url, address) of each apartment listed by the placards of a search result page.
+    The address is '' when the placard doesn't show one."""
+    listings = []
+    for item in placards:
+        data_url = item.get('data-url')
+        if data_url is None: 
+            continue
+
+        # get the name for user/debug info
+        name = "N/A"
+        obj = item.find('span', class_='js-placardTitle')
+        if obj is not None:
+            name = obj.getText().strip()
+        address = ''
+        obj = item.find(class_='property-address')
+        if obj is not None:
+            address = parsing.simplify(obj.getText())
+        listings.append((name, data_url, address))
+    return listings
+
+def newListings(listings, seen, ignore_duplicates, state):
+    """Returns the (name, url) of the (name, url, address) listings of a search page that haven't been seen yet.
+    Listings skipped as duplicates are still marked as listed in the state store (None outside incremental mode)."""
+    kept = []
+    for name, data_url, address in listings:
+        #Take note of the url so we don't accidently create a duplicate entry later
+        isNew = seen.add(data_url)
+        if ignore_duplicates and not isNew:
+            logging.info('Skipping duplicate: %s' % name)
+            if state is not None:
+                state.touch(data_url)
+            continue
+        #The same complex can be listed under another url, the placard is enough to tell when it has the address
+        if ignore_duplicates and not seen.addListing(data_url, name, address):
+            logging.info('Skipping duplicate listed under another url: %s' % name)
+            if state is not None:
+                state.touch(data_url)
+            continue
+        kept.append((name, data_url))
+    return kept
+
+def finishApartments(results, seen, ignore_duplicates, state, locations):
+    """Gets the (name, url, apartment, content hash) read from the listings ready to be written, the same way for
+    both engines: drops the pages that couldn't be read and the complexes already found under another url, fills
+    in the locations and commutes, and records them in the state store. Returns (name, url, apartment, status) for
+    each apartment to write, their URLs are the only ones that should be committed to the seen set."""
+    parsed = []
+    for name, data_url, apartment, contentHash in results:
+        if apartment is None:
+            #The listing is still up, only its page couldn't be read this time
+            if state is not None:
+                state.touch(data_url)
+            continue
+        if ignore_duplicates and not seen.addApartment(data_url, apartment):
+            logging.info('Skipping duplicate found under another url: %s' % name)
+            if state is not None:
+                state.touch(data_url)
+            continue
+        parsed.append((name, data_url, apartment, contentHash))
+    #The locations and commutes of all of them are found at once
+    locations.add([apartment for name, data_url, apartment, contentHash in parsed])
+    finished = []
+    for name, data_url, apartment, contentHash in parsed:
+        #print some user/debug info
+        logging.info("Collecting data for: %s" % name)
+
+        status = None
+        if state is not None:
+            status = state.record(data_url, contentHash, apartment)
+        finished.append((name, data_url, apartment, status))
+    return finished
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+from parse_apartments import EXTRACTION_OPTIONS, PARSER_VERSION
+
+def hashContent(content):
+    return hashlib.sha256(content).hexdigest()
+
+def extractionKey(config):
+    """Identifies the parser version and the options an apartment was read with."""
+    options = [PARSER_VERSION] + [config[option] for option in EXTRACTION_OPTIONS]
+    return hashlib.sha256(json.dumps(options).encode('utf-8')).hexdigest()[:16]
+
+class StateStore(object):
+    """Remembers every apartment page seen by earlier runs: the hash of its content, the apartment
+    read from it, and when it was last seen. Pages that haven't changed since the last run don't need
+    to be read again, and pages that stopped showing up in the search results can be pointed out.
+    A stored apartment is only reused when it was read by the same parser version with the same options."""
+
+    def __init__(self, path, config):
+        self.extraction = extractionKey(config)
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS listings (
+            url TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            apartment TEXT NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            removed_at REAL,
+            extraction TEXT
+        )""")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(listings)")]
+        if 'extraction' not in columns:
+            #Made by a version that didn't store it, none of its apartments are reused
+            self.db.execute("ALTER TABLE listings ADD COLUMN extraction TEXT")
+        self.db.commit()
+        self.runStart = time.time()
+
+        #Lookups happen on the fetch threads, and sqlite connections can't be shared between threads,
+        #so everything needed for them is kept in memory. Only the main thread writes to the database.
+        self.known = {}
+        for url, contentHash, apartment, extraction in self.db.execute("SELECT url, content_hash, apartment, extraction FROM listings"):
+            self.known[url] = (contentHash, apartment, extraction)
+
+    def unchangedApartment(self, url, content):
+        """Returns (content hash, apartment). The apartment is the one stored by an earlier run if the
+        page content is exactly the same and it was read the same way, otherwise it is None and the page has
+        to be read again."""
+        contentHash = hashContent(content)
+        known = self.known.get(url)
+        if (known is None) or (known[0] != contentHash) or (known[2] != self.extraction):
+            return contentHash, None
+        return contentHash, json.loads(known[1])
+
+    def record(self, url, contentHash, apartment):
+        """Saves the apartment read from the page, returns whether it is "New", "Changed" or "Unchanged"."""
+        known = self.known.get(url)
+        if known is None:
+            status = "New"
+        elif known[0] != contentHash:
+            status = "Changed"
+        else:
+            status = "Unchanged"
+
+        now = time.time()
+        if (status == "Unchanged") and (known[2] == self.extraction):
+            self.db.execute("UPDATE listings SET last_seen = ?, removed_at = NULL WHERE url = ?", (now, url))
+        else:
+            #An unchanged page read again by a new parser or with other options keeps its status
+            data = json.dumps(apartment)
+            self.db.execute("""INSERT INTO listings (url, content_hash, apartment, first_seen, last_seen, extraction) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET content_hash = excluded.content_hash, apartment = excluded.apartment,
+                last_seen = excluded.last_seen, removed_at = NULL, extraction = excluded.extraction""",
+                (url, contentHash, data, now, now, self.extraction))
+            self.known[url] = (contentHash, data, self.extraction)
+        return status
+
+    def touch(self, url):
+        """Records that a listing is still in the search results without reading it, e.x. when it was skipped as a duplicate."""
+        self.db.execute("UPDATE listings SET last_seen = ?, removed_at = NULL WHERE url = ?", (time.time(), url))
+
+    def markRemoved(self):
+        """Marks every listing that wasn't seen during this run as removed.
+        Returns (url, apartment) for the listings that disappeared since the last run."""
+        removed = []
+        query = "SELECT url, apartment FROM listings WHERE last_seen < ? AND removed_at IS NULL ORDER BY first_seen"
+        for url, apartment in self.db.execute(query, (self.runStart,)).fetchall():
+            removed.append((url, json.loads(apartment)))
+        self.db.execute("UPDATE listings SET removed_at = ? WHERE last_seen < ? AND removed_at IS NULL", (time.time(), self.runStart))
+        self.db.commit()
+        return removed
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        """Anything recorded since the last commit is dropped, it belongs to a search page that wasn't finished."""
+        self.db.rollback()
+        self.db.close()
@@ -0,0 +1,65 @@
+import configparser
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from scrape_apartments import readConfig
+from scrape_engine import finishApartments
+from state_store import StateStore
+
+class NoLocations(object):
+    def add(self, apartments):
+        pass
+
+def exampleConfig():
+    conf = configparser.ConfigParser()
+    conf.read(os.path.join(ROOT, 'config_example.ini'))
+    return readConfig(conf)
+
+class FinishApartmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state.db')
+        self.config = exampleConfig()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_once(self, results):
+        state = StateStore(self.path, self.config)
+        finished = finishApartments(results, None, False, state, NoLocations())
+        state.commit()
+        removed = state.markRemoved()
+        state.close()
+
+        #Move the run an hour back, so the next run starts well after it
+        db = sqlite3.connect(self.path)
+        db.execute("UPDATE listings SET first_seen = first_seen - 3600, last_seen = last_seen - 3600")
+        db.commit()
+        db.close()
+        return finished, removed
+
+    def test_failed_fetch_is_not_marked_removed(self):
+        apartment = {'name': 'Complex 1', 'floorplans': []}
+        self.run_once([('Complex 1', 'http://example.com/1/', apartment, 'hash')])
+
+        finished, removed = self.run_once([('Complex 1', 'http://example.com/1/', None, None)])
+        self.assertEqual(finished, [])
+        self.assertEqual(removed, [])
+
+    def test_missing_listing_is_marked_removed(self):
+        apartment = {'name': 'Complex 1', 'floorplans': []}
+        self.run_once([('Complex 1', 'http://example.com/1/', apartment, 'hash')])
+
+        finished, removed = self.run_once([])
+        self.assertEqual(removed, [('http://example.com/1/', apartment)])
+
+if __name__ == '__main__':
+    unittest.main()